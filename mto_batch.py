@@ -0,0 +1,8 @@
+import sys
+
+import mtolib.batch as batch
+
+"""Find objects in many images - run with python mto_batch.py -h"""
+
+if __name__ == '__main__':
+    sys.exit(1 if batch.main() else 0)
@@ -1,57 +1,121 @@
-"""Classes to facilitate interaction with MTObjects C libraries."""
+"""Classes to facilitate interaction with MTObjects C libraries.
+
+The C structures depend on the pixel type, so each pixel type has its own set of classes and
+libraries, given by bindings. Sets for different types can be used together in one process.
+"""
 import ctypes as ct
+import threading
+from collections import namedtuple
+
+# Compiled maxtree and object libraries for each pixel type
+LIBRARIES = {ct.c_float: ('mtolib/lib/maxtree.so', 'mtolib/lib/mt_objects.so'),
+             ct.c_double: ('mtolib/lib/maxtree_double.so', 'mtolib/lib/mt_objects_double.so')}
+
+Bindings = namedtuple('Bindings', ['d_type', 'attribute_type', 'maxtree_lib', 'objects_lib',
+                                   'MtPixel', 'MtHeap', 'MtStack',
+                                   'MtConnectivity', 'MtNodeAttributes', 'MtNodeMoments', 'MtNode',
+                                   'Image', 'MtData', 'MtParameters', 'MtObjectData',
+                                   'SIGTEST_TYPE', 'SIGNODES_TYPE', 'INIT_TYPE',
+                                   'BATCH_TEST_TYPE'])
+
+_bindings = {}
+_bindings_lock = threading.Lock()
+
 
+def bindings(d_type):
+    """Return the classes and libraries for interaction with the C libraries for a ctypes pixel
+       type, c_float or c_double. The set for each type is made once, and may be shared by
+       threads."""
+    with _bindings_lock:
+        if d_type not in _bindings:
+            _bindings[d_type] = make_bindings(d_type)
 
-def init_classes(d_type):
-    """Initialise the classes required for interaction with C libraries."""
+        return _bindings[d_type]
+
+
+def make_bindings(d_type):
+    """Load the C libraries for a pixel type, and make the classes of their structures.
+       Node attributes have the type the maxtree library was compiled with."""
 
     float_type = d_type
     pixel_type = d_type
 
-    MtImageLocation._fields_ = [("x", ct.c_int16),
-                    ("y", ct.c_int16)]
+    maxtree_lib = ct.CDLL(LIBRARIES[d_type][0])
+    objects_lib = ct.CDLL(LIBRARIES[d_type][1])
 
-    MtPixel._fields_ = [("location", MtImageLocation),
+    attribute_size = ct.c_int.in_dll(maxtree_lib, 'mt_attribute_size').value
+    attribute_type = ct.c_double if attribute_size == ct.sizeof(ct.c_double) else ct.c_float
+
+    class MtPixel(ct.Structure):
+        _fields_ = [("index", ct.c_int32),
                     ("value", pixel_type)]
 
-    MtHeap._fields_ = [("entries", ct.POINTER(MtPixel)),
+    class MtHeap(ct.Structure):
+        _fields_ = [("entries", ct.POINTER(MtPixel)),
                     ("num_entries", ct.c_int32),
                     ("max_entries", ct.c_int32)]
 
-    MtStack._fields_ = [("entries", ct.POINTER(MtPixel)),
+    class MtStack(ct.Structure):
+        _fields_ = [("entries", ct.POINTER(MtPixel)),
                     ("num_entries", ct.c_int32),
                     ("max_entries", ct.c_int32)]
 
-    MtConnectivity._fields_ = [("neighbours", ct.POINTER(ct.c_int)),
+    class MtConnectivity(ct.Structure):
+        _fields_ = [("neighbours", ct.POINTER(ct.c_int)),
                     ("height", ct.c_int),
                     ("width", ct.c_int)]
 
-    MtNodeAttributes._fields_ = [("volume", float_type),
-                    ("power", float_type)]
-
-    MtNode._fields_ = [("parent", ct.c_int32),
+    class MtNodeAttributes(ct.Structure):
+        _fields_ = [("volume", attribute_type),
+                    ("power", attribute_type)]
+
+    class MtNodeMoments(ct.Structure):
+        _fields_ = [("sums", ct.c_double * 5),
+                    ("weighted_sums", ct.c_double * 5),
+                    ("flux", ct.c_double),
+                    ("x_min", ct.c_int32),
+                    ("y_min", ct.c_int32),
+                    ("x_max", ct.c_int32),
+                    ("y_max", ct.c_int32)]
+
+    class MtNode(ct.Structure):
+        _fields_ = [("parent", ct.c_int32),
                     ("area", ct.c_int32)]
 
-    Image._fields_ = [("data", ct.POINTER(pixel_type)),
-                    ("height", ct.c_int16),
-                    ("width", ct.c_int16),
+    class Image(ct.Structure):
+        _fields_ = [("data", ct.POINTER(pixel_type)),
+                    ("height", ct.c_int32),
+                    ("width", ct.c_int32),
                     ("size", ct.c_int32)]
 
-    MtData._fields_ = [("root", ct.POINTER(MtNode)),
+    class MtData(ct.Structure):
+        _fields_ = [("root", ct.POINTER(MtNode)),
                     ("nodes", ct.POINTER(MtNode)),
                     ("node_attributes", ct.POINTER(MtNodeAttributes)),
                     ("heap", MtHeap),
                     ("stack", MtStack),
                     ("img", Image),
                     ("connectivity", MtConnectivity),
-                    ("verbosity_level", ct.c_int)]
-
-    MtParameters._fields_ = [("verbosity", ct.c_int),
-                           ("bg_variance", ct.c_double),
-                           ("gain", ct.c_double),
-                           ("move_factor", ct.c_double),
-                           ("alpha", ct.c_double),
-                           ("min_distance", ct.c_double)]
+                    ("verbosity_level", ct.c_int),
+                    ("nodes_moments", ct.POINTER(MtNodeMoments))]
+
+    class MtParameters(ct.Structure):
+        _fields_ = [("verbosity", ct.c_int),
+                    ("bg_variance", ct.c_double),
+                    ("gain", ct.c_double),
+                    ("move_factor", ct.c_double),
+                    ("alpha", ct.c_double),
+                    ("min_distance", ct.c_double)]
+
+    # Declared before its fields, which include pointers to functions taking it
+    class MtObjectData(ct.Structure):
+        pass
+
+    SIGTEST_TYPE = ct.CFUNCTYPE(ct.c_int, ct.POINTER(MtObjectData), ct.c_int32)
+    SIGNODES_TYPE = ct.CFUNCTYPE(None, ct.POINTER(MtObjectData))
+    INIT_TYPE = ct.CFUNCTYPE(None, ct.POINTER(MtObjectData))
+    BATCH_TEST_TYPE = ct.CFUNCTYPE(None, ct.POINTER(MtObjectData), ct.POINTER(ct.c_int32),
+                                   ct.c_int32, ct.POINTER(ct.c_uint8))
 
     MtObjectData._fields_ = [("mt", ct.POINTER(MtData)),
                              ("paras", ct.POINTER(MtParameters)),
@@ -70,52 +134,12 @@ def init_classes(d_type):
                              ("significant_nodes", SIGNODES_TYPE),
                              ("node_significance_test_data", ct.c_void_p),
                              ("node_significance_test_data_free",
-                              ct.CFUNCTYPE(ct.c_void_p, ct.POINTER(MtObjectData)))]
-
-
-class MtImageLocation(ct.Structure):
-    pass
-
-
-class MtPixel(ct.Structure):
-    pass
-
-
-class MtHeap(ct.Structure):
-    pass
-
-
-class MtStack(ct.Structure):
-    pass
-
-
-class MtConnectivity(ct.Structure):
-    pass
-
-
-class MtNodeAttributes(ct.Structure):
-    pass
-
-
-class MtNode(ct.Structure):
-    pass
-
-
-class Image(ct.Structure):
-    pass
-
-
-class MtData(ct.Structure):
-    pass
-
-
-class MtObjectData(ct.Structure):
-    pass
-
-
-class MtParameters(ct.Structure):
-    pass
-
-SIGTEST_TYPE = ct.CFUNCTYPE(ct.c_int, ct.POINTER(MtObjectData), ct.c_int32)
-SIGNODES_TYPE = ct.CFUNCTYPE(None, ct.POINTER(MtObjectData))
-INIT_TYPE = ct.CFUNCTYPE(None, ct.POINTER(MtObjectData))
\ No newline at end of file
+                              ct.CFUNCTYPE(ct.c_void_p, ct.POINTER(MtObjectData))),
+                             ("branch_indices", ct.POINTER(ct.c_int32)),
+                             # Pointer to batch significance test function
+                             ("node_significance_test_batch", BATCH_TEST_TYPE)]
+
+    return Bindings(float_type, attribute_type, maxtree_lib, objects_lib,
+                    MtPixel, MtHeap, MtStack, MtConnectivity, MtNodeAttributes,
+                    MtNodeMoments, MtNode, Image, MtData, MtParameters, MtObjectData,
+                    SIGTEST_TYPE, SIGNODES_TYPE, INIT_TYPE, BATCH_TEST_TYPE)
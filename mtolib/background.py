@@ -1,28 +1,36 @@
 """Background estimation methods."""
 
 import numpy as np
-from scipy import stats
+from scipy import special, stats
 from mtolib.utils import time_function
 
 _REJECT_TILE = False
 _ACCEPT_TILE = True
 
-rejection_rate_1 = 0
-rejection_rate_2 = 0
+# Side of the smallest tiles whose moments are computed directly from the image
+BASE_TILE_SIZE = 8
 
 
-def estimate_bg(img, verbosity=1, rejection_rate=0.05):
-    """Estimate the background mean and variance of an (image) array."""
-    global rejection_rate_1, rejection_rate_2
-
+def estimate_bg(img, verbosity=1, rejection_rate=0.05, batched=True, mask=None):
+    """Estimate the background mean and variance of an (image) array.
+       If batched, all tiles of each size are tested at once from cached tile moments.
+       Pixels where mask is true are ignored, as NANs are.
+    """
     if verbosity:
         print("\n---Estimating background---")
 
-    rejection_rate_1 = 1 - pow(1 - rejection_rate, 0.5)
-    rejection_rate_2 = 1 - pow(1 - rejection_rate, 0.25)
+    if batched:
+        tiles = TileMoments(img, mask=mask)
+        available = tiles.available_tiles
+    else:
+        available = available_tiles
+
+        # The per-tile tests are given a copy with the masked pixels set to NAN
+        if mask is not None:
+            img = np.where(mask, np.nan, img)
 
     # Find a usable tile size
-    tile_size = largest_flat_tile(img, rejection_rate)
+    tile_size = largest_flat_tile(img, rejection_rate, available=available)
 
     if tile_size == 0:
         raise ValueError("No usable background tiles")
@@ -31,13 +39,26 @@ def estimate_bg(img, verbosity=1, rejection_rate=0.05):
         print("Using a tile size of", tile_size, "in the background")
 
     # Return the background mean and variance
+    if batched:
+        return tiles.collect_info(img, tile_size, rejection_rate, verbosity)
+
     return collect_info(img, tile_size, rejection_rate, verbosity)
 
 
-def largest_flat_tile(img, sig_level, tile_size_start=6, tile_size_min=4, tile_size_max=7):
+def test_levels(rejection_rate):
+    """Return the significance levels of the normality test and of each mean equality test of a
+       tile, such that a flat tile is rejected at the given rate."""
+    return 1 - pow(1 - rejection_rate, 0.5), 1 - pow(1 - rejection_rate, 0.25)
+
+
+def largest_flat_tile(img, sig_level, tile_size_start=6, tile_size_min=4, tile_size_max=7,
+                      available=None):
     """Find an image's largest flat tile.
        Tile_size values --> 2^tile_size - i.e. parameters should be exponents.
+       Tiles are tested with available(img, tile_length, sig_level), by default available_tiles.
     """
+    if available is None:
+        available = available_tiles
 
     # Convert exponents to sizes
     current_size = 2**tile_size_start
@@ -45,10 +66,10 @@ def largest_flat_tile(img, sig_level, tile_size_start=6, tile_size_min=4, tile_s
     min_size = 2**tile_size_min
 
     # If tiles available, double the size until a maximum is found
-    if available_tiles(img, current_size, sig_level):
+    if available(img, current_size, sig_level):
         while current_size < max_size:
             current_size *= 2
-            if not available_tiles(img, current_size, sig_level):
+            if not available(img, current_size, sig_level):
                 # Return the last level with flat tiles available
                 return int(current_size/2)
         # Return the maximum tile size if no limit has been found
@@ -57,7 +78,7 @@ def largest_flat_tile(img, sig_level, tile_size_start=6, tile_size_min=4, tile_s
         # If no tiles available, halve size until flat tiles found
         while current_size > min_size:
             current_size = int(current_size / 2)
-            if available_tiles(img, current_size, sig_level):
+            if available(img, current_size, sig_level):
                 # Return first size where flat tiles are found
                 return min_size
 
@@ -109,12 +130,14 @@ def check_tile_is_flat(tile, rejection_rate):
     if np.count_nonzero(~np.isnan(tile)) == 0:
         return _REJECT_TILE
 
+    normality_level, means_level = test_levels(rejection_rate)
+
     # If tile fails to be normal, reject it
-    if test_normality(tile, rejection_rate_1) is False:
+    if test_normality(tile, normality_level) is False:
         return _REJECT_TILE
 
     # If half tile means are not equal, reject the tile
-    if check_tile_means(tile, rejection_rate_2) is False:
+    if check_tile_means(tile, means_level) is False:
         return _REJECT_TILE
 
     return _ACCEPT_TILE
@@ -162,10 +185,226 @@ def test_mean_equality(array_a, array_b, test_statistic):
         return _ACCEPT_TILE
 
 
-def est_mean_and_variance(img, tile_length, usable):
-    """Calculate a mean and variance from a list of array indices"""
+def est_mean_and_variance(img, tile_length, usable, mask=None):
+    """Calculate a mean and variance from a list of array indices, ignoring masked pixels"""
 
     total_bg = np.vstack([img[u[1]:u[1]+tile_length,
                                   u[0]:u[0]+tile_length] for u in usable])
 
+    if mask is not None:
+        valid = ~np.vstack([mask[u[1]:u[1]+tile_length, u[0]:u[0]+tile_length] for u in usable])
+
+        return (np.nanmean(total_bg, axis=None, where=valid),
+                np.nanvar(total_bg, axis=None, where=valid))
+
     return np.nanmean(total_bg, axis=None), np.nanvar(total_bg,axis=None)
+
+
+def block_moments(img, size, rows_per_chunk=64, mask=None):
+    """Find the pixel count, mean, sums of powers of deviations from the mean (2 to 4) and
+       number of zeros of each size x size block of an image, ignoring NANs and pixels where
+       mask is true. Blocks which do not fit in the image are left out.
+    """
+    num_y = img.shape[0] // size
+    num_x = img.shape[1] // size
+
+    moments = [np.zeros((num_y, num_x)) for _ in range(6)]
+
+    # Process rows of blocks in chunks to limit temporary memory
+    for y in range(0, num_y, rows_per_chunk):
+        y_end = min(y + rows_per_chunk, num_y)
+
+        blocks = img[y * size:y_end * size, :num_x * size].astype(np.float64)
+        if mask is not None:
+            blocks[mask[y * size:y_end * size, :num_x * size]] = np.nan
+
+        blocks = blocks.reshape(y_end - y, size, num_x, size).swapaxes(1, 2)
+        blocks = blocks.reshape(y_end - y, num_x, size * size)
+
+        valid = ~np.isnan(blocks)
+        count = valid.sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.nansum(blocks, axis=2) / count, 0)
+
+        deviations = np.where(valid, blocks - mean[..., None], 0)
+
+        chunk = (count, mean, (deviations ** 2).sum(axis=2), (deviations ** 3).sum(axis=2),
+                 (deviations ** 4).sum(axis=2), (blocks == 0).sum(axis=2))
+
+        for moment, value in zip(moments, chunk):
+            moment[y:y_end] = value
+
+    return tuple(moments)
+
+
+def merge_moments(a, b):
+    """Combine the moments of two sets of blocks into the moments of their unions
+       (Pebay, 2008, "Formulas for robust, one-pass parallel computation of covariances and
+       arbitrary-order statistical moments").
+    """
+    n_a, mean_a, m2_a, m3_a, m4_a, zeros_a = a
+    n_b, mean_b, m2_b, m3_b, m4_b, zeros_b = b
+
+    n = n_a + n_b
+    safe_n = np.maximum(n, 1)
+    delta = mean_b - mean_a
+
+    mean = mean_a + delta * n_b / safe_n
+
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / safe_n
+
+    m3 = (m3_a + m3_b + delta ** 3 * n_a * n_b * (n_a - n_b) / safe_n ** 2 +
+          3 * delta * (n_a * m2_b - n_b * m2_a) / safe_n)
+
+    m4 = (m4_a + m4_b +
+          delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / safe_n ** 3 +
+          6 * delta ** 2 * (n_a ** 2 * m2_b + n_b ** 2 * m2_a) / safe_n ** 2 +
+          4 * delta * (n_a * m3_b - n_b * m3_a) / safe_n)
+
+    return n, mean, m2, m3, m4, zeros_a + zeros_b
+
+
+def normality_p_values(moments, resolution):
+    """Find p values of D'Agostino and Pearson's normality test for each set of moments, as
+       given by stats.normaltest.
+    """
+    n, mean, m2, m3, m4, _ = moments
+
+    with np.errstate(all='ignore'):
+        m2 = m2 / n
+        m3 = m3 / n
+        m4 = m4 / n
+
+        # Skewness and kurtosis are undefined where all values are equal
+        zero = m2 <= (resolution * mean) ** 2
+        b1 = np.where(zero, np.nan, m3 / m2 ** 1.5)
+        b2 = np.where(zero, np.nan, m4 / m2 ** 2)
+
+        # Skew test
+        y = b1 * np.sqrt(((n + 1) * (n + 3)) / (6.0 * (n - 2)))
+        beta2 = (3.0 * (n ** 2 + 27 * n - 70) * (n + 1) * (n + 3) /
+                 ((n - 2.0) * (n + 5) * (n + 7) * (n + 9)))
+        w2 = -1 + np.sqrt(2 * (beta2 - 1))
+        delta = 1 / np.sqrt(0.5 * np.log(w2))
+        alpha = np.sqrt(2.0 / (w2 - 1))
+        y = np.where(y == 0, 1, y)
+        z_skew = delta * np.log(y / alpha + np.sqrt((y / alpha) ** 2 + 1))
+
+        # Kurtosis test
+        e = 3.0 * (n - 1) / (n + 1)
+        var_b2 = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) * (n + 1.0) * (n + 3) * (n + 5))
+        x = (b2 - e) / np.sqrt(var_b2)
+        sqrt_beta1 = (6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) *
+                      np.sqrt((6.0 * (n + 3) * (n + 5)) / (n * (n - 2) * (n - 3))))
+        a = 6.0 + 8.0 / sqrt_beta1 * (2.0 / sqrt_beta1 + np.sqrt(1 + 4.0 / (sqrt_beta1 ** 2)))
+        term1 = 1 - 2 / (9.0 * a)
+        denom = 1 + x * np.sqrt(2 / (a - 4.0))
+        term2 = np.sign(denom) * np.where(denom == 0.0, np.nan,
+                                          np.power((1 - 2.0 / a) / np.abs(denom), 1 / 3.0))
+        z_kurtosis = (term1 - term2) / np.sqrt(2 / (9.0 * a))
+
+        return stats.chi2.sf(z_skew ** 2 + z_kurtosis ** 2, 2)
+
+
+def mean_equality_p_values(moments_a, moments_b):
+    """Find p values of the equal variance t-test for each pair of sets of moments, as given by
+       stats.ttest_ind.
+    """
+    n_a, mean_a, m2_a = moments_a[:3]
+    n_b, mean_b, m2_b = moments_b[:3]
+
+    with np.errstate(all='ignore'):
+        df = n_a + n_b - 2.0
+        pooled_variance = (m2_a + m2_b) / df
+        t = (mean_a - mean_b) / np.sqrt(pooled_variance * (1.0 / n_a + 1.0 / n_b))
+
+        return 2 * special.stdtr(df, -np.abs(t))
+
+
+class TileMoments:
+    """Moments of the tiles of an image, for testing every tile of a size at once.
+       Moments of larger tiles are combined from those of smaller tiles, and cached, so testing
+       another tile size reuses the work done for earlier sizes. Pixels where mask is true are
+       ignored, as NANs are.
+    """
+    def __init__(self, img, base_size=BASE_TILE_SIZE, mask=None):
+        self.base_size = base_size
+
+        if np.issubdtype(img.dtype, np.floating):
+            self.resolution = np.finfo(img.dtype).resolution
+        else:
+            self.resolution = np.finfo(np.float64).resolution
+
+        self.shape = img.shape
+        self.mask = mask
+        self.cache = {(base_size, base_size): block_moments(img, base_size, mask=mask)}
+        self.flat = {}
+
+    def moments(self, height, width):
+        """Return the moments of each height x width tile, where both sides are the base size
+           times a power of two."""
+        if (height, width) not in self.cache:
+            if height < self.base_size or width < self.base_size:
+                raise ValueError("Tiles must be at least " + str(self.base_size) + " pixels wide")
+
+            # Merge pairs of tiles along the longer side
+            if height >= width and height > self.base_size:
+                halves = self.moments(height // 2, width)
+                rows = halves[0].shape[0] // 2 * 2
+                merged = merge_moments([m[0:rows:2] for m in halves], [m[1:rows:2] for m in halves])
+            else:
+                halves = self.moments(height, width // 2)
+                columns = halves[0].shape[1] // 2 * 2
+                merged = merge_moments([m[:, 0:columns:2] for m in halves],
+                                       [m[:, 1:columns:2] for m in halves])
+
+            self.cache[(height, width)] = merged
+
+        return self.cache[(height, width)]
+
+    def flat_tiles(self, tile_length, rejection_rate):
+        """Test every tile of a size for flatness, as check_tile_is_flat does for one tile.
+           Return a boolean array with one entry per tile tested by available_tiles.
+        """
+        if (tile_length, rejection_rate) in self.flat:
+            return self.flat[(tile_length, rejection_rate)]
+
+        normality_level, means_level = test_levels(rejection_rate)
+
+        num_y = len(range(0, self.shape[0] - tile_length, tile_length))
+        num_x = len(range(0, self.shape[1] - tile_length, tile_length))
+
+        half = tile_length // 2
+
+        tiles = [m[:num_y, :num_x] for m in self.moments(tile_length, tile_length)]
+        top = [m[0:2 * num_y:2, :num_x] for m in self.moments(half, tile_length)]
+        bottom = [m[1:2 * num_y:2, :num_x] for m in self.moments(half, tile_length)]
+        left = [m[:num_y, 0:2 * num_x:2] for m in self.moments(tile_length, half)]
+        right = [m[:num_y, 1:2 * num_x:2] for m in self.moments(tile_length, half)]
+
+        # Discard tiles which are entirely zeros or entirely NANs
+        flat = (tiles[5] < tile_length ** 2) & (tiles[0] > 0)
+
+        # Comparisons with NAN p values are false, so the tile is accepted as in scipy
+        flat &= ~(normality_p_values(tiles, self.resolution) < normality_level)
+        flat &= ~(mean_equality_p_values(top, bottom) < means_level)
+        flat &= ~(mean_equality_p_values(left, right) < means_level)
+
+        self.flat[(tile_length, rejection_rate)] = flat
+
+        return flat
+
+    def available_tiles(self, img, tile_length, sig_level):
+        """Check if at least one background tile is available at this scale"""
+        return bool(self.flat_tiles(tile_length, sig_level).any())
+
+    def collect_info(self, img, tile_length, rejection_rate, verbosity=1):
+        """Find all flat tiles of a size, and estimate the mean and variance over them"""
+        tile_y, tile_x = np.nonzero(self.flat_tiles(tile_length, rejection_rate))
+
+        flat_tiles = [[x * tile_length, y * tile_length] for y, x in zip(tile_y, tile_x)]
+
+        if verbosity:
+            print("Number of usable tiles:", len(flat_tiles))
+
+        return est_mean_and_variance(img, tile_length, flat_tiles, self.mask)
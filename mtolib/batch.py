@@ -0,0 +1,249 @@
+"""Find objects in many images with a pool of worker processes.
+
+Run with: python mto_batch.py [files or patterns] -- [mto.py arguments]
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from mtolib.io_mto import make_parser
+
+# Name of the record of processed files, in the output directory by default
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def make_batch_parser():
+    """Create an argument parser for the batch options."""
+    parser = argparse.ArgumentParser(
+        description='Find objects in many fits files. Arguments after -- are passed to mto.py '
+                    'for every file.')
+    parser.add_argument('files', type=str, nargs='+', help='Fits files, or patterns matching them')
+    parser.add_argument('-out_dir', type=str, help='Directory in which to save the segmentation maps, '
+                                                   'parameters and manifest', default='mto_output')
+    parser.add_argument('-out_type', type=str, choices=('png', 'fits'), default='png',
+                        help='Format of the segmentation maps')
+    parser.add_argument('-workers', type=int, help='Number of worker processes or threads',
+                        default=os.cpu_count())
+    parser.add_argument('-threads', action='store_true',
+                        help='Process files with a pool of threads in this process rather than '
+                             'worker processes. Starts faster and shares memory, but a file which '
+                             'crashes the C libraries ends the batch')
+    parser.add_argument('-manifest', type=str, default=None,
+                        help='Record of processed files, used to skip them when rerun. '
+                             'Defaults to ' + MANIFEST_NAME + ' in the output directory')
+
+    return parser
+
+
+def expand_files(patterns):
+    """Return the absolute paths of the files matching a list of names or patterns, in order and
+       without repeats. Names matching nothing are kept, to be reported as failures."""
+    files = []
+
+    for pattern in patterns:
+        files += sorted(glob.glob(pattern)) or [pattern]
+
+    return list(dict.fromkeys(os.path.abspath(filename) for filename in files))
+
+
+def output_names(filename, out_dir, out_type, base_dir=None):
+    """Return the segmentation map and parameter file names for an input file. Files below
+       base_dir are saved in the same subdirectories of out_dir."""
+    stem = os.path.basename(filename)
+
+    for extension in ('.gz', '.fits', '.fit', '.fts'):
+        if stem.lower().endswith(extension):
+            stem = stem[:-len(extension)]
+
+    if base_dir is not None:
+        out_dir = os.path.normpath(os.path.join(out_dir, os.path.relpath(os.path.dirname(filename),
+                                                                         base_dir)))
+
+    return (os.path.join(out_dir, stem + '.' + out_type),
+            os.path.join(out_dir, stem + '_parameters.csv'))
+
+
+def all_output_names(files, out_dir, out_type):
+    """Return the output names of each of a list of absolute file paths, mirroring their
+       directories below the deepest directory which holds them all.
+       Raise a ValueError if two files would have the same outputs."""
+    base_dir = None
+    if files:
+        base_dir = os.path.commonpath([os.path.dirname(filename) for filename in files])
+
+    names = [output_names(filename, out_dir, out_type, base_dir) for filename in files]
+
+    seen = {}
+    for filename, (out, _) in zip(files, names):
+        if out in seen:
+            raise ValueError("{} and {} would both be saved as {}".format(seen[out], filename, out))
+        seen[out] = filename
+
+    return names
+
+
+def read_manifest(path):
+    """Return the last record of each file in a manifest, by file name."""
+    records = {}
+
+    try:
+        with open(path) as manifest:
+            for line in manifest:
+                try:
+                    record = json.loads(line)
+                    records[record['filename']] = record
+                except (ValueError, KeyError):
+                    # Skip a line left incomplete by an interrupted run
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return records
+
+
+def init_worker():
+    """Import the pipeline once in a worker process. The C libraries for each pixel type are
+       loaded by the first image of that type."""
+    importlib.import_module('mtolib.main')
+
+
+def process_file(filename, mto_args):
+    """Find objects in one file with mto.py's arguments, in a worker process or thread.
+       Return a manifest record of the outcome, with the time taken."""
+    from mtolib import main
+
+    start_time = time.time()
+    record = {'filename': filename}
+
+    try:
+        image, params = main.setup(mto_args)
+        id_map = main.run(image, params)
+
+        record.update(status='done', objects=int(id_map.max()))
+
+    # Failures, including exits on unreadable files, are recorded rather than ending the batch
+    except (Exception, SystemExit) as error:
+        record.update(status='failed', error='{}: {}'.format(type(error).__name__, error))
+
+    record['seconds'] = round(time.time() - start_time, 3)
+
+    return record
+
+
+def run_pool(jobs, num_workers, on_result):
+    """Run jobs of a file name and arguments in a pool of worker processes, passing each record
+       to on_result. Return the jobs lost if a worker process died."""
+    lost = []
+
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker) as executor:
+        futures = {executor.submit(process_file, *job): job for job in jobs}
+
+        for future in as_completed(futures):
+            try:
+                on_result(future.result())
+            except BrokenProcessPool:
+                lost.append(futures[future])
+
+    return lost
+
+
+def run_jobs(jobs, num_workers, on_result):
+    """Run jobs as run_pool does. Jobs lost when a worker dies are run again one at a time, so that
+       only a file which kills its worker is recorded as failed."""
+    for job in run_pool(jobs, num_workers, on_result):
+        if run_pool([job], 1, on_result):
+            on_result({'filename': job[0], 'status': 'failed', 'error': 'Worker process died',
+                       'seconds': None})
+
+
+def run_threads(jobs, num_workers, on_result):
+    """Run jobs of a file name and arguments in a pool of threads in this process, passing each
+       record to on_result."""
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(process_file, *job) for job in jobs]
+
+        for future in as_completed(futures):
+            on_result(future.result())
+
+
+def main(argv=None):
+    """Find objects in every file not recorded as done in the manifest.
+       Return the number of files which failed."""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Arguments after -- are for mto.py
+    if '--' in argv:
+        split = argv.index('--')
+        argv, mto_args = argv[:split], argv[split + 1:]
+    else:
+        mto_args = []
+
+    parser = make_batch_parser()
+    args = parser.parse_args(argv)
+
+    # Check the mto.py arguments before starting
+    make_parser().parse_args(mto_args + ['input.fits'])
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.out_dir, MANIFEST_NAME)
+
+    files = expand_files(args.files)
+
+    # Names are given to every file, done or not, so that they do not change when rerun
+    try:
+        names = dict(zip(files, all_output_names(files, args.out_dir, args.out_type)))
+    except ValueError as error:
+        parser.error(str(error))
+
+    done = {filename for filename, record in read_manifest(manifest_path).items()
+            if record.get('status') == 'done'}
+    files = [filename for filename in files if filename not in done]
+
+    print('{} files to process, {} done before.'.format(len(files), len(done)))
+
+    counts = {'done': 0, 'failed': 0}
+    start_time = time.time()
+
+    with open(manifest_path, 'a') as manifest:
+
+        def on_result(record):
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+
+            counts[record['status']] += 1
+            progress = '[{}/{}] {}'.format(sum(counts.values()), len(files), record['filename'])
+
+            if record['status'] == 'done':
+                print('{}: {} objects in {:.1f} s'.format(progress, record['objects'],
+                                                          record['seconds']))
+            else:
+                print('{}: FAILED - {}'.format(progress, record['error']))
+
+        jobs = []
+
+        for filename in files:
+            out, par_out = names[filename]
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            jobs.append((filename, mto_args + [filename, '-out', out, '-par_out', par_out]))
+
+        if args.threads:
+            run_threads(jobs, args.workers, on_result)
+        else:
+            run_jobs(jobs, args.workers, on_result)
+
+    elapsed_time = time.time() - start_time
+    print('{} done, {} failed in {:.1f} s ({:.0f} frames/hour).'.format(
+        counts['done'], counts['failed'], elapsed_time,
+        counts['done'] * 3600 / elapsed_time if elapsed_time else 0))
+
+    return counts['failed']
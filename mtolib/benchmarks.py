@@ -0,0 +1,569 @@
+"""Benchmarks comparing max tree construction methods.
+
+Run with: python -m mtolib.benchmarks
+"""
+
+import argparse
+import ctypes as ct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from mtolib import maxtree, significance_tests, tree_filtering
+from mtolib.utils import reset_peak_memory, resource_usage
+from mtolib.io_mto import make_parser, read_fits_file
+from mtolib.postprocessing import ObjectIndex, get_catalogue, relabel_segments
+from mtolib.preprocessing import estimate_background, preprocess_image
+
+
+def synthetic_image(height, width, num_sources=200, seed=0):
+    """Make a synthetic image of gaussian sources on unit noise."""
+    rng = np.random.RandomState(seed)
+
+    img = rng.normal(0, 1, (height, width))
+
+    y, x = np.mgrid[:height, :width]
+    for _ in range(num_sources):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        sigma = rng.uniform(1, 8)
+        img += rng.uniform(5, 100) * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * sigma ** 2))
+
+    return img
+
+
+def flat_background_image(height, width, num_sources=200, flat_fraction=0.8, seed=0):
+    """Make a synthetic image of gaussian sources on noise, with most of the background clipped
+       to zero, as after preprocessing. Large flat regions like this are the worst case for
+       flooding with a priority queue.
+    """
+    img = synthetic_image(height, width, num_sources, seed)
+
+    threshold = np.percentile(img, flat_fraction * 100)
+    return np.clip(img - threshold, 0, None).astype(np.float32)
+
+
+def frame_image(side, sources_per_megapixel=50, seed=0):
+    """Make a large synthetic frame of gaussian sources on unit noise, in single precision.
+       Each source is added within a box around it, so that frames of many pixels are quick to
+       make."""
+    rng = np.random.default_rng(seed)
+
+    img = rng.standard_normal((side, side), dtype=np.float32)
+
+    y, x = np.mgrid[-32:33, -32:33]
+    for _ in range(side * side * sources_per_megapixel // 10 ** 6):
+        cy, cx = rng.integers(32, side - 32, 2)
+        sigma = rng.uniform(1, 8)
+        img[cy - 32:cy + 33, cx - 32:cx + 33] += (
+            rng.uniform(5, 100) * np.exp(-(y ** 2 + x ** 2) / (2 * sigma ** 2)))
+
+    return img
+
+
+def tree_arrays(mt):
+    """Return the parents, areas, volumes and powers of a flooded max tree as numpy arrays.
+       The arrays keep the tree's memory after it is freed."""
+    return mt.parent, mt.area, mt.volume, mt.power
+
+
+def canonical_tree(image, parents):
+    """Label each flat zone of a max tree by its first pixel.
+       Return a level root mask, each pixel's level root, and each level root's label.
+    """
+    values = image.ravel()
+    indices = np.arange(values.size)
+
+    level_roots = (parents < 0) | (values[np.maximum(parents, 0)] != values)
+    zones = np.where(level_roots, indices, parents)
+
+    labels = np.full(values.size, values.size)
+    np.minimum.at(labels, zones, indices)
+
+    return level_roots, zones, labels
+
+
+def trees_equivalent(image, tree_a, tree_b, rtol=1e-4):
+    """Check whether two max trees of an image have the same structure and attributes.
+       Level roots of flat zones may be represented by different pixels.
+    """
+    level_roots_a, zones_a, labels_a = canonical_tree(image, tree_a[0])
+    level_roots_b, zones_b, labels_b = canonical_tree(image, tree_b[0])
+
+    if not np.array_equal(labels_a[zones_a], labels_b[zones_b]):
+        return False
+
+    # Match level roots by the label of their flat zone
+    roots_a = np.nonzero(level_roots_a)[0]
+    roots_b = np.nonzero(level_roots_b)[0]
+    roots_a = roots_a[np.argsort(labels_a[roots_a])]
+    roots_b = roots_b[np.argsort(labels_b[roots_b])]
+
+    parents_a = np.where(tree_a[0][roots_a] < 0, -1, labels_a[np.maximum(tree_a[0][roots_a], 0)])
+    parents_b = np.where(tree_b[0][roots_b] < 0, -1, labels_b[np.maximum(tree_b[0][roots_b], 0)])
+
+    if not np.array_equal(parents_a, parents_b):
+        return False
+
+    if not np.array_equal(tree_a[1][roots_a], tree_b[1][roots_b]):
+        return False
+
+    # Sums are accumulated in different orders
+    for a, b in zip(tree_a[2:], tree_b[2:]):
+        if not np.allclose(a[roots_a], b[roots_b], rtol=rtol, atol=rtol):
+            return False
+
+    return True
+
+
+def time_maxtree(image, params, maxtree_class, repeats=3):
+    """Build a max tree several times, and return the fastest flood time, the last tree and its
+       number of nodes."""
+    best_time = np.inf
+
+    for _ in range(repeats):
+        mt = maxtree_class(image, 0, params)
+
+        start_time = time.perf_counter()
+        mt.flood()
+        best_time = min(best_time, time.perf_counter() - start_time)
+
+        tree = tree_arrays(mt)
+        num_nodes = mt.num_nodes()
+        mt.free_objects()
+
+    return best_time, tree, num_nodes
+
+
+def time_flood(image, params, maxtree_class, repeats=3):
+    """Return the fastest of several flood times of a max tree, keeping one tree at a time."""
+    best_time = np.inf
+
+    for _ in range(repeats):
+        mt = maxtree_class(image, 0, params)
+
+        start_time = time.perf_counter()
+        mt.flood()
+        best_time = min(best_time, time.perf_counter() - start_time)
+
+        mt.free_objects()
+
+    return best_time
+
+
+def compare_flood_sizes(sides, connectivities=(4, 8), repeats=3):
+    """Time flooding frames of each side length with the priority queue flood, connecting each
+       pixel to each number of neighbours. Return the best time and the time per million pixels
+       for each connectivity, for each side."""
+    results = []
+
+    for side in sides:
+        image = frame_image(side)
+        side_results = []
+
+        for connectivity in connectivities:
+            params = argparse.Namespace(d_type=ct.c_float, connectivity=connectivity)
+            flood_time = time_flood(image, params, maxtree.OriginalMaxTree, repeats)
+            side_results.append((flood_time, flood_time * 10 ** 6 / side ** 2))
+
+        results.append(side_results)
+
+    return results
+
+
+def compare_maxtrees(image, params, maxtree_classes, repeats=3):
+    """Time each max tree class on an image, and check that they build equivalent trees.
+       Return a list of (class name, time, equivalent to first class) tuples.
+    """
+    results = []
+    reference = None
+
+    for maxtree_class in maxtree_classes:
+        flood_time, tree, _ = time_maxtree(image, params, maxtree_class, repeats)
+
+        if reference is None:
+            reference = tree
+
+        results.append((maxtree_class.__name__, flood_time, trees_equivalent(image, reference, tree)))
+
+    return results
+
+
+def compare_levels(image, params, levels, repeats=3):
+    """Compare flooding an image quantised to a number of levels with flooding the unquantised
+       image. Return the node counts and flood times of both trees.
+    """
+    float_time, _, float_nodes = time_maxtree(image, params, maxtree.OriginalMaxTree, repeats)
+    levels_time, _, levels_nodes = time_maxtree(image, params,
+                                                partial(maxtree.QuantisedMaxTree, levels=levels),
+                                                repeats)
+
+    return float_nodes, levels_nodes, float_time, levels_time
+
+
+def default_params():
+    """Return the default MTObjects parameters."""
+    params = make_parser().parse_args([''])
+    params.soft_bias = 0.0
+
+    return params
+
+
+def compare_preprocessing(image, repeats=3):
+    """Preprocess an image with and without fusing the steps, and check that the results are the
+       same. Return the fastest time and the growth in peak memory use, in MB, of each method,
+       and whether the results are equal.
+    """
+    params = default_params()
+    estimate_background(image, params)
+
+    results = []
+    outputs = []
+
+    for fused in (False, True):
+        best_time = np.inf
+
+        for _ in range(repeats):
+            output = None
+            reset_peak_memory()
+            _, start_memory, _ = resource_usage()
+
+            start_time = time.perf_counter()
+            output = preprocess_image(image, params, n=2, fused=fused)
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+            memory = (resource_usage()[2] - start_memory) / 2**20
+
+        results.append((best_time, memory))
+        outputs.append(output)
+
+    return results[0], results[1], np.array_equal(*outputs)
+
+
+def compare_sweep(image, move_factors, min_distances, num_threads, repeats=3):
+    """Filter one max tree of an image for every combination of move factor and minimum distance,
+       with filter_tree for each setting and with sweep_tree on one and num_threads threads.
+       Return the fastest time of each method, and whether the id maps are all the same.
+    """
+    params = default_params()
+    params.d_type = ct.c_float
+
+    processed_image = preprocess_image(image, params, n=2)
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    settings = [dict(move_factor=move_factor, min_distance=min_distance)
+                for move_factor in move_factors for min_distance in min_distances]
+
+    def filter_each():
+        results = []
+
+        for setting in settings:
+            for name, value in setting.items():
+                setattr(params, name, value)
+
+            results.append(tree_filtering.filter_tree(mt, processed_image, params))
+
+        return results
+
+    methods = [filter_each,
+               partial(tree_filtering.sweep_tree, mt, processed_image, params, settings),
+               partial(tree_filtering.sweep_tree, mt, processed_image, params, settings,
+                       num_threads=num_threads)]
+
+    times = []
+    outputs = []
+
+    for method in methods:
+        best_time = np.inf
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            output = method()
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        times.append(best_time)
+        outputs.append([id_map for id_map, _ in output])
+
+    mt.free_objects()
+
+    same = all(np.array_equal(a, b) for output in outputs[1:] for a, b in zip(outputs[0], output))
+
+    return times, same
+
+
+def compare_batch_test(image, repeats=3):
+    """Filter a max tree of an image with significance test 4 in C, node by node, and written in
+       Python as a batch test. Return the fastest time of each, and whether the id maps are
+       the same.
+    """
+    params = default_params()
+    params.d_type = ct.c_float
+
+    processed_image = preprocess_image(image, params, n=2)
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    times = []
+    outputs = []
+
+    for sig_test in (tree_filtering.default_sig_test, significance_tests.batch_test_4()):
+        best_time = np.inf
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            id_map, _ = tree_filtering.filter_tree(mt, processed_image, params, sig_test)
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        times.append(best_time)
+        outputs.append(id_map)
+
+    mt.free_objects()
+
+    return times, np.array_equal(*outputs)
+
+
+def compare_alpha(image, alphas, repeats=3):
+    """Filter a max tree of an image with significance test 4 at each significance level, with the
+       fitted boundary for 1e-6 and boundary tables for other levels.
+       Return the fastest time and the number of objects for each level.
+    """
+    params = default_params()
+    params.d_type = ct.c_float
+
+    processed_image = preprocess_image(image, params, n=2)
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    results = []
+
+    for alpha in alphas:
+        params.alpha = alpha
+        best_time = np.inf
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            id_map, _ = tree_filtering.filter_tree(mt, processed_image, params)
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        results.append((best_time, np.count_nonzero(np.unique(id_map) != -1)))
+
+    mt.free_objects()
+
+    return results
+
+
+def find_objects(image, d_type):
+    """Find objects in an image with the default parameters, in the precision of a ctypes float
+       type matching the image. Return the relabelled object map, its catalogue, the time taken
+       and the growth in peak memory use, in MB.
+    """
+    params = default_params()
+    params.d_type = d_type
+
+    reset_peak_memory()
+    _, start_memory, _ = resource_usage()
+    start_time = time.perf_counter()
+
+    processed_image = preprocess_image(image, params, n=2)
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+    id_map, _ = tree_filtering.filter_tree(mt, processed_image, params)
+    mt.free_objects()
+
+    total_time = time.perf_counter() - start_time
+    memory = (resource_usage()[2] - start_memory) / 2**20
+
+    index = ObjectIndex(id_map)
+    id_map = relabel_segments(id_map, index=index)
+
+    return id_map, get_catalogue(image, id_map, index.relabelled(id_map)), total_time, memory
+
+
+def compare_precision(image):
+    """Find objects in an image in single and double precision.
+       Return the results of find_objects for each, the fraction of pixels given to matching
+       objects, and the largest relative difference in total flux between matching objects.
+       Objects match if each is the other's largest overlap.
+    """
+    results = [find_objects(image.astype(dtype), d_type)
+               for d_type, dtype in ((ct.c_float, np.float32), (ct.c_double, np.float64))]
+
+    ids_a, ids_b = results[0][0].ravel(), results[1][0].ravel()
+
+    # Count the pixels shared by each pair of objects, including the background
+    pairs, overlaps = np.unique(np.stack([ids_a, ids_b]), axis=1, return_counts=True)
+
+    # Keep each pair which is the largest overlap of both of its objects
+    order = np.argsort(-overlaps, kind='stable')
+    _, first_a = np.unique(pairs[0][order], return_index=True)
+    _, first_b = np.unique(pairs[1][order], return_index=True)
+    matches = order[np.intersect1d(first_a, first_b)]
+
+    matched_pixels = overlaps[matches].sum() / ids_a.size
+
+    # Compare the total flux of matching objects
+    flux_a = {row[0]: row[6] for row in results[0][1]}
+    flux_b = {row[0]: row[6] for row in results[1][1]}
+    flux_errors = [abs(flux_a[a] - flux_b[b]) / abs(flux_b[b])
+                   for a, b in pairs[:, matches].T.tolist() if a in flux_a and b in flux_b]
+
+    return results[0], results[1], matched_pixels, max(flux_errors, default=0)
+
+
+def process_frame(image):
+    """Find objects in an image with the default parameters, as mto.py does without saving the
+       results. Return the relabelled object map and its catalogue."""
+    params = default_params()
+    params.d_type = ct.c_double if image.dtype == np.float64 else ct.c_float
+
+    processed_image = preprocess_image(image, params, n=2)
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+    id_map, _ = tree_filtering.filter_tree(mt, processed_image, params)
+    mt.free_objects()
+
+    index = ObjectIndex(id_map)
+    id_map = relabel_segments(id_map, index=index)
+
+    return id_map, get_catalogue(image, id_map, index.relabelled(id_map))
+
+
+def compare_threads(images, thread_counts, repeats=3):
+    """Find objects in a list of images with a pool of each number of threads.
+       Return the best throughput of each pool, in images per second, and whether the results
+       are the same for every pool.
+    """
+    throughputs = []
+    outputs = []
+
+    for num_threads in thread_counts:
+        best_time = np.inf
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+
+            with ThreadPoolExecutor(num_threads) as executor:
+                output = list(executor.map(process_frame, images))
+
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        throughputs.append(len(images) / best_time)
+        outputs.append(output)
+
+    same = all(np.array_equal(a[0], b[0]) and a[1] == b[1]
+               for output in outputs[1:] for a, b in zip(outputs[0], output))
+
+    return throughputs, same
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare max tree construction methods.')
+    parser.add_argument('-size', type=int, nargs='+', default=[1000, 3000],
+                        help='Image side lengths to test')
+    parser.add_argument('-flat_fraction', type=float, default=0.8,
+                        help='Fraction of the image clipped to a flat background')
+    parser.add_argument('-repeats', type=int, default=3, help='Number of timing runs')
+    parser.add_argument('-levels', type=int, nargs='*', default=[65536, 4096, 256],
+                        help='Numbers of grey levels to compare with the unquantised flood')
+    parser.add_argument('-threads', type=int, default=4,
+                        help='Number of threads with which to filter a parameter sweep')
+    parser.add_argument('-frames', type=int, default=8,
+                        help='Number of images processed by each pool of threads')
+    parser.add_argument('-thread_counts', type=int, nargs='*', default=[1, 2, 4],
+                        help='Numbers of threads with which to process images concurrently')
+    parser.add_argument('-flood_sides', type=int, nargs='*', default=[4096, 8192, 16384],
+                        help='Side lengths of large frames on which to time flooding')
+    parser.add_argument('-connectivities', type=int, nargs='+', default=[4, 8],
+                        choices=maxtree.CONNECTIVITIES,
+                        help='Numbers of connected neighbours with which to time flooding')
+    parser.add_argument('-fits', type=str, nargs='*', default=[],
+                        help='FITS files on which to compare single and double precision')
+    args = parser.parse_args()
+
+    params = argparse.Namespace(d_type=ct.c_float)
+
+    maxtree_classes = [maxtree.OriginalMaxTree, maxtree.UnionFindMaxTree]
+
+    for size in args.size:
+        image = flat_background_image(size, size, num_sources=size // 5,
+                                      flat_fraction=args.flat_fraction)
+
+        print('\n{0}x{0} image, {1:.0%} flat background'.format(size, args.flat_fraction))
+        for name, flood_time, equivalent in compare_maxtrees(image, params, maxtree_classes,
+                                                             args.repeats):
+            print('{:<20} {:8.3f} s  {}'.format(name, flood_time,
+                                                'equivalent' if equivalent else 'DIFFERENT'))
+
+        for levels in args.levels:
+            float_nodes, levels_nodes, float_time, levels_time = compare_levels(image, params, levels,
+                                                                                args.repeats)
+            print('{} levels: {} of {} nodes ({:.0%} fewer), {:.3f} s of {:.3f} s ({:.0%} faster)'.format(
+                levels, levels_nodes, float_nodes, 1 - levels_nodes / float_nodes,
+                levels_time, float_time, 1 - levels_time / float_time))
+
+        image = synthetic_image(size, size, num_sources=size // 5).astype(np.float32)
+
+        (unfused_time, unfused_memory), (fused_time, fused_memory), same = compare_preprocessing(
+            image, args.repeats)
+        print('preprocessing: {:.3f} s, peak memory +{:.0f} MB; fused {:.3f} s, +{:.0f} MB, {}'.format(
+            unfused_time, unfused_memory, fused_time, fused_memory, 'same' if same else 'DIFFERENT'))
+
+        print_precision(image)
+
+        move_factors, min_distances = (0, 0.25, 0.5, 1), (0, 0.5, 1)
+        (each_time, sweep_time, threaded_time), same = compare_sweep(
+            image, move_factors, min_distances, args.threads, args.repeats)
+        print('{} settings: filter_tree {:.3f} s, sweep_tree {:.3f} s, {} threads {:.3f} s, {}'.format(
+            len(move_factors) * len(min_distances), each_time, sweep_time, args.threads,
+            threaded_time, 'same' if same else 'DIFFERENT'))
+
+        (c_time, python_time), same = compare_batch_test(image, args.repeats)
+        print('significance test 4: C {:.3f} s, Python batch test {:.3f} s, {}'.format(
+            c_time, python_time, 'same' if same else 'DIFFERENT'))
+
+        alphas = (1e-6, 1e-4, 1e-2)
+        print('alpha: ' + ', '.join('{:g} {:.3f} s {} objects'.format(alpha, filter_time, objects)
+                                    for alpha, (filter_time, objects)
+                                    in zip(alphas, compare_alpha(image, alphas, args.repeats))))
+
+        if args.thread_counts:
+            throughputs, same = compare_threads([image] * args.frames, args.thread_counts,
+                                                args.repeats)
+            print('{} images: {}, {}'.format(args.frames, ', '.join(
+                '{} threads {:.2f}/s ({:.2f}x)'.format(num_threads, throughput,
+                                                      throughput / throughputs[0])
+                for num_threads, throughput in zip(args.thread_counts, throughputs)),
+                'same' if same else 'DIFFERENT'))
+
+    if args.flood_sides:
+        print()
+        for side, side_results in zip(args.flood_sides,
+                                      compare_flood_sizes(args.flood_sides, args.connectivities,
+                                                          args.repeats)):
+            print('{0}x{0} frame flood: {1}'.format(side, ', '.join(
+                '{}-connected {:.3f} s ({:.4f} s per megapixel)'.format(connectivity, flood_time,
+                                                                       megapixel_time)
+                for connectivity, (flood_time, megapixel_time)
+                in zip(args.connectivities, side_results))))
+
+    for filename in args.fits:
+        print('\n' + filename)
+        print_precision(read_fits_file(filename))
+
+
+def print_precision(image):
+    """Print a comparison of finding objects in an image in single and double precision."""
+    single, double, matched_pixels, flux_error = compare_precision(image)
+
+    for name, (id_map, _, total_time, peak_memory) in (('single', single), ('double', double)):
+        print('{} precision: {} objects, {:.3f} s, peak memory +{:.0f} MB'.format(
+            name, id_map.max(), total_time, peak_memory))
+
+    print('{:.4%} of pixels in matching objects, largest flux difference {:.2e}'.format(
+        matched_pixels, flux_error))
+
+
+if __name__ == '__main__':
+    main()
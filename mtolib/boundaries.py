@@ -0,0 +1,169 @@
+"""Rejection boundaries of significance test 4 for any significance level.
+
+The boundary of test 4 is a rational fit in area for alpha = 1e-6. For other values of alpha, the
+fit is scaled at each area by the ratio of the chi-square quantiles of alpha and 1e-6, with one
+degree of freedom per independent sample of the smoothed noise in the area. The boundary is
+tabulated by area, and the tables are cached on disk.
+"""
+
+import ctypes as ct
+import hashlib
+import os
+import threading
+import numpy as np
+from scipy import ndimage, signal, stats
+
+from mtolib.utils import fwhm_to_sigma
+
+# Significance level of the fitted boundary
+DEFAULT_ALPHA = 1e-6
+
+# Increase when the tables change
+BOUNDARY_VERSION = 1
+
+# Number of areas in each table, from an area of one pixel
+TABLE_AREAS = 4096
+
+# Coefficients of the fitted boundary, which is constant above FIT_MAX_AREA
+FIT_MAX_AREA = 4087
+FIT_P = (1.683355084690155e-01, 3.770229379757511e+02, 1.176722049258011e+05,
+         6.239836661965291e+06)
+FIT_Q = (1.354265276841128e+03, 2.091126298053044e+05, 1.424803575269314e+06)
+
+_boundaries = {}
+_boundaries_lock = threading.Lock()
+
+
+def default_directory():
+    """Return the directory in which boundary tables are cached by default."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(cache_home, 'mtobjects', 'boundaries')
+
+
+def fitted_boundary(area, float_type=np.float64):
+    """Return the fitted boundary for alpha = 1e-6 at each area, computed in a float type as
+       mt_node_test_4 does."""
+    area = np.minimum(area, FIT_MAX_AREA)
+
+    area_to_2 = (area * area).astype(float_type)
+    area_to_3 = area_to_2 * np.asarray(area).astype(float_type)
+    area = np.asarray(area).astype(float_type)
+
+    p1, p2, p3, p4 = (float_type(p) for p in FIT_P)
+    q1, q2, q3 = (float_type(q) for q in FIT_Q)
+
+    x = p1 * area_to_3 + p2 * area_to_2 + p3 * area + p4
+    x /= area_to_3 + q1 * area_to_2 + q2 * area + q3
+
+    return x
+
+
+def correlation_area(fwhm=2):
+    """Return the number of pixels per independent sample of white noise smoothed by a gaussian
+       with a full width at half maximum, as preprocessing does. This is the sum of the squared
+       autocorrelation of the smoothed noise."""
+    sigma = fwhm_to_sigma(fwhm)
+    radius = int(4 * sigma + 0.5)
+
+    impulse = np.zeros((2 * radius + 1, 2 * radius + 1))
+    impulse[radius, radius] = 1
+
+    kernel = ndimage.gaussian_filter(impulse, sigma, mode='constant')
+    autocorrelation = signal.correlate(kernel, kernel)
+
+    return float(np.sum((autocorrelation / autocorrelation.max()) ** 2))
+
+
+def boundary_table(alpha, num_areas=TABLE_AREAS, fwhm=2):
+    """Return the boundary for a significance level at each area from 1 to num_areas, in double
+       precision."""
+    area = np.arange(1, num_areas + 1)
+    dof = area / correlation_area(fwhm)
+
+    return fitted_boundary(area) * stats.chi2.isf(alpha, dof) / stats.chi2.isf(DEFAULT_ALPHA, dof)
+
+
+class RejectionBoundary:
+    """The boundary of test 4 for a significance level, as a table by area in a float type.
+       Larger areas scale the last entry by the ratio of the chi-square quantiles of alpha and
+       1e-6, from the Wilson-Hilferty approximation.
+    """
+    def __init__(self, alpha, float_type, directory=None, fwhm=2):
+        self.alpha = alpha
+        self.float_type = np.dtype(float_type).type
+        self.correlation_area = correlation_area(fwhm)
+
+        self.z_alpha = stats.norm.isf(alpha)
+        self.z_default = stats.norm.isf(DEFAULT_ALPHA)
+
+        self.table = self.load(directory, fwhm)
+
+    def load(self, directory, fwhm):
+        """Return the table from the cache directory, computing and saving it if it is not
+           there. The table is computed without saving if the directory is not writable."""
+        if directory is None:
+            directory = default_directory()
+
+        settings = (BOUNDARY_VERSION, float(self.alpha).hex(), np.dtype(self.float_type).str,
+                    TABLE_AREAS, fwhm)
+        key = hashlib.blake2b(repr(settings).encode(), digest_size=16).hexdigest()
+        path = os.path.join(directory, key + '.npy')
+
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            pass
+
+        table = boundary_table(self.alpha, TABLE_AREAS, fwhm).astype(self.float_type)
+
+        # Complete tables appear at once
+        try:
+            os.makedirs(directory, exist_ok=True)
+            temporary_path = path + '.tmp' + str(os.getpid()) + '.npy'
+            np.save(temporary_path, table)
+            os.replace(temporary_path, path)
+        except OSError:
+            pass
+
+        return table
+
+    def quantile_ratio(self, area):
+        """Return the approximate ratio of the chi-square quantiles of alpha and 1e-6 for the
+           degrees of freedom of each area, as mt_quantile_ratio does."""
+        c = 2 / (9 * (np.asarray(area) / self.correlation_area))
+
+        return ((1 - c + self.z_alpha * np.sqrt(c)) / (1 - c + self.z_default * np.sqrt(c))) ** 3
+
+    def __call__(self, area):
+        """Return the boundary at each area, as mt_node_test_4 does."""
+        area = np.asarray(area)
+        inside = area <= len(self.table)
+
+        x = np.empty(area.shape, dtype=self.float_type)
+        x[inside] = self.table[area[inside] - 1]
+        x[~inside] = (self.table[-1] * self.quantile_ratio(area[~inside]) /
+                      self.quantile_ratio(len(self.table)))
+
+        return x
+
+    def use(self, mto_lib, mto):
+        """Set up test 4 in the C object data with this boundary."""
+        pixel_type = np.ctypeslib.as_ctypes_type(self.float_type)
+
+        mto_lib.mt_use_node_test_4_boundaries.argtypes = [
+            type(mto), ct.POINTER(pixel_type), ct.c_int32, ct.c_double, ct.c_double, ct.c_double]
+        mto_lib.mt_use_node_test_4_boundaries(mto, self.table.ctypes.data_as(ct.POINTER(pixel_type)),
+                                              len(self.table), self.z_alpha, self.z_default,
+                                              self.correlation_area)
+
+
+def rejection_boundary(alpha, float_type):
+    """Return the boundary for a significance level in a float type, made once for each."""
+    key = (alpha, np.dtype(float_type).str)
+
+    with _boundaries_lock:
+        if key not in _boundaries:
+            _boundaries[key] = RejectionBoundary(alpha, float_type)
+
+        return _boundaries[key]
@@ -0,0 +1,186 @@
+"""A cache of preprocessed images and max trees on disk, so that an image can be filtered again
+with different parameters without being preprocessed and flooded again."""
+
+import ctypes as ct
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from mtolib import _ctype_classes as mt_class
+
+# Increase when the format of cached trees changes
+CACHE_VERSION = 5
+
+# Approximate size in bytes of the blocks of rows hashed together
+HASH_BLOCK_SIZE = 2 ** 24
+
+# Parameters which may be estimated by preprocessing, and are stored with each tree
+PREPROCESSING_PARAMETERS = ('bg_mean', 'bg_variance', 'gain', 'soft_bias')
+
+
+def image_hash(img):
+    """Return a hash of an image's shape, type and pixels, read a block of rows at a time."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((img.shape, img.dtype.str)).encode())
+
+    block_rows = max(1, HASH_BLOCK_SIZE // max(1, img[0].nbytes))
+
+    for start in range(0, img.shape[0], block_rows):
+        digest.update(np.ascontiguousarray(img[start:start + block_rows]).data)
+
+    return digest.hexdigest()
+
+
+class TreeCache:
+    """A directory of preprocessed images and their max trees, keyed by the input image and the
+       parameters used to build them. Cached arrays are memory mapped when loaded.
+       The least recently used entries are removed to keep the cache below max_bytes, and hits
+       and misses are counted across runs.
+    """
+    def __init__(self, directory, max_bytes=2 ** 32, verbosity=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verbosity = verbosity
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, img, p, maxtree_name, n=2, gaussian_blur=True, levels=None, moments=False,
+            connectivity=4, mask=None):
+        """Return the key of a tree of a named class, built from an image with the given
+           parameters and mask. Must be called before preprocessing, which may estimate
+           parameters."""
+        settings = [CACHE_VERSION, maxtree_name, n, gaussian_blur, levels, moments, connectivity,
+                    ct.sizeof(p.d_type), ct.sizeof(mt_class.bindings(p.d_type).MtNodeAttributes)]
+        settings += [getattr(p, name) for name in PREPROCESSING_PARAMETERS]
+
+        if mask is not None:
+            settings.append(image_hash(np.asarray(mask, dtype=bool)))
+
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(image_hash(img).encode())
+        digest.update(repr(settings).encode())
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """Return the memory mapped image and tree arrays stored for a key, and a dictionary of
+           the tree's root index and preprocessing parameters, or None if they are not cached.
+           The arrays are copy on write, so changes are not saved."""
+        path = self.path(key)
+
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+
+            image = np.load(os.path.join(path, 'image.npy'), mmap_mode='c')
+            arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+                      for name in meta['arrays']}
+
+        except (OSError, ValueError, KeyError):
+            self.count('misses')
+            return None
+
+        # Mark the entry as recently used
+        os.utime(path)
+        self.count('hits')
+
+        return image, arrays, meta
+
+    def store(self, key, image, mt, p):
+        """Save a preprocessed image and its flooded tree for a key, then remove the least
+           recently used entries if the cache is too large."""
+        path = self.path(key)
+        temporary_path = path + '.tmp' + str(os.getpid())
+
+        os.makedirs(temporary_path, exist_ok=True)
+
+        np.save(os.path.join(temporary_path, 'image.npy'), image)
+
+        arrays = mt.arrays()
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary_path, name + '.npy'), array)
+
+        meta = {'root': int(mt.root_index()), 'arrays': sorted(arrays)}
+        for name in PREPROCESSING_PARAMETERS:
+            value = getattr(p, name)
+            meta[name] = None if value is None else float(value)
+
+        with open(os.path.join(temporary_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        # Complete entries appear at once; another process may have stored the same entry
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """Return the time of last use, size in bytes and key of each cached entry, oldest first."""
+        entries = []
+
+        for key in os.listdir(self.directory):
+            path = self.path(key)
+
+            if '.' in key or not os.path.isdir(path):
+                continue
+
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, key))
+
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries, other than keep, until the cache is no larger
+           than max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+
+            if key == keep:
+                continue
+
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+
+            if self.verbosity > 1:
+                print("Removed cached tree", key)
+
+    def counts(self):
+        """Return the numbers of hits and misses recorded in the cache directory."""
+        counts = {'hits': 0, 'misses': 0}
+
+        try:
+            with open(os.path.join(self.directory, 'stats.json')) as stats_file:
+                counts.update(json.load(stats_file))
+        except (OSError, ValueError):
+            pass
+
+        return counts
+
+    def count(self, name):
+        """Add one to the number of hits or misses."""
+        counts = self.counts()
+        counts[name] += 1
+
+        with open(os.path.join(self.directory, 'stats.json'), 'w') as stats_file:
+            json.dump(counts, stats_file)
+
+    def stats(self):
+        """Return the numbers of hits and misses, entries and bytes used by the cache."""
+        stats = self.counts()
+
+        entries = self.entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(size for _, size, _ in entries)
+
+        return stats
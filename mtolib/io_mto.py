@@ -20,14 +20,16 @@ def get_file_extension(filename):
         return None
 
 
-def read_fits_file(filename):
+def read_fits_file(filename, return_header=False):
     """Open a .fits file.
-       Return the first data frame as a numpy array.
+       Return the first data frame as a numpy array, and the primary header if return_header is set.
+       Floating point data is memory mapped, so pixels are only read from disk when used.
     """
 
     # Open the file
     try:
-        hdulist = fits.open(filename)
+        hdulist = fits.open(filename, memmap=True)
+        header = hdulist[0].header
         img_data = None
         hdu_index = 0
 
@@ -42,10 +44,16 @@ def read_fits_file(filename):
                 hdulist.close()
                 sys.exit(1)
 
+        # The memory map stays open while the data is in use
         hdulist.close()
 
-        if img_data.dtype != np.double:
-            img_data = img_data.astype(np.float)
+        # Give integer data a float type which holds it exactly
+        # Floating point data keeps its precision and byte order, and is converted by preprocessing
+        if not np.issubdtype(img_data.dtype, np.floating):
+            img_data = img_data.astype(np.result_type(img_data.dtype, np.float32))
+
+        if return_header:
+            return img_data, header
 
         return img_data
 
@@ -94,11 +102,11 @@ def write_fits_file(data, header=None, filename='out.fits'):
 
 
 def generate_image(img, object_ids, p,
-                   levelled=False):
+                   levelled=False, index=None):
     """Save an image in .png or .fits format.
 
     The 'levelled' parameter generates an extra fits dataframe where objects are shown at their
-    detection level.
+    detection level. The objects may be given as an ObjectIndex of the object id map.
     """
 
     if p.verbosity:
@@ -109,19 +117,19 @@ def generate_image(img, object_ids, p,
     data = [object_ids.reshape(img.shape)]
 
     if levelled:
-        data.append(postprocessing.levelled_segments(img, object_ids))
+        data.append(postprocessing.levelled_segments(img, object_ids, index))
 
     if extension == "fits":
-        if p.filename is not None:
-            # Get original header
+        # Use the original header, if it was not read with the image
+        header = getattr(p, 'header', None)
+        if header is None and p.filename is not None:
             header = get_fits_header(p.filename)
-            # Write to file
-            write_fits_file(data, header=header, filename=p.out)
-        else:
-            write_fits_file(data, filename=p.out)
+
+        # Write to file
+        write_fits_file(data, header=header, filename=p.out)
 
     else:
-        output = postprocessing.colour_labels(object_ids)
+        output = postprocessing.colour_labels(object_ids, index)
 
         Image.fromarray(np.flipud(output)).save(p.out)
 
@@ -129,22 +137,42 @@ def generate_image(img, object_ids, p,
         print("Saved output to", p.out)
 
 
-def generate_parameters(img, object_ids, sig_ancs, p):
-    """Write detected object parameters into a csv file"""
+def generate_parameters(img, object_ids, sig_ancs, p, index=None):
+    """Write detected object parameters into a csv file. The objects may be given as an
+       ObjectIndex of the object id map."""
 
     if p.verbosity:
         print("\n---Calculating parameters---")
 
     object_ids = object_ids.ravel()
 
-    # Mask NANs for parameter calculations
-    img = np.ma.array(img, mask=np.isnan(img))
-
     # Open file and create a writer
     with open(p.par_out, 'w') as csvfile:
         param_writer = csv.writer(csvfile)
 
-        param_writer.writerows(postprocessing.get_image_parameters(img, object_ids, sig_ancs, p))
+        param_writer.writerows(postprocessing.get_image_parameters(img, object_ids, sig_ancs, p,
+                                                                    index=index))
+
+    if p.verbosity:
+        print("Saved parameters to", p.par_out)
+
+
+def generate_tree_parameters(mt, object_ids, p, index=None):
+    """Write detected object parameters, read from the moments of a max tree's nodes, into a csv
+       file. object_ids must be the id map found from the tree, before relabelling, and index
+       may be its ObjectIndex."""
+
+    if p.verbosity:
+        print("\n---Reading parameters from the max tree---")
+
+    parents, areas = mt.node_arrays()
+
+    with open(p.par_out, 'w') as csvfile:
+        param_writer = csv.writer(csvfile)
+
+        param_writer.writerow(postprocessing.tree_headings)
+        param_writer.writerows(postprocessing.get_tree_catalogue(mt.image, object_ids, parents, areas,
+                                                                 mt.node_moments(), index))
 
     if p.verbosity:
         print("Saved parameters to", p.par_out)
@@ -166,6 +194,24 @@ def make_parser():
     parser.add_argument('-move_factor', type=utils.validate_positive, help='Moves up the object marker', default=0.5)
     parser.add_argument('-min_distance', type=utils.validate_positive,
                          help='Minimum brightness distance between objects', default=0.0)
+    parser.add_argument('-tile_size', type=int, help='Process the image in tiles of this size', default=None)
+    parser.add_argument('-tile_overlap', type=int, help='Overlap between tiles', default=256)
+    parser.add_argument('-levels', type=int, help='Quantise the image to this many grey levels before '
+                                                  'building the max tree', default=None)
+    parser.add_argument('-mask', type=str, default=None,
+                        help='Fits file of the same shape as the image, nonzero where pixels are to be '
+                             'ignored. NaN pixels are always ignored')
+    parser.add_argument('-connectivity', type=int, choices=(4, 8, 12), default=4,
+                        help='Number of neighbours connected to each pixel in the max tree')
+    parser.add_argument('-tree_parameters', action='store_true',
+                        help='Read object parameters from moments computed while building the '
+                             'max tree, measured on the smoothed image, into columns named '
+                             'with _smoothed')
+    parser.add_argument('-double', action='store_true',
+                        help='Process single precision images in double precision')
+    parser.add_argument('-cache', type=str, default=None,
+                        help='Directory in which to cache preprocessed images and max trees')
+    parser.add_argument('-cache_size', type=float, help='Maximum size of the cache in GB', default=4)
     parser.add_argument('-verbosity', type=int, help='Verbosity level (0-2)', choices=range(0, 3), default=0)
 
     return parser
@@ -1,28 +1,54 @@
-"""High level processes for MTObjects."""
+"""High level processes for MTObjects.
+
+The state of a run is held by the parameters returned by setup and the objects made from them,
+so threads may process different images at once, each with its own parameters:
+
+    image, params = setup(['image.fits', '-out', 'image.png', '-par_out', 'image.csv'])
+    run(image, params)
+
+The C libraries run without the GIL. Resource use reported at verbosity 2 is for the whole
+process.
+"""
 # TODO rename?
 
+import sys
 import numpy as np
-from mtolib import _ctype_classes as ct
 from mtolib.preprocessing import preprocess_image
-from mtolib import maxtree
-from mtolib.tree_filtering import filter_tree, get_c_significant_nodes, init_double_filtering
-from mtolib.io_mto import generate_image, generate_parameters, read_fits_file, make_parser
+from mtolib import maxtree, tiling
+from mtolib.cache import TreeCache, PREPROCESSING_PARAMETERS
+from mtolib.tree_filtering import filter_tree, default_sig_test, up_tree
+from mtolib.io_mto import generate_image, generate_parameters, generate_tree_parameters, read_fits_file, \
+    make_parser
 from mtolib.utils import time_function
 from ctypes import c_float, c_double
-from mtolib.postprocessing import relabel_segments
+from mtolib.postprocessing import ObjectIndex, relabel_segments
 
 
-def setup():
-    """Read in a file and parameters; run initialisation functions."""
+def setup(args=None):
+    """Read in a file and parameters; run initialisation functions.
+       Arguments are taken from the command line unless a list is given."""
 
     # Parse command line arguments
-    p = make_parser().parse_args()
+    p = make_parser().parse_args(args)
 
     # Warn if using default soft bias
     if p.soft_bias is None:
         p.soft_bias = 0.0
 
-    img = read_fits_file(p.filename)
+    img, p.header = read_fits_file(p.filename, return_header=True)
+
+    if p.double and not np.issubdtype(img.dtype, np.float64):
+        img = img.astype(np.float64)
+
+    if p.mask:
+        # The mask file is replaced by the mask, which preprocessing and the max tree ignore
+        mask = read_fits_file(p.mask) != 0
+
+        if mask.shape != img.shape:
+            print("The mask must have the same shape as the image:", p.mask)
+            sys.exit(1)
+
+        p.mask = mask
 
     if p.verbosity:
         print("\n---Image dimensions---")
@@ -30,26 +56,153 @@ def setup():
         print("Width = ", img.shape[1])
         print("Size = ", img.size)
 
-    # Set the pixel type based on the type in the image
+    # Set the pixel type based on the type in the image, which selects the C libraries
     p.d_type = c_float
     if np.issubdtype(img.dtype, np.float64):
         p.d_type = c_double
-        init_double_filtering(p)
-
-    # Initialise CTypes classes
-    ct.init_classes(p.d_type)
 
     return img, p
 
 
-def max_tree_timed(img, params, maxtree_class):
-    """Build and return a maxtree of a given class"""
+def max_tree_timed(img, params, maxtree_class, levels=None, moments=False, connectivity=None,
+                   mask=None):
+    """Build and return a maxtree of a given class, or of the image quantised to a number of
+       levels if levels is given. If moments is set, the moments of each node are computed
+       while flooding. Pixels are connected to 4, 8 or 12 neighbours, as set by connectivity or
+       else the parameters. NaN pixels, and pixels where mask is true, are left out of the
+       tree."""
     if params.verbosity:
         print("\n---Building Maxtree---")
-    mt = maxtree_class(img, params.verbosity, params)
+
+    if levels:
+        mt = maxtree.QuantisedMaxTree(img, params.verbosity, params, levels)
+    else:
+        mt = maxtree_class(img, params.verbosity, params)
+
+    if connectivity:
+        mt.set_connectivity(connectivity)
+
+    if mask is not None:
+        mt.set_mask(mask)
+
+    if moments:
+        mt.enable_moments()
+
     mt.flood()
+
+    if params.verbosity > 1:
+        print(mt.num_nodes(), "nodes.")
+        print("Max tree: {:.1f} bytes per pixel.".format(mt.memory_usage() / mt.mt.img.size))
+
     return mt
 
 
-def build_max_tree(img, params, maxtree_class=maxtree.OriginalMaxTree):
-    return time_function(max_tree_timed, (img, params, maxtree_class), params.verbosity, 'create max tree')
+def build_max_tree(img, params, maxtree_class=maxtree.OriginalMaxTree, levels=None, moments=False,
+                   connectivity=None, mask=None):
+    return time_function(max_tree_timed, (img, params, maxtree_class, levels, moments, connectivity,
+                                          mask),
+                         params.verbosity, 'create max tree')
+
+
+def cached_max_tree(img, params, cache, maxtree_class=maxtree.OriginalMaxTree, levels=None,
+                    moments=False, n=2, connectivity=None, mask=None):
+    """Preprocess an image and build its maxtree as build_max_tree does, or load both from a
+       TreeCache if they were built before with the same parameters.
+       Return the preprocessed image and the tree."""
+    if levels:
+        maxtree_class = maxtree.QuantisedMaxTree
+
+    connectivity = connectivity or getattr(params, 'connectivity', 4)
+
+    key = time_function(cache.key, (img, params, maxtree_class.__name__, n, True, levels, moments,
+                                    connectivity, mask),
+                        params.verbosity, 'hash the image')
+    entry = cache.load(key)
+
+    if entry is None:
+        processed_image = preprocess_image(img, params, n=n, mask=mask)
+        mt = build_max_tree(processed_image, params, maxtree_class, levels, moments, connectivity,
+                            mask)
+
+        time_function(cache.store, (key, processed_image, mt, params), params.verbosity,
+                      'cache the max tree')
+    else:
+        processed_image, arrays, meta = entry
+
+        for name in PREPROCESSING_PARAMETERS:
+            setattr(params, name, meta[name])
+
+        if levels:
+            mt = maxtree.QuantisedMaxTree(processed_image, params.verbosity, params, levels)
+        else:
+            mt = maxtree_class(processed_image, params.verbosity, params)
+
+        mt.use_arrays(arrays, meta['root'])
+
+    if params.verbosity:
+        stats = cache.stats()
+        print("\n---Max Tree Cache---")
+        print("Cache", "hit" if entry is not None else "miss", "-", stats['hits'], "hits,",
+              stats['misses'], "misses,", stats['entries'], "trees,",
+              "{:.1f} MB".format(stats['bytes'] / 2 ** 20))
+
+    return processed_image, mt
+
+
+def run(image, params):
+    """Find objects in an image read by setup, and save the segmentation map and parameters.
+       Return the relabelled object id map."""
+    if params.tile_size:
+        # Pre-process the image
+        processed_image = preprocess_image(image, params, n=2, mask=params.mask)
+
+        # Build and filter max trees tile by tile
+        id_map, sig_ancs = filter_tree_tiled(processed_image, params, params.tile_size,
+                                             params.tile_overlap, mask=params.mask)
+    else:
+        if params.cache:
+            # Pre-process the image and build a max tree, or load both from the cache
+            cache = TreeCache(params.cache, params.cache_size * 2**30, params.verbosity)
+            processed_image, mt = cached_max_tree(image, params, cache, levels=params.levels,
+                                                  moments=params.tree_parameters,
+                                                  mask=params.mask)
+        else:
+            # Pre-process the image
+            processed_image = preprocess_image(image, params, n=2, mask=params.mask)
+
+            # Build a max tree
+            mt = build_max_tree(processed_image, params, levels=params.levels,
+                                moments=params.tree_parameters, mask=params.mask)
+
+        # Filter the tree and find objects
+        id_map, sig_ancs = filter_tree(mt, processed_image, params)
+
+    # Group the pixels of each object once, for relabelling and every output
+    index = time_function(ObjectIndex, (id_map,), params.verbosity, 'index the objects')
+
+    if params.tree_parameters and not params.tile_size:
+        # Read object parameters from the tree, using the object ids before relabelling
+        generate_tree_parameters(mt, id_map, params, index)
+
+    # Relabel objects for clearer visualisation
+    id_map = relabel_segments(id_map, shuffle_labels=False, index=index)
+    index = index.relabelled(id_map)
+
+    # Generate output files
+    generate_image(image, id_map, params, index=index)
+
+    if params.tile_size or not params.tree_parameters:
+        generate_parameters(image, id_map, sig_ancs, params, index=index)
+
+    return id_map
+
+
+def filter_tree_tiled(img, params, tile_size=4096, overlap=256,
+                      maxtree_class=maxtree.OriginalMaxTree, mask=None):
+    """Build and filter max trees over overlapping tiles, and return a merged id map.
+       Pixels where mask is true are left out of the trees."""
+    if params.verbosity:
+        print("\n---Finding Objects in Tiles---")
+    return time_function(tiling.filter_tiles, (img, params, tile_size, overlap, maxtree_class,
+                                               default_sig_test, up_tree, mask),
+                         params.verbosity, 'find objects in tiles')
@@ -1,10 +1,57 @@
 """Build a maxtree from a numpy array."""
 
 import ctypes as ct
-import numpy.ctypeslib as npct
+import os
 import numpy as np
 
 from mtolib import _ctype_classes as mt_class
+from mtolib.preprocessing import quantise_image
+
+# Largest number of pixels in an image supported by the C max tree
+MAX_IMAGE_SIZE = 2 ** 31 - 1
+
+# Numbers of neighbours which may be connected to each pixel
+CONNECTIVITIES = (4, 8, 12)
+
+# Offsets (y, x) of the neighbours of each connectivity, as in the tables in maxtree.c
+NEIGHBOUR_OFFSETS = {4: ((-1, 0), (0, -1), (0, 1), (1, 0)),
+                     8: ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))}
+NEIGHBOUR_OFFSETS[12] = NEIGHBOUR_OFFSETS[8] + ((-2, 0), (0, -2), (0, 2), (2, 0))
+
+# Parent of masked pixels, which are not in the tree
+MASKED = -4
+
+
+def c_array(owner, pointer, count, c_type):
+    """Return a numpy array of count elements of a ctypes type at a pointer, sharing its memory.
+       The array keeps owner alive, so that memory released by deleting the owner stays valid
+       while the array is in use."""
+    dtype = np.dtype(c_type)
+
+    if not pointer or count == 0:
+        return np.zeros(0, dtype)
+
+    buffer = (ct.c_char * (count * dtype.itemsize)).from_address(ct.cast(pointer, ct.c_void_p).value)
+    buffer.owner = owner
+
+    return np.frombuffer(buffer, dtype)
+
+
+class TreeMemory:
+    """The memory of a C maxtree, and the image it was built from, which are released when this
+       object is deleted. Arrays given to the tree by use_arrays are kept, and not freed by C."""
+    def __init__(self, mt_lib, mt, image_data):
+        self.mt_lib = mt_lib
+        self.mt = mt
+        self.image_data = image_data
+        self.arrays = {}
+
+    def __del__(self):
+        for name in self.arrays:
+            setattr(self.mt, name, None)
+
+        self.mt_lib.mt_free.argtypes = [ct.POINTER(type(self.mt))]
+        self.mt_lib.mt_free(ct.byref(self.mt))
 
 
 class MaxTree:
@@ -28,11 +75,12 @@ class MaxTree:
     def ctypes_maxtree(self, params):
         # Create image object
         img_pointer = self.image.ravel().ctypes.data_as(ct.POINTER(params.d_type))
+        bindings = mt_class.bindings(params.d_type)
 
-        return mt_class.MtData(root=self.root,
+        return bindings.MtData(root=self.root,
                                nodes=self.nodes,
                                node_attributes=self.node_attributes,
-                               img=mt_class.Image(img_pointer, *self.image.shape, self.image.size),
+                               img=bindings.Image(img_pointer, *self.image.shape, self.image.size),
                                verbosity_level = self.verbosity)
 
 
@@ -42,52 +90,282 @@ class OriginalMaxTree(MaxTree):
 
         MaxTree.__init__(self, image, verbosity)
 
-        # Get access to the compiled C maxtree library
-        if params.d_type == ct.c_double:
-            self.mt_lib = ct.CDLL('mtolib/lib/maxtree_double.so')
-        else:
-            self.mt_lib = ct.CDLL('mtolib/lib/maxtree.so')
+        # Pixel indices are stored as int32 in C
+        if image.size > MAX_IMAGE_SIZE:
+            raise ValueError("Images must have at most " + str(MAX_IMAGE_SIZE) +
+                             " pixels - use tiled processing for larger images")
 
+        # Get the classes and compiled C maxtree library for the pixel type
+        self.bindings = mt_class.bindings(params.d_type)
+        self.mt_lib = self.bindings.maxtree_lib
 
-        # Create image object
-        img_pointer = image.ravel().ctypes.data_as(ct.POINTER(params.d_type))
+        # Create image object, keeping the pixel data for the lifetime of the tree
+        image_data = image.ravel()
+        img_pointer = image_data.ctypes.data_as(ct.POINTER(params.d_type))
 
-        c_img = mt_class.Image(img_pointer, image.shape[0], image.shape[1], image.size)
+        c_img = self.bindings.Image(img_pointer, image.shape[0], image.shape[1], image.size)
 
         # Create empty mt object
-        self.mt = mt_class.MtData()
+        self.mt = self.bindings.MtData()
 
         # Set argument types for init function; Initialise max tree.
-        self.mt_lib.mt_init.argtypes = (ct.POINTER(mt_class.MtData), ct.POINTER(mt_class.Image))
+        self.mt_lib.mt_init.argtypes = (ct.POINTER(self.bindings.MtData),
+                                        ct.POINTER(self.bindings.Image))
 
         self.mt_lib.mt_init(ct.byref(self.mt), ct.byref(c_img))
+        self.memory = TreeMemory(self.mt_lib, self.mt, image_data)
+        self.object_data = None
 
         # Set verbosity
-        self.mt_lib.mt_set_verbosity_level.argtypes = (ct.POINTER(mt_class.MtData),
+        self.mt_lib.mt_set_verbosity_level.argtypes = (ct.POINTER(self.bindings.MtData),
                                                   ct.c_int)
         self.mt_lib.mt_set_verbosity_level(ct.byref(self.mt), verbosity)
 
+        self.set_connectivity(getattr(params, 'connectivity', 4))
+
+        # NaN pixels are left out of the tree
+        nan_mask = np.isnan(image)
+        if nan_mask.any():
+            self.set_mask(nan_mask)
+
+    def set_mask(self, mask):
+        """Leave the pixels where mask is true out of the tree, in addition to any masked before.
+           Must be called before flooding."""
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+
+        if mask.shape != self.image.shape:
+            raise ValueError("The mask must have the same shape as the image")
+
+        self.mt_lib.mt_set_mask.argtypes = [ct.POINTER(self.bindings.MtData),
+                                            ct.POINTER(ct.c_uint8)]
+        self.mt_lib.mt_set_mask(ct.byref(self.mt), mask.ctypes.data_as(ct.POINTER(ct.c_uint8)))
+
+        if np.all(self.parent == MASKED):
+            raise ValueError("Every pixel of the image is masked")
+
+    def set_connectivity(self, connectivity):
+        """Connect each pixel to 4, 8 or 12 neighbours when flooding."""
+        if connectivity not in CONNECTIVITIES:
+            raise ValueError("Connectivity must be one of " + str(CONNECTIVITIES))
+
+        self.mt_lib.mt_set_connectivity.argtypes = [ct.POINTER(self.bindings.MtData), ct.c_int]
+        self.mt_lib.mt_set_connectivity(ct.byref(self.mt), connectivity)
+        self.connectivity = connectivity
+
     def flood(self):
         # Call the C function to flood the maxtree
 
         # C flood function takes a pointer to an MtData (mt_data in C) object
-        self.mt_lib.mt_flood.argtypes = [ct.POINTER(mt_class.MtData)]
+        self.mt_lib.mt_flood.argtypes = [ct.POINTER(self.bindings.MtData)]
         self.mt_lib.mt_flood(ct.byref(self.mt))
 
-        # Get a 2D numpy array of the MtNode data
-        # nodes = npct.as_array(ct.cast(self.mt.nodes, ct.POINTER(ct.c_int32)), (self.mt.img.size, 2))
-
-        # node_attributes = npct.as_array(ct.cast(self.mt.node_attributes, ct.POINTER(ct.c_double)),
-        #                                (self.mt.img.size, 2))
-
         self.root = self.mt.root
         self.nodes = self.mt.nodes
         self.node_attributes = self.mt.node_attributes
 
     def free_objects(self):
-        # Free the memory used by the max tree
-        self.mt_lib.mt_free.argtypes = [ct.POINTER(mt_class.MtData)]
-        self.mt_lib.mt_free(ct.byref(self.mt))
+        # Free the memory used by the max tree, once no numpy views of it remain
+        self.memory = None
+        self.object_data = None
 
     def ctypes_maxtree(self):
         return self.mt
+
+    def enable_moments(self):
+        """Compute the moments of each node's component while flooding."""
+        self.mt_lib.mt_alloc_moments.argtypes = [ct.POINTER(self.bindings.MtData)]
+        self.mt_lib.mt_alloc_moments(ct.byref(self.mt))
+
+    def root_index(self):
+        """Return the pixel index of the flooded tree's root."""
+        offset = ct.addressof(self.mt.root.contents) - ct.addressof(self.mt.nodes.contents)
+
+        return offset // ct.sizeof(self.bindings.MtNode)
+
+    def arrays(self):
+        """Return the flooded tree's C arrays as numpy views by field name, which can be saved and
+           given to use_arrays."""
+        arrays = {'nodes': self.view(self.mt.nodes, self.bindings.MtNode),
+                  'node_attributes': self.view(self.mt.node_attributes,
+                                               self.bindings.MtNodeAttributes)}
+
+        if self.mt.nodes_moments:
+            arrays['nodes_moments'] = self.view(self.mt.nodes_moments, self.bindings.MtNodeMoments)
+
+        return arrays
+
+    def use_arrays(self, arrays, root_index):
+        """Use the arrays of a tree of the same image, as returned by arrays, in place of flooding.
+           The arrays are used without copying, and kept for the lifetime of the tree's memory."""
+        size = self.mt.img.size
+
+        for name, c_type in (('nodes', self.bindings.MtNode),
+                             ('node_attributes', self.bindings.MtNodeAttributes),
+                             ('nodes_moments', self.bindings.MtNodeMoments)):
+            if name in arrays and (arrays[name].dtype != np.dtype(c_type) or
+                                   arrays[name].size != size):
+                raise ValueError("Array " + name + " does not match this tree")
+
+        self.mt_lib.mt_use_arrays.argtypes = [ct.POINTER(self.bindings.MtData), ct.c_void_p,
+                                              ct.c_void_p, ct.c_int32]
+        self.mt_lib.mt_use_arrays(ct.byref(self.mt), arrays['nodes'].ctypes.data,
+                                  arrays['node_attributes'].ctypes.data, root_index)
+
+        if 'nodes_moments' in arrays:
+            self.mt.nodes_moments = arrays['nodes_moments'].ctypes.data_as(
+                ct.POINTER(self.bindings.MtNodeMoments))
+
+        self.memory.arrays = arrays
+
+        self.root = self.mt.root
+        self.nodes = self.mt.nodes
+        self.node_attributes = self.mt.node_attributes
+
+    def view(self, pointer, c_type):
+        """Return a numpy array of one element per pixel at a pointer into the tree's memory.
+           The array shares the memory, which is kept until the tree is freed and no arrays
+           from it remain."""
+        if self.memory is None:
+            raise ValueError("The max tree has been freed")
+
+        return c_array(self.memory, pointer, self.mt.img.size, c_type)
+
+    @property
+    def parent(self):
+        """The parent of each pixel's node, or a negative value for the root and MASKED for
+           masked pixels."""
+        return self.view(self.mt.nodes, self.bindings.MtNode)['parent']
+
+    @property
+    def area(self):
+        """The area of each pixel's node."""
+        return self.view(self.mt.nodes, self.bindings.MtNode)['area']
+
+    @property
+    def volume(self):
+        """The volume of each pixel's node, relative to its parent's level."""
+        return self.view(self.mt.node_attributes, self.bindings.MtNodeAttributes)['volume']
+
+    @property
+    def power(self):
+        """The power of each pixel's node, relative to its parent's level."""
+        return self.view(self.mt.node_attributes, self.bindings.MtNodeAttributes)['power']
+
+    def node_arrays(self):
+        """Return the parents and areas of the flooded tree's nodes as numpy arrays."""
+        return self.parent, self.area
+
+    def node_moments(self):
+        """Return the moments of the flooded tree's nodes as a numpy record array,
+           or None if they were not computed."""
+        if not self.mt.nodes_moments:
+            return None
+
+        return self.view(self.mt.nodes_moments, self.bindings.MtNodeMoments)
+
+    def objects(self):
+        """Return the arrays kept from filtering the tree with keep_object_data."""
+        if self.object_data is None:
+            raise ValueError("No object data - filter the tree with keep_object_data=True")
+
+        return self.object_data
+
+    @property
+    def flags(self):
+        """The flags set for each pixel's node by object detection."""
+        return self.objects().flags
+
+    @property
+    def closest_significant_ancestors(self):
+        """The closest significant ancestor of each pixel's node, or -3 if there is none."""
+        return self.objects().closest_significant_ancestors
+
+    @property
+    def main_branches(self):
+        """The main branch of each relevant node and then the root, in the order of
+           objects().branch_nodes."""
+        return self.objects().main_branches
+
+    def memory_usage(self):
+        """Return the number of bytes held by the flooded tree's C arrays."""
+        size = self.mt.img.size
+
+        total = size * (ct.sizeof(self.bindings.MtNode) + ct.sizeof(self.bindings.MtNodeAttributes))
+
+        if self.mt.nodes_moments:
+            total += size * ct.sizeof(self.bindings.MtNodeMoments)
+
+        return total
+
+    def num_nodes(self):
+        """Count the nodes of the flooded tree, one per level root. Masked pixels have no node."""
+        parents, _ = self.node_arrays()
+        values = self.image.ravel()
+
+        level_roots = (parents < 0) | (values[np.maximum(parents, 0)] != values)
+
+        return int(np.count_nonzero(level_roots & (parents != MASKED)))
+
+
+class ParallelMaxTree(OriginalMaxTree):
+    """A maxtree built by flooding horizontal strips concurrently and merging them.
+       Gives the same parents and areas as OriginalMaxTree, with each flat zone represented by
+       its first pixel. Volumes, powers and moments are summed in another order, so may differ
+       by rounding.
+    """
+    def __init__(self, image, verbosity, params, num_threads=None):
+        OriginalMaxTree.__init__(self, image, verbosity, params)
+
+        # Use the thread count from the parameters, or one thread per core
+        if num_threads is None:
+            num_threads = getattr(params, 'num_threads', None) or os.cpu_count()
+
+        self.num_threads = num_threads
+
+    def flood(self):
+        # Call the C function to flood the maxtree in parallel
+        self.mt_lib.mt_flood_parallel.argtypes = [ct.POINTER(self.bindings.MtData), ct.c_int]
+        self.mt_lib.mt_flood_parallel(ct.byref(self.mt), self.num_threads)
+
+        self.root = self.mt.root
+        self.nodes = self.mt.nodes
+        self.node_attributes = self.mt.node_attributes
+
+
+class UnionFindMaxTree(OriginalMaxTree):
+    """A maxtree built by sorting the pixels with a radix sort and merging them with union-find.
+       Gives the same parents and areas as OriginalMaxTree, with each flat zone represented by
+       its first pixel. Volumes, powers and moments are summed in another order, so may differ
+       by rounding.
+    """
+    def flood(self):
+        # Call the C function to flood the maxtree by union-find
+        self.mt_lib.mt_flood_union_find.argtypes = [ct.POINTER(self.bindings.MtData)]
+        self.mt_lib.mt_flood_union_find(ct.byref(self.mt))
+
+        self.root = self.mt.root
+        self.nodes = self.mt.nodes
+        self.node_attributes = self.mt.node_attributes
+
+
+class QuantisedMaxTree(OriginalMaxTree):
+    """A maxtree of an image quantised to a fixed number of levels, built by flooding with a
+       bucket queue in place of the heap.
+       The tree is built from, and holds, the quantised image rather than the input image.
+    """
+    def __init__(self, image, verbosity, params, levels=65536):
+        quantised, self.base, self.step = quantise_image(image, levels)
+        self.levels = levels
+        self.d_type = params.d_type
+
+        OriginalMaxTree.__init__(self, quantised, verbosity, params)
+
+    def flood(self):
+        # Call the C function to flood the maxtree with a bucket queue
+        self.mt_lib.mt_flood_levels.argtypes = [ct.POINTER(self.bindings.MtData), ct.c_int32,
+                                                self.d_type, self.d_type]
+        self.mt_lib.mt_flood_levels(ct.byref(self.mt), self.levels, self.base, self.step)
+
+        self.root = self.mt.root
+        self.nodes = self.mt.nodes
+        self.node_attributes = self.mt.node_attributes
@@ -1,111 +1,364 @@
 """Functions to generate statistics and labels from object maps"""
 
+import copy
+import ctypes as ct
 import numpy as np
-import warnings
 from skimage.color import label2rgb
+from skimage.color.colorlabel import DEFAULT_COLORS
 
+from mtolib import _ctype_classes as mt_class
 
-def colour_labels(label_map):
-    """Apply a colour to each object in the image non-sequentially and convert to 8-bit int RGB format"""
-    return np.uint8(label2rgb(label_map)*255)
 
+# Largest label and number of pixels which the C counting sort can index
+MAX_C_INDEX = 2 ** 31 - 3
 
-def relabel_segments(label_map, shuffle_labels=False):
-    """Relabel segments with sequential numbers"""
 
-    original_shape = label_map.shape
+class ObjectIndex:
+    """The pixels of each object in a label map, grouped by object in order of label.
+       Object n has label labels[n], and the flat indices of its pixels are
+       pixels[offsets[n]:offsets[n + 1]], in increasing order. Pixels with negative labels belong
+       to no object. Built once with a counting sort, and shared by the functions which visit the
+       pixels of each object.
+    """
+    def __init__(self, label_map):
+        self.shape = label_map.shape
 
-    label_map = label_map.ravel()
-    output = np.zeros(label_map.shape, dtype=label_map.dtype) -1
+        ids = label_map.ravel()
+        num_labels = max(int(ids.max()) + 1, 0) if ids.size else 0
+
+        if num_labels <= MAX_C_INDEX and ids.size <= MAX_C_INDEX:
+            ids = np.ascontiguousarray(ids, dtype=np.int32)
+
+            offsets = np.empty(num_labels + 2, dtype=np.int32)
+            pixels = np.empty(np.count_nonzero(ids >= 0), dtype=np.int32)
+
+            objects_lib = mt_class.bindings(ct.c_float).objects_lib
+            objects_lib.mt_object_index.argtypes = [ct.POINTER(ct.c_int32), ct.c_int32, ct.c_int32,
+                                                    ct.POINTER(ct.c_int32), ct.POINTER(ct.c_int32)]
+            objects_lib.mt_object_index(ids.ctypes.data_as(ct.POINTER(ct.c_int32)), ids.size,
+                                        num_labels, offsets.ctypes.data_as(ct.POINTER(ct.c_int32)),
+                                        pixels.ctypes.data_as(ct.POINTER(ct.c_int32)))
+
+            # Keep only the labels in use
+            labels = np.flatnonzero(offsets[1:-1] != offsets[:-2])
+            offsets = np.append(offsets[labels], offsets[-1])
+        else:
+            # Labels too large for the C index are sorted by numpy
+            pixels = np.argsort(ids, kind='stable')
+            pixels = pixels[pixels.size - np.count_nonzero(ids >= 0):]
+
+            sorted_ids = ids[pixels]
+            starts = np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1
+
+            labels = sorted_ids[np.append(0, starts)] if pixels.size else sorted_ids
+            offsets = np.concatenate(([0], starts, [pixels.size]))
+
+        self.labels = labels.astype(label_map.dtype)
+        self.offsets = offsets.astype(np.intp)
+        self.pixels = pixels
+
+    def __len__(self):
+        return self.labels.size
+
+    @property
+    def counts(self):
+        """The number of pixels of each object."""
+        return np.diff(self.offsets)
+
+    def object_pixels(self, n):
+        """Return the flat indices of object n's pixels."""
+        return self.pixels[self.offsets[n]:self.offsets[n + 1]]
+
+    def relabelled(self, label_map):
+        """Return the index of a label map with the same objects as this one under other labels,
+           such as one from relabel_segments, without sorting the pixels again."""
+        labels = label_map.ravel()[self.pixels[self.offsets[:-1]]]
+
+        index = copy.copy(self)
+        index.labels = labels
+
+        # Regroup the pixels in order of the new labels if it differs
+        if np.any(labels[1:] < labels[:-1]):
+            order = np.argsort(labels)
+            counts = self.counts[order]
+
+            index.labels = labels[order]
+            index.offsets = np.concatenate(([0], np.cumsum(counts)))
+            index.pixels = self.pixels[np.repeat(self.offsets[order] - index.offsets[:-1], counts) +
+                                       np.arange(self.pixels.size)]
+
+        return index
+
+
+def colour_labels(label_map, index=None):
+    """Apply a colour to each object in the image non-sequentially and convert to 8-bit int RGB format.
+       Gives the colours of skimage's label2rgb, without sorting the pixels if the objects are
+       given as an ObjectIndex of the label map."""
+    if index is None:
+        index = ObjectIndex(label_map)
+
+    # The colours label2rgb cycles through in order of label, after black for label 0
+    cycle = np.uint8(label2rgb(np.arange(1, len(DEFAULT_COLORS) + 1)[np.newaxis])[0] * 255)
+
+    # label2rgb ranks the labels, including those of pixels in no object, from 1
+    has_background = index.pixels.size < label_map.size
+    ranks = np.arange(len(index)) + has_background + 1
+
+    if len(index) and index.labels[0] == 0:
+        ranks -= 1
+        ranks[0] = 0
+
+    colours = np.where((ranks == 0)[:, np.newaxis], 0, cycle[(ranks - 1) % len(cycle)])
+
+    output = np.empty((label_map.size, 3), dtype=np.uint8)
+    output[:] = cycle[0]
+    output[index.pixels] = np.repeat(colours.astype(np.uint8), index.counts, axis=0)
+
+    return output.reshape(label_map.shape + (3,))
+
+
+def relabel_segments(label_map, shuffle_labels=False, index=None):
+    """Relabel segments with sequential numbers, in order of label. The objects may be given as an
+       ObjectIndex of the label map, which avoids sorting it."""
+    if index is None:
+        # Look up each pixel's new label by its rank among the labels
+        ids, ranks = np.unique(label_map, return_inverse=True)
+        num_objects = np.count_nonzero(ids >= 0)
+    else:
+        num_objects = len(index)
+
+    # Generate labels, starting from 1
+    label_list = np.arange(1, 1 + num_objects, dtype=label_map.dtype)
 
-    # Sort the object ID map for faster pixel retrieval
-    sorted_ids = label_map.argsort()
-    id_set = list(set(label_map))
-    id_set.sort()
-    
-    id_set.remove(-1)
-    
-    # Get the locations in sorted_ids of the matching pixels
-    right_indices = np.searchsorted(label_map, id_set, side='right', sorter=sorted_ids)
-    left_indices = np.searchsorted(label_map, id_set, side='left', sorter=sorted_ids)
-    
-    # Generate a list of labels, starting from 1
-    label_list = list(range(1, 1 + len(id_set)))
-    
     # Shuffle order in which labels are allocated
     if shuffle_labels:
         np.random.shuffle(label_list)
-        
-    # Relabel pixels
-    for n in range(len(id_set)):
-        pixel_indices = np.unravel_index(sorted_ids[left_indices[n]:right_indices[n]], label_map.shape)
-
-        output[pixel_indices] = label_list[n]
 
-    return output.reshape(original_shape)
+    if index is None:
+        lookup = np.concatenate((np.full(ids.size - num_objects, -1, dtype=label_map.dtype),
+                                 label_list))
+        return lookup[ranks].reshape(label_map.shape)
 
+    output = np.full(label_map.size, -1, dtype=label_map.dtype)
+    output[index.pixels] = np.repeat(label_list, index.counts)
 
-def levelled_segments(img, label_map):
-    """Replace object ids with the value at which the object was detected"""
-    output = np.zeros(img.shape)
+    return output.reshape(label_map.shape)
 
-    label_map = label_map.ravel()
 
-    # Sort the object ID map for faster pixel retrieval
-    sorted_ids = label_map.argsort()
-    id_set = list(set(label_map))
+def levelled_segments(img, label_map, index=None):
+    """Replace object ids with the value at which the object was detected. The objects may be
+       given as an ObjectIndex of the label map."""
+    if index is None:
+        index = ObjectIndex(label_map)
 
-    id_set.remove(-1)
+    output = np.zeros(img.size)
 
-    # Get the locations in sorted_ids of the matching pixels
-    right_indices = np.searchsorted(label_map, id_set, side='right', sorter=sorted_ids)
-    left_indices = np.searchsorted(label_map, id_set, side='left', sorter=sorted_ids)
+    if len(index):
+        # Minimum of each object's pixels, which the index keeps together
+        minima = np.minimum.reduceat(img.ravel()[index.pixels], index.offsets[:-1])
+        output[index.pixels] = np.repeat(minima, index.counts)
 
-    for n in range(len(id_set)):
-        pixel_indices = np.unravel_index(sorted_ids[left_indices[n]:right_indices[n]], img.shape)
+    return output.reshape(img.shape)
 
-        pixel_values = img[pixel_indices]
 
-        min_value = np.min(pixel_values)
+headings = ['ID', 'X', 'Y', 'A', 'B', 'theta',  # 'kurtosis',
+            'total_flux', 'mu_max', 'mu_median', 'mu_mean', 'R_fwhm', 'R_e', 'R10', 'R90']
 
-        output[pixel_indices] = min_value
 
-    return output
+def get_image_parameters(img, object_ids, sig_ancs, params, vectorised=True, index=None):
+    """Calculate the parameters for all objects in an image. The objects may be given as an
+       ObjectIndex of the object id map."""
 
+    if index is None:
+        index = ObjectIndex(object_ids)
 
-def get_image_parameters(img, object_ids, sig_ancs, params,):
-    """Calculate the parameters for all objects in an image"""
-
-    # Treat warnings as exceptions
-    warnings.filterwarnings('error', category=RuntimeWarning, append=True)
+    if vectorised:
+        return [headings] + get_catalogue(img, object_ids, index)
 
     parameters = []
-    headings = ['ID', 'X', 'Y', 'A', 'B', 'theta',  # 'kurtosis',
-                           'total_flux', 'mu_max', 'mu_median', 'mu_mean', 'R_fwhm', 'R_e', 'R10', 'R90']
 
     parameters.append(headings)
 
-    # Sort the object ID map for faster pixel retrieval
-    sorted_ids = object_ids.argsort()
-    id_set = list(set(object_ids))
+    # For each object in the list, get the pixels, calculate parameters, and write to file
+    for n in range(len(index)):
 
-    if -1 in id_set:
-        id_set.remove(-1)
+        pixel_indices = np.unravel_index(index.object_pixels(n), img.shape)
+        parameters.append(get_object_parameters(img, index.labels[n], pixel_indices))
 
-    # Get the locations in sorted_ids of the matching pixels
-    right_indices = np.searchsorted(object_ids, id_set, side='right', sorter=sorted_ids)
-    left_indices = np.searchsorted(object_ids, id_set, side='left', sorter=sorted_ids)
+    return parameters
 
-    # For each object in the list, get the pixels, calculate parameters, and write to file
-    for n in range(len(id_set)):
 
-        pixel_indices = np.unravel_index(sorted_ids[left_indices[n]:right_indices[n]], img.shape)
-        parameters.append(get_object_parameters(img, id_set[n], pixel_indices))
+def get_catalogue(img, object_ids, index=None):
+    """Calculate the parameters for all objects in an image at once.
+       Gives the same columns as get_object_parameters, with one row per object in order of id.
+       The objects may be given as an ObjectIndex of the object id map.
+    """
+    if index is None:
+        index = ObjectIndex(object_ids)
 
-    # Return to printing warnings
-    warnings.resetwarnings()
+    # Pixels grouped by object, in order of id
+    pixels = index.pixels
 
-    return parameters
+    if pixels.size == 0:
+        return []
+
+    # Number objects from 0 in order of id
+    object_labels = index.labels
+    num_objects = len(index)
+
+    counts = index.counts
+    starts = index.offsets[:-1]
+    ends = index.offsets[1:]
+    labels = np.repeat(np.arange(num_objects), counts)
+
+    values = np.nan_to_num(img.ravel()[pixels]).astype(np.float64)
+    y, x = np.divmod(pixels, img.shape[1])
+
+    # Sort pixels by object, then by value
+    order = np.lexsort((values, labels))
+
+    # Subtract min values if required
+    values -= np.maximum(values[order[starts]], 0)[labels]
+
+    flux_sum = np.bincount(labels, values, num_objects)
+
+    # Handle objects where flux_sum is 0 because of minimum subtraction
+    # As in get_object_parameters, zero pixels take the smallest double in the image's type
+    no_flux = flux_sum == 0
+    almost_zero = np.nextafter(0.0, 1)
+    values[no_flux[labels] & (values == 0)] = img.dtype.type(almost_zero)
+
+    means = np.bincount(labels, values, num_objects) / counts
+    flux_sum[no_flux] = almost_zero
+
+    sorted_values = values[order]
+
+    # First and second order moments
+    x_mean = np.bincount(labels, x * values, num_objects) / flux_sum
+    y_mean = np.bincount(labels, y * values, num_objects) / flux_sum
+
+    x2 = np.bincount(labels, x * x * values, num_objects) / flux_sum - x_mean ** 2
+    y2 = np.bincount(labels, y * y * values, num_objects) / flux_sum - y_mean ** 2
+    xy = np.bincount(labels, x * y * values, num_objects) / flux_sum - x_mean * y_mean
+
+    major_axis, minor_axis, theta = get_shape_parameters(x2, y2, xy)
+
+    # Basic statistics
+    max_values = sorted_values[ends - 1]
+    medians = (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+    # Half maximum radius, from the number of pixels of at least half the maximum value
+    bright = values >= 0.5 * max_values[labels]
+    half_max_radii = find_radius(np.bincount(labels[bright], minlength=num_objects))
+
+    # Cumulative sums of each object's pixels in order of decreasing value
+    descending = sorted_values[::-1]
+    descending_labels = labels[order][::-1]
+    descending_counts = counts[::-1]
+
+    summed_pixels = np.cumsum(descending)
+    segment_starts = np.cumsum(descending_counts) - descending_counts
+    previous_sums = np.where(segment_starts > 0, summed_pixels[segment_starts - 1], 0)
+    summed_pixels -= np.repeat(previous_sums, descending_counts)
+
+    # Find the number of pixels needed to reach n% of each object's flux
+    radii = []
+    for fraction in (0.5, 0.1, 0.9):
+        below = summed_pixels < fraction * flux_sum[descending_labels]
+        radii.append(find_radius(np.bincount(descending_labels[below], minlength=num_objects)))
+
+    columns = [x_mean, y_mean, major_axis, minor_axis, theta, flux_sum, max_values, medians, means,
+               half_max_radii, *radii]
+
+    return [[object_id, *row] for object_id, row in zip(object_labels.tolist(),
+                                                        np.column_stack(columns).tolist())]
+
+
+# Columns measured on the preprocessed image are named apart from those of get_catalogue, which
+# are measured on the input image
+tree_headings = ['ID', 'X_smoothed', 'Y_smoothed', 'A_smoothed', 'B_smoothed', 'theta_smoothed',
+                 'total_flux_smoothed', 'mu_mean_smoothed', 'x_min', 'y_min', 'x_max', 'y_max']
+
+
+def get_tree_catalogue(img, object_ids, parents, areas, moments, index=None):
+    """Calculate object parameters from the moments of a max tree's nodes, without visiting pixels.
+       img is the image the tree was built from, and object_ids the object id map found from the
+       tree, before relabelling. Gives the moment-based columns of get_catalogue for that image,
+       which is background subtracted and smoothed, so they differ from get_catalogue's for the
+       input image, and the bounding box of each object's branch, including any objects nested
+       in it. The columns are named in tree_headings.
+       Objects are labelled from 1 in order of id, as by relabel_segments. The objects may be
+       given as an ObjectIndex of the object id map.
+    """
+    ids = object_ids.ravel()
+    nodes = np.unique(ids[ids != -1]) if index is None else index.labels
+
+    if nodes.size == 0:
+        return []
+
+    node_moments = moments[nodes]
+
+    # An object's pixels are its node's component, less the components of the nearest objects
+    # nested inside it, which are the objects found at their nodes' parents
+    node_parents = parents[nodes]
+    outer_objects = np.where(node_parents >= 0, ids[np.maximum(node_parents, 0)], -1)
+    nested = outer_objects != -1
+    outer_labels = np.searchsorted(nodes, outer_objects[nested])
+
+    def object_sums(node_sums):
+        sums = node_sums.astype(np.float64)
+        np.subtract.at(sums, outer_labels, sums[nested])
+        return sums
+
+    counts = object_sums(areas[nodes])
+    flux_sum = object_sums(node_moments['flux'])
+    sums = object_sums(node_moments['sums'])
+    weighted_sums = object_sums(node_moments['weighted_sums'])
+
+    # Subtract min values if required - the minimum of an object is its node's level
+    levels = np.maximum(img.ravel()[nodes].astype(np.float64), 0)
+    flux_sum -= levels * counts
+    weighted_sums -= levels[:, np.newaxis] * sums
+
+    # Objects without flux after minimum subtraction are weighted evenly, as in get_catalogue
+    no_flux = flux_sum <= 1e-9 * levels * counts
+    total_flux = np.where(no_flux, 0, flux_sum)
+    flux_sum[no_flux] = counts[no_flux]
+    weighted_sums[no_flux] = sums[no_flux]
+
+    # First and second order moments
+    x_mean, y_mean, x2, y2, xy = (weighted_sums / flux_sum[:, np.newaxis]).T
+    x2 -= x_mean ** 2
+    y2 -= y_mean ** 2
+    xy -= x_mean * y_mean
+
+    major_axis, minor_axis, theta = get_shape_parameters(x2, y2, xy)
+
+    columns = [x_mean, y_mean, major_axis, minor_axis, theta, total_flux, total_flux / counts]
+    boxes = np.column_stack([node_moments[b] for b in ('x_min', 'y_min', 'x_max', 'y_max')])
+
+    return [[label, *row, *box] for label, row, box in zip(range(1, nodes.size + 1),
+                                                          np.column_stack(columns).tolist(),
+                                                          boxes.tolist())]
+
+
+def get_shape_parameters(x2, y2, xy):
+    """Find the major and minor axes and angle of objects from their second order moments"""
+    lhs = (x2 + y2) / 2
+    rhs = np.sqrt(((x2 - y2) / 2) ** 2 + xy ** 2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Axes are zero where they would be imaginary
+        major_axis = np.where(lhs + rhs < 0, 0, np.sqrt(lhs + rhs))
+        minor_axis = np.where(lhs - rhs < 0, 0, np.sqrt(lhs - rhs))
+
+        t = np.where(x2 == y2, 0, np.arctan((2 * xy) / (x2 - y2)))
+
+    # Shift theta to the correct value
+    theta = np.where((xy < 0) & (0 < t), (t - np.pi) / 2,
+                     np.where((t < 0) & (0 < xy), (t + np.pi) / 2, t / 2))
+
+    return major_axis, minor_axis, theta
 
 
 def get_object_parameters(img, node_id, pixel_indices):
@@ -113,7 +366,7 @@ def get_object_parameters(img, node_id, pixel_indices):
     p = [node_id]
 
     # Get pixel values for an object
-    pixel_values = np.nan_to_num(img.data[pixel_indices])
+    pixel_values = np.nan_to_num(img[pixel_indices])
 
     # Subtract min values if required
     pixel_values -= max(np.min(pixel_values), 0)
@@ -187,10 +440,12 @@ def get_second_order_moments(indices, values, flux_sum, x, y):
             minor_axis = 0
 
     # Solve for theta - major axis angle
-    try:
-        t = np.arctan((2 * xy) / (x2 - y2))
-    except RuntimeWarning:
-        t = 0
+    # Numpy's error state is per thread, unlike the warnings filters
+    with np.errstate(divide='raise', invalid='raise'):
+        try:
+            t = np.arctan((2 * xy) / (x2 - y2))
+        except FloatingPointError:
+            t = 0
 
     # Shift theta to the correct value
     if xy < 0 < t:
@@ -7,13 +7,31 @@ import scipy.ndimage.filters as filters
 from mtolib import background, utils
 
 
-def preprocess_image(img, p, gaussian_blur=True, n=2, nan_value=np.inf):
-    """Estimate an image's background, subtract it, smooth and truncate."""
+# Approximate size in bytes of the blocks of rows processed together by fused preprocessing
+BLOCK_SIZE = 2 ** 20
+
+
+def preprocess_image(img, p, gaussian_blur=True, n=2, nan_value=None, fused=True, out=None,
+                     mask=None):
+    """Estimate an image's background, subtract it, smooth and truncate.
+       Pixels where mask is true, and NaNs, are ignored by the background estimate and the
+       smoothing, which is normalised by the weight of the other pixels under the kernel. They
+       are NaN in the output, which the max tree leaves out, unless a nan_value to replace NaNs
+       with is given. If fused is set, the steps are applied in place to a single output
+       buffer, which may be given as out (and may be img itself), with the same result.
+    """
 
     # Estimate and subtract the background
-    estimate_background(img, p)
+    estimate_background(img, p, mask)
+
+    if fused:
+        return fused_preprocessing(img, p.bg_mean, gaussian_blur, n, nan_value, out, mask)
+
     new_img = subtract_background(img, p.bg_mean)
 
+    if mask is not None:
+        new_img[mask] = np.nan
+
     # Smooth the image
     if gaussian_blur:
         new_img = smooth_image(new_img, n)
@@ -24,18 +42,90 @@ def preprocess_image(img, p, gaussian_blur=True, n=2, nan_value=np.inf):
     return new_img
 
 
-def estimate_background(img, p):
-    """Estimate background mean & variance"""
+def fused_preprocessing(img, bg_mean, gaussian_blur=True, n=2, nan_value=None, out=None,
+                        mask=None):
+    """Subtract the background, smooth, truncate and replace nans, writing only to one image sized
+       buffer, and to buffers of weights and invalid pixels if NaN or masked pixels are smoothed.
+       Steps other than smoothing along columns are applied a block of rows at a time.
+    """
+    if out is None:
+        out = np.empty(img.shape, dtype=img.dtype.newbyteorder('='))
+
+    bg_mean = out.dtype.type(bg_mean)
+    block_rows = max(1, BLOCK_SIZE // (img.shape[1] * out.itemsize))
+    blocks = [slice(start, start + block_rows) for start in range(0, img.shape[0], block_rows)]
+
+    # Masked and NaN pixels, and the weight of each pixel in the smoothing, if there are any
+    invalid = None
+    weights = None
+
+    for rows in blocks:
+        block = out[rows]
+        np.subtract(img[rows], bg_mean, out=block)
+
+        if not gaussian_blur:
+            if mask is not None:
+                block[mask[rows]] = np.nan
+            continue
+
+        invalid_block = np.isnan(block)
+        if mask is not None:
+            invalid_block |= mask[rows]
+
+        if not invalid_block.any():
+            continue
+
+        if invalid is None:
+            invalid = np.zeros(img.shape, dtype=bool)
+            weights = np.ones(img.shape, dtype=out.dtype)
+
+        invalid[rows] = invalid_block
+        weights[rows][invalid_block] = 0
+        block[invalid_block] = 0
+
+    # Smooth along columns, then along rows with the remaining steps, as gaussian_filter does
+    if gaussian_blur:
+        sigma = utils.fwhm_to_sigma(n)
+        filters.gaussian_filter1d(out, sigma, axis=0, output=out)
+
+        if weights is not None:
+            filters.gaussian_filter1d(weights, sigma, axis=0, output=weights)
+
+    for rows in blocks:
+        block = out[rows]
+
+        if gaussian_blur:
+            filters.gaussian_filter1d(block, sigma, axis=1, output=block)
+
+            if weights is not None:
+                weight_block = weights[rows]
+                filters.gaussian_filter1d(weight_block, sigma, axis=1, output=weight_block)
+                normalise(block, weight_block, invalid[rows])
+
+        np.clip(block, 0, None, out=block)
+
+        if nan_value is None:
+            continue
+        elif nan_value == 0:
+            np.nan_to_num(block, copy=False)
+        else:
+            block[np.isnan(block)] = nan_value
+
+    return out
+
+
+def estimate_background(img, p, mask=None):
+    """Estimate background mean & variance, ignoring pixels where mask is true"""
 
     if p.bg_mean is None or p.bg_variance < 0:
 
         if np.isnan(img).any():
             if p.verbosity > 0:
-                print("WARNING: image contains NAN values which may affect output parameters")
+                print("WARNING: image contains NAN values, which are left out of the max tree")
 
         bg_mean_tmp, bg_variance_tmp = utils.time_function(background.estimate_bg,
-                                                           (img, p.verbosity), p.verbosity,
-                                                           "estimate background")
+                                                           (img, p.verbosity, 0.05, True, mask),
+                                                           p.verbosity, "estimate background")
 
         if p.bg_mean is None:
             p.bg_mean = bg_mean_tmp
@@ -43,7 +133,7 @@ def estimate_background(img, p):
         if p.bg_variance < 0:
             p.bg_variance = bg_variance_tmp
 
-    estimate_gain(img, p)
+    estimate_gain(img, p, mask)
 
     if p.verbosity:
         print("\n---Background Estimates---")
@@ -52,12 +142,15 @@ def estimate_background(img, p):
         print("Gain: ", p.gain, " electrons/ADU")
 
 
-def estimate_gain(img, p):
-    """Estimate gain."""
+def estimate_gain(img, p, mask=None):
+    """Estimate gain, ignoring pixels where mask is true."""
 
     # Negative gains break sig test 4 - estimated gain should be positive
     if p.gain < 0:
-        image_minimum = np.nanmin(img)
+        if mask is None:
+            image_minimum = np.nanmin(img)
+        else:
+            image_minimum = np.nanmin(img, where=~mask, initial=np.inf)
         if image_minimum < 0:
             p.soft_bias = image_minimum
 
@@ -65,8 +158,8 @@ def estimate_gain(img, p):
 
 
 def subtract_background(img, value):
-    """Subtract the background from an image and truncate."""
-    return img - value
+    """Subtract the background from an image and truncate, keeping the image's precision."""
+    return img - img.dtype.type(value)
 
 
 def truncate(img):
@@ -75,13 +168,59 @@ def truncate(img):
 
 
 def smooth_image(img, n=2):
-    """Apply a gaussian smoothing function to an image."""
-    return filters.gaussian_filter(img, utils.fwhm_to_sigma(n))
+    """Apply a gaussian smoothing function to an image. NaN pixels are left out, and stay NaN."""
+    invalid = np.isnan(img)
+
+    if not invalid.any():
+        return filters.gaussian_filter(img, utils.fwhm_to_sigma(n))
+
+    # Normalised convolution: smooth the valid pixels and their weights
+    weights = filters.gaussian_filter((~invalid).astype(img.dtype), utils.fwhm_to_sigma(n))
+    smoothed = filters.gaussian_filter(np.where(invalid, img.dtype.type(0), img),
+                                       utils.fwhm_to_sigma(n))
+
+    return normalise(smoothed, weights, invalid)
+
+
+def normalise(smoothed, weights, invalid):
+    """Divide smoothed valid pixels by the smoothed weights in place, and set invalid pixels to
+       NaN. Every valid pixel has some weight of its own."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(smoothed, weights, out=smoothed)
+
+    smoothed[invalid] = np.nan
 
+    return smoothed
 
-def replace_nans(img, value=np.inf):
-    if value == 0:
+
+def replace_nans(img, value=None):
+    if value is None:
+        return img
+    elif value == 0:
         return np.nan_to_num(img)
     else:
         img[np.isnan(img)] = value
         return img
+
+
+def quantise_image(img, levels):
+    """Round the finite values of an image to evenly spaced levels between its minimum and
+       maximum, keeping the image's units. Non-finite values are unchanged.
+       Return the quantised image, the lowest level and the spacing between levels.
+    """
+    if levels < 2:
+        raise ValueError("Images must be quantised to at least 2 levels")
+
+    quantised = img.copy()
+    finite = np.isfinite(img)
+
+    if not finite.any():
+        return quantised, 0.0, 0.0
+
+    base = float(img[finite].min())
+    step = (float(img[finite].max()) - base) / (levels - 1)
+
+    if step > 0:
+        quantised[finite] = base + np.round((img[finite] - base) / step) * step
+
+    return quantised, base, step
@@ -1,37 +1,109 @@
 """Statistical tests for max tree filtering."""
 
+import ctypes as ct
 from scipy import stats
-from mtolib._ctype_classes import SIGTEST_TYPE, INIT_TYPE
+from mtolib import boundaries
+from mtolib.maxtree import c_array
 import numpy as np
 
 
 NO_PARENT = -3
 
 
+def c_function(function_type, function):
+    """Return a function as a ctypes function pointer type. Functions from a compiled library are
+       called directly, rather than through Python, so they run without the GIL."""
+    if isinstance(function, ct._CFuncPtr):
+        return function_type(ct.cast(function, ct.c_void_p).value)
+
+    return function_type(function)
+
+
+def init_nothing(mto):
+    """An initialisation function for tests which need no data."""
+    pass
+
+
 class SignificanceTest:
     """A container class for statistical tests on the maxtree."""
+
+    # Field of the C object data which holds the test
+    field = 'node_significance_test'
+
     def __init__(self, test_function, init_function):
-        self.test = SIGTEST_TYPE(test_function)
-        self.init_test = INIT_TYPE(init_function)
+        self.test_function = test_function
+        self.init_function = init_function
+        self.c_functions = {}
+
+    def functions(self, bindings):
+        """Return the test and initialisation functions as function pointers of a set of
+           bindings' types, made once for each set."""
+        if bindings not in self.c_functions:
+            self.c_functions[bindings] = (c_function(bindings.SIGTEST_TYPE, self.test_function),
+                                          self.init(bindings))
+
+        return self.c_functions[bindings]
+
+    def init(self, bindings):
+        """Return the initialisation function, which is called from Python with a pointer to the
+           object data. Python functions are returned as they are, so that their exceptions are
+           raised."""
+        if isinstance(self.init_function, ct._CFuncPtr):
+            return c_function(bindings.INIT_TYPE, self.init_function)
+
+        return self.init_function
+
+    def setup_test(self, mto, bindings):
+        test, init_test = self.functions(bindings)
+        setattr(mto.contents, self.field, test)
 
-    def setup_test(self, mto):
-        mto.node_significance_test = self.test
+        init_test(mto)
 
-        self.init_test(mto)
+
+class BatchSignificanceTest(SignificanceTest):
+    """A statistical test of many nodes at once, for tests written in Python.
+       The test function is given an MtoAccess and an array of nodes whose ancestors have all
+       been tested, with their closest significant ancestors set, and returns a boolean array
+       marking the significant nodes. Trees are filtered with it one depth at a time."""
+
+    field = 'node_significance_test_batch'
+
+    def __init__(self, test_function, init_function=init_nothing):
+        SignificanceTest.__init__(self, test_function, init_function)
+
+    def functions(self, bindings):
+        """Return the batch test and initialisation functions as function pointers of a set of
+           bindings' types, made once for each set."""
+        if bindings not in self.c_functions:
+            def test_batch(mto, nodes, num_nodes, results):
+                nodes = c_array(None, nodes, num_nodes, ct.c_int32)
+                results = c_array(None, results, num_nodes, ct.c_uint8)
+
+                results[:] = self.test_function(MtoAccess(mto), nodes)
+
+            self.c_functions[bindings] = (bindings.BATCH_TEST_TYPE(test_batch), self.init(bindings))
+
+        return self.c_functions[bindings]
 
 
 class MtoAccess:
-    """Wrapper for mto objects, to simplify python data access."""
+    """Wrapper for mto objects, to simplify python data access.
+       The arrays share the C memory, so the getters accept single nodes or arrays of nodes."""
     def __init__(self, mto):
         self.mto = mto.contents
         self.mt = self.mto.mt.contents
+        size = self.mt.img.size
+
+        self.img = c_array(None, self.mt.img.data, size, self.mt.img.data._type_)
+        self.attributes = c_array(None, self.mt.node_attributes, size,
+                                  self.mt.node_attributes._type_)
+        self.nodes = c_array(None, self.mt.nodes, size, self.mt.nodes._type_)
+        self.flags = c_array(None, self.mto.flags, size, ct.c_uint8)
 
-        self.img = self.mt.img.data
-        self.attributes = self.mt.node_attributes
-        self.nodes = self.mt.nodes
-        self.flags = self.mto.flags
+        self.closest_sig_ancs = c_array(None, self.mto.closest_significant_ancestors, size,
+                                        ct.c_int32)
 
-        self.closest_sig_ancs = self.mto.closest_significant_ancestors
+        # Main branches are indexed by the dense numbers held in object_ids during the tests
         self.main_branches = self.mto.main_branches
         self.main_power_branches = self.mto.main_power_branches
 
@@ -42,16 +114,16 @@ class MtoAccess:
         self.sig_level = self.paras.alpha
 
     def get_area(self, node):
-        return self.nodes[node].area
+        return self.nodes['area'][node]
 
     def get_parent(self, node):
-        return self.nodes[node].parent
+        return self.nodes['parent'][node]
 
     def get_vol(self, node):
-        return self.attributes[node].volume
+        return self.attributes['volume'][node]
 
     def get_pow(self, node):
-        return self.attributes[node].power
+        return self.attributes['power'][node]
 
     def get_value(self, node):
         return self.img[node]
@@ -66,7 +138,8 @@ class MtoAccess:
         return self.get_sig_anc(node) != NO_PARENT
 
     def has_sig_dec(self, node_id):
-        return self.main_branches[node_id] != NO_PARENT
+        # Main branches are only stored for level roots, so use the node's flags
+        return self.flags[node_id] & 4
 
     def is_significant(self, node_id):
         return self.flags[node_id] & 1
@@ -74,5 +147,77 @@ class MtoAccess:
 
 def default_sig_test(mto_lib):
     """Return the default (original) significance test"""
-    return SignificanceTest(mto_lib.mt_node_test_4,
-                            mto_lib.mt_use_node_test_4)
+    def init_test(mto):
+        # Levels other than 1e-6 use a table of the rejection boundary
+        alpha = mto.contents.paras.contents.alpha
+
+        if alpha == boundaries.DEFAULT_ALPHA:
+            mto_lib.mt_use_node_test_4(mto)
+        else:
+            pixel_type = mto.contents.mt.contents.img.data._type_
+            boundaries.rejection_boundary(alpha, pixel_type).use(mto_lib, mto)
+
+    return SignificanceTest(mto_lib.mt_node_test_4, init_test)
+
+
+def noise_variance(access, nodes):
+    """Return the noise variance of each node, as mt_noise_variance does, in the image's type."""
+    float_type = access.img.dtype.type
+
+    variance = np.full(len(nodes), access.paras.bg_variance, dtype=float_type)
+
+    # Added in double precision, as in C
+    has_sig_anc = access.has_sig_anc(nodes)
+    variance[has_sig_anc] = (variance[has_sig_anc].astype(np.float64) +
+                             access.get_sig_anc_value(nodes[has_sig_anc]) / access.paras.gain)
+
+    return variance
+
+
+def alternative_power(access, nodes):
+    """Return the power of each node relative to its closest significant ancestor, as
+       mt_alternative_power_definition does, in the image's type."""
+    float_type = access.img.dtype.type
+
+    delta = access.get_value(access.get_parent(nodes))
+
+    has_sig_anc = access.has_sig_anc(nodes)
+    delta[has_sig_anc] -= access.get_sig_anc_value(nodes[has_sig_anc])
+
+    area = access.get_area(nodes).astype(float_type)
+
+    return (access.get_pow(nodes) + delta * (2 * access.get_vol(nodes) + delta * area)).astype(
+        float_type)
+
+
+def power_given_area_test(access, nodes):
+    """Test many nodes at once with significance test 4, as mt_node_test_4 does."""
+    float_type = access.img.dtype.type
+
+    variance = noise_variance(access, nodes)
+    significant = np.ones(len(nodes), dtype=bool)
+
+    min_distance = float_type(access.paras.min_distance)
+
+    if min_distance > 0:
+        distance = access.get_value(nodes)
+
+        has_sig_anc = access.has_sig_anc(nodes)
+        distance[has_sig_anc] -= access.get_sig_anc_value(nodes[has_sig_anc])
+
+        significant &= ~(distance / np.sqrt(variance.astype(np.float64)) < min_distance)
+
+    area = access.get_area(nodes)
+    power_normalized = alternative_power(access, nodes) / variance / area.astype(float_type)
+
+    if access.sig_level == boundaries.DEFAULT_ALPHA:
+        x = boundaries.fitted_boundary(area, float_type)
+    else:
+        x = boundaries.rejection_boundary(access.sig_level, float_type)(area)
+
+    return significant & (power_normalized > x)
+
+
+def batch_test_4():
+    """Return significance test 4 written in Python, as a batch test."""
+    return BatchSignificanceTest(power_given_area_test)
@@ -22,7 +22,16 @@
 
 #define FLOAT_TYPE float
 
+// Type of the node attributes (volume and power), which may be set when
+// compiling to trade precision for memory
+#ifndef ATTRIBUTE_TYPE
+#define ATTRIBUTE_TYPE FLOAT_TYPE
+#endif
+
 #define PIXEL_TYPE float
+// Unsigned integer type with the same size as PIXEL_TYPE
+#define PIXEL_BITS_TYPE uint32_t
+
 #define FITS_TYPE TFLOAT
 
 #define TRUE  1
@@ -31,13 +40,13 @@
 typedef struct
 {
   PIXEL_TYPE* data;
-  SHORT_TYPE height;
-  SHORT_TYPE width;
+  INT_TYPE height;
+  INT_TYPE width;
   INT_TYPE size;
 } image;
 
 static inline void image_set(image* img, PIXEL_TYPE *data,
-  SHORT_TYPE height, SHORT_TYPE width)
+  INT_TYPE height, INT_TYPE width)
 {
   img->data = data;
   img->height = height;
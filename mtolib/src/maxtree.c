@@ -1,9 +1,8 @@
 #include "maxtree.h"
+#include "mt_bucket_queue.h"
 
 #include <assert.h>
-
-#define MT_INDEX_OF(PIXEL) ((PIXEL).location.y * mt->img.width + \
-  (PIXEL).location.x)
+#include <math.h>
 
 const int mt_conn_12[MT_CONN_12_HEIGHT * MT_CONN_12_WIDTH] =
 {
@@ -28,34 +27,31 @@ const int mt_conn_4[MT_CONN_4_HEIGHT * MT_CONN_4_WIDTH] =
   0, 1, 0,
 };
 
+const int mt_attribute_size = sizeof(ATTRIBUTE_TYPE);
+
 mt_pixel mt_starting_pixel(mt_data* mt)
 {
-  // Find the minimum pixel value in the image
-  SHORT_TYPE y;
-  SHORT_TYPE x;
+  // Find the minimum pixel value in the image, ignoring masked pixels. The
+  // index is MT_UNASSIGNED if every pixel is masked
+  INT_TYPE index;
 
   mt_pixel pixel;
-  pixel.location.x = 0;
-  pixel.location.y = 0;
-
-  pixel.value = mt->img.data[0];
+  pixel.index = MT_UNASSIGNED;
+  pixel.value = 0;
 
   // iterate over image pixels
-  for (y = 0; y != mt->img.height; ++y)
+  for (index = 0; index != mt->img.size; ++index)
   {
-    for (x = 0; x != mt->img.width; ++x)
+    if (MT_IS_MASKED(mt, index))
     {
-	  // Convert from x,y coordinates to an array index
-      INT_TYPE index = y * mt->img.width + x;
-
-      // If the pixel is less than the current minimum, update the minimum
-      if (mt->img.data[index] < pixel.value)
-      {
-        pixel.value = mt->img.data[index];
-        pixel.location.x = x;
-        pixel.location.y = y;
+      continue;
+    }
 
-      }
+    // If the pixel is less than the current minimum, update the minimum
+    if (pixel.index == MT_UNASSIGNED || mt->img.data[index] < pixel.value)
+    {
+      pixel.value = mt->img.data[index];
+      pixel.index = index;
     }
   }
 
@@ -75,98 +71,213 @@ static void mt_init_nodes(mt_data* mt)
   }
 }
 
-static int mt_queue_neighbour(mt_data* mt, PIXEL_TYPE val,
-  SHORT_TYPE x, SHORT_TYPE y)
+static void mt_queue_insert(mt_data* mt, mt_bucket_queue* buckets,
+  const mt_pixel* pixel)
 {
-  // Add a pixel to the queue for processing
+  // Add a pixel to the bucket queue if there is one, or else the heap
+  if (buckets)
+  {
+    mt_bucket_queue_insert(buckets, pixel);
+  }
+  else
+  {
+    mt_heap_insert(&mt->heap, pixel);
+  }
+}
 
-  //Create a pixel and set its location
-  mt_pixel neighbour;
-  neighbour.location.x = x;
-  neighbour.location.y = y;
+static const mt_pixel* mt_queue_top(mt_data* mt, mt_bucket_queue* buckets)
+{
+  return buckets ? MT_BUCKET_QUEUE_TOP(buckets) : MT_HEAP_TOP(&mt->heap);
+}
+
+static const mt_pixel* mt_queue_remove(mt_data* mt,
+  mt_bucket_queue* buckets)
+{
+  return buckets ? mt_bucket_queue_remove(buckets) :
+    mt_heap_remove(&mt->heap);
+}
+
+static int mt_queue_empty(mt_data* mt, mt_bucket_queue* buckets)
+{
+  return buckets ? MT_BUCKET_QUEUE_EMPTY(buckets) :
+    MT_HEAP_EMPTY(&mt->heap);
+}
+
+typedef struct
+{
+  // Flags of the pixels which have been queued, in an image padded with a
+  // border of flagged pixels, so that neighbours need no bounds checks
+  uint8_t* queued;
+  // Width of the padded image, and the padding added to each row
+  INT_TYPE width;
+  INT_TYPE row_padding;
+  // Offset of the image's first pixel in the padded image
+  INT_TYPE origin;
+  // Neighbour offsets in the image and in the padded image
+  INT_TYPE offsets[MT_MAX_NEIGHBOURS];
+  INT_TYPE padded_offsets[MT_MAX_NEIGHBOURS];
+  int num_neighbours;
+  // Index from which to search for pixels which have not been queued
+  INT_TYPE next_unqueued;
+} mt_queue_flags;
+
+static void mt_alloc_queue_flags(mt_data* mt, mt_queue_flags* flags)
+{
+  // Pad the image by the radius of the connectivity, and list the neighbour
+  // offsets in the image and the padded image
+
+  INT_TYPE radius_y = mt->connectivity.height / 2;
+  INT_TYPE radius_x = mt->connectivity.width / 2;
+
+  INT_TYPE height = mt->img.height + 2 * radius_y;
+  flags->width = mt->img.width + 2 * radius_x;
+  flags->row_padding = 2 * radius_x;
+  flags->origin = radius_y * flags->width + radius_x;
+
+  mt_neighbours neighbours;
+  mt_init_neighbours(mt, &neighbours);
+
+  flags->num_neighbours = neighbours.num_neighbours;
+
+  int n;
+  for (n = 0; n != neighbours.num_neighbours; ++n)
+  {
+    flags->offsets[n] = neighbours.offsets[n];
+    flags->padded_offsets[n] = neighbours.dy[n] * flags->width +
+      neighbours.dx[n];
+  }
+
+  flags->next_unqueued = 0;
 
-  // Convert from x,y coordinates to an array index
-  INT_TYPE neighbour_index = MT_INDEX_OF(neighbour);
-  // Get a pointer to the neighbour
-  mt_node *neighbour_node = mt->nodes + neighbour_index;
+  // Flag the border and masked pixels as queued
+  flags->queued = safe_malloc((size_t)height * flags->width);
+  memset(flags->queued, 1, (size_t)radius_y * flags->width);
+  memset(flags->queued + (size_t)(height - radius_y) * flags->width, 1,
+    (size_t)radius_y * flags->width);
 
-  // If the neighbour has not already been processed, add it to the queue
-  if (neighbour_node->parent == MT_UNASSIGNED)
+  INT_TYPE y;
+  for (y = radius_y; y != height - radius_y; ++y)
   {
-    neighbour.value = mt->img.data[neighbour_index];
-    neighbour_node->parent = MT_IN_QUEUE;
-    mt_heap_insert(&mt->heap, &neighbour);
+    uint8_t* row = flags->queued + (size_t)y * flags->width;
 
-    // If the neighbour has a higher value than the current node, return 1
-    if (neighbour.value > val)
+    memset(row, 1, radius_x);
+    memset(row + radius_x, 0, mt->img.width);
+    memset(row + radius_x + mt->img.width, 1, radius_x);
+
+    const mt_node* nodes = mt->nodes + (size_t)(y - radius_y) * mt->img.width;
+
+    INT_TYPE x;
+    for (x = 0; x != mt->img.width; ++x)
     {
-      return 1;
+      if (nodes[x].parent == MT_MASKED)
+      {
+        row[radius_x + x] = 1;
+      }
     }
   }
+}
 
-  return 0;
+static uint8_t* mt_queue_flag(mt_data* mt, mt_queue_flags* flags,
+  INT_TYPE index)
+{
+  // Return the queued flag of a pixel
+
+  INT_TYPE y = index / mt->img.width;
+
+  return flags->queued + flags->origin + index + y * flags->row_padding;
 }
 
-static void mt_queue_neighbours(mt_data* mt,
-  mt_pixel* pixel)
+static int mt_queue_neighbour(mt_data* mt, mt_bucket_queue* buckets,
+  PIXEL_TYPE val, INT_TYPE neighbour_index)
 {
-  // Seems to be limiting conn values within image coordinates
+  // Add a pixel to the queue for processing
 
-  // Radius is half size of connectivity
-  INT_TYPE radius_y = mt->connectivity.height / 2;
-  INT_TYPE radius_x = mt->connectivity.width / 2;
+  //Create a pixel and set its index
+  mt_pixel neighbour;
+  neighbour.index = neighbour_index;
+  neighbour.value = mt->img.data[neighbour_index];
 
-  // If pixel's x is less than radius, conn = the difference
-  INT_TYPE conn_x_min = 0;
-  if (pixel->location.x < radius_x)
-    conn_x_min = radius_x - pixel->location.x;
+  mt_queue_insert(mt, buckets, &neighbour);
 
-  // Ditto for y
-  INT_TYPE conn_y_min = 0;
-  if (pixel->location.y < radius_y)
-    conn_y_min = radius_y - pixel->location.y;
+  // If the neighbour has a higher value than the current node, return 1
+  return neighbour.value > val;
+}
 
-  // If pixel's x + radius > image width, conn = radius + width - location - 1
-  INT_TYPE conn_x_max = 2 * radius_x;
-  if (pixel->location.x + radius_x >= mt->img.width)
-    conn_x_max = radius_x + mt->img.width - pixel->location.x - 1;
+static void mt_queue_neighbours(mt_data* mt, mt_bucket_queue* buckets,
+  mt_queue_flags* flags, mt_pixel* pixel)
+{
+  // Queue the neighbours of a pixel which have not been queued, until one is
+  // higher than the pixel
 
-  INT_TYPE conn_y_max = 2 * radius_y;
-  if (pixel->location.y + radius_y >= mt->img.height)
-    conn_y_max = radius_y + mt->img.height - pixel->location.y - 1;
+  uint8_t* queued = mt_queue_flag(mt, flags, pixel->index);
 
-  INT_TYPE conn_y;
-  // Conn coordinates refer to position with connectivity grid
-  for (conn_y = conn_y_min; conn_y <= conn_y_max; ++conn_y)
+  int n;
+  for (n = 0; n != flags->num_neighbours; ++n)
   {
-    INT_TYPE conn_x;
-    for (conn_x = conn_x_min; conn_x <= conn_x_max; ++conn_x)
+    uint8_t* neighbour_queued = queued + flags->padded_offsets[n];
+
+    if (*neighbour_queued)
     {
-	  // Skip iteration if 0 in connectivity grid
-      if (mt->connectivity.
-        neighbors[conn_y * mt->connectivity.width + conn_x] == 0)
-      {
-        continue;
-      }
+      continue;
+    }
 
-      // Try to queue neighbour at x = x-rad+conn
-      // If successfully queued and value higher than current,
-      // break out of function
-      if (mt_queue_neighbour(mt, pixel->value,
-        pixel->location.x - radius_x + conn_x,
-        pixel->location.y - radius_y + conn_y))
-      {
-        return;
-      }
+    *neighbour_queued = 1;
+
+    // If the neighbour is higher than the current pixel, break out of function
+    if (mt_queue_neighbour(mt, buckets, pixel->value,
+      pixel->index + flags->offsets[n]))
+    {
+      return;
     }
   }
 }
 
+static int mt_queue_unqueued(mt_data* mt, mt_bucket_queue* buckets,
+  mt_queue_flags* flags)
+{
+  // Queue the first pixel which has not been queued, which starts a component
+  // not connected to the pixels flooded so far. Return 0 if there is none
+
+  INT_TYPE index = flags->next_unqueued;
+  INT_TYPE x = index % mt->img.width;
+  uint8_t* queued = mt_queue_flag(mt, flags, index);
+
+  for (; index != mt->img.size; ++index, ++x, ++queued)
+  {
+    if (x == mt->img.width)
+    {
+      // Skip the padding between rows
+      x = 0;
+      queued += flags->row_padding;
+    }
+
+    if (!*queued)
+    {
+      *queued = 1;
+      flags->next_unqueued = index + 1;
+
+      mt_pixel pixel;
+      pixel.index = index;
+      pixel.value = mt->img.data[index];
+      mt_queue_insert(mt, buckets, &pixel);
+
+      return 1;
+    }
+  }
+
+  flags->next_unqueued = index;
+
+  return 0;
+}
+
 static void mt_merge_nodes(mt_data* mt,
   INT_TYPE merge_to_idx,
   INT_TYPE merge_from_idx)
 {
   // Merge two nodes
+  // Attributes of the merged node are added relative to the level of the
+  // node it is merged into. The merged node keeps attributes relative to its
+  // own level until mt_rebase_attributes.
 
   mt_node *merge_to = mt->nodes + merge_to_idx;
   mt_node_attributes *merge_to_attr = mt->nodes_attributes +
@@ -181,29 +292,38 @@ static void mt_merge_nodes(mt_data* mt,
   FLOAT_TYPE delta = mt->img.data[merge_from_idx] -
     mt->img.data[merge_to_idx];
 
-  merge_from_attr->power += delta *
+  merge_to_attr->power += merge_from_attr->power + delta *
     (2 * merge_from_attr->volume + delta * merge_from->area);
-  merge_to_attr->power += merge_from_attr->power;
 
-  merge_from_attr->volume += delta * merge_from->area;
-  merge_to_attr->volume += merge_from_attr->volume;
+  merge_to_attr->volume += merge_from_attr->volume +
+    delta * merge_from->area;
+
+  if (mt->nodes_moments != NULL)
+  {
+    mt_add_moments(mt->nodes_moments + merge_to_idx,
+      mt->nodes_moments + merge_from_idx);
+  }
 }
 
 static void mt_descend(mt_data* mt, mt_pixel *next_pixel)
 {
   mt_pixel old_top = *mt_stack_remove(&mt->stack);
-  INT_TYPE old_top_index = MT_INDEX_OF(old_top);
-
+  INT_TYPE old_top_index = old_top.index;
 
-  mt_pixel* stack_top = MT_STACK_TOP(&mt->stack);
-
-  if (stack_top->value < next_pixel->value)
+  if (!MT_STACK_NOT_EMPTY(&mt->stack))
+  {
+    // Below the root of a component which is not joined to the others, so
+    // the next pixel becomes its root
+    mt->nodes[next_pixel->index].parent = MT_NO_PARENT;
+    mt_stack_insert(&mt->stack, next_pixel);
+  }
+  else if (MT_STACK_TOP(&mt->stack)->value < next_pixel->value)
   {
     mt_stack_insert(&mt->stack, next_pixel);
   }
 
-  stack_top = MT_STACK_TOP(&mt->stack);
-  INT_TYPE stack_top_index = MT_INDEX_OF(*stack_top);
+  mt_pixel* stack_top = MT_STACK_TOP(&mt->stack);
+  INT_TYPE stack_top_index = stack_top->index;
 
   mt->nodes[old_top_index].parent = stack_top_index;
   mt_merge_nodes(mt, stack_top_index, old_top_index);
@@ -214,58 +334,321 @@ static void mt_remaining_stack(mt_data* mt)
   while (MT_STACK_SIZE(&mt->stack) > 1)
   {
     mt_pixel old_top = *mt_stack_remove(&mt->stack);
-    INT_TYPE old_top_index = MT_INDEX_OF(old_top);
+    INT_TYPE old_top_index = old_top.index;
 
     mt_pixel* stack_top = MT_STACK_TOP(&mt->stack);
-    INT_TYPE stack_top_index = MT_INDEX_OF(*stack_top);
+    INT_TYPE stack_top_index = stack_top->index;
 
     mt->nodes[old_top_index].parent = stack_top_index;
     mt_merge_nodes(mt, stack_top_index, old_top_index);
   }
 }
 
-void mt_flood(mt_data* mt)
+void mt_pixel_moments(mt_data* mt, INT_TYPE idx)
 {
-  assert(mt->connectivity.height > 0);
-  assert(mt->connectivity.height % 2 == 1);
-  assert(mt->connectivity.width > 0);
-  assert(mt->connectivity.width % 2 == 1);
+  // Set a node's moments to those of its own pixel
+  // Non-finite pixels have no weight
 
-  if (mt->verbosity_level)
+  mt_node_moments *moments = mt->nodes_moments + idx;
+
+  INT_TYPE y = idx / mt->img.width;
+  INT_TYPE x = idx - y * mt->img.width;
+
+  double value = mt->img.data[idx];
+  if (!isfinite(value))
+  {
+    value = 0;
+  }
+
+  moments->sums[0] = x;
+  moments->sums[1] = y;
+  moments->sums[2] = (double)x * x;
+  moments->sums[3] = (double)y * y;
+  moments->sums[4] = (double)x * y;
+
+  int i;
+  for (i = 0; i != MT_NUM_MOMENTS; ++i)
+  {
+    moments->weighted_sums[i] = value * moments->sums[i];
+  }
+
+  moments->flux = value;
+
+  moments->x_min = x;
+  moments->x_max = x;
+  moments->y_min = y;
+  moments->y_max = y;
+}
+
+void mt_add_moments(mt_node_moments* to, const mt_node_moments* from)
+{
+  // Add the moments of a component to another component
+
+  int i;
+  for (i = 0; i != MT_NUM_MOMENTS; ++i)
+  {
+    to->sums[i] += from->sums[i];
+    to->weighted_sums[i] += from->weighted_sums[i];
+  }
+
+  to->flux += from->flux;
+
+  if (from->x_min < to->x_min)
+    to->x_min = from->x_min;
+  if (from->x_max > to->x_max)
+    to->x_max = from->x_max;
+  if (from->y_min < to->y_min)
+    to->y_min = from->y_min;
+  if (from->y_max > to->y_max)
+    to->y_max = from->y_max;
+}
+
+void mt_alloc_moments(mt_data* mt)
+{
+  // Compute the moments of each node's component during the next flood
+  // Unlike volume and power, moments are not relative to any level, so
+  // they are simply added when components merge
+
+  free(mt->nodes_moments);
+
+  mt->nodes_moments = safe_malloc(mt->img.size * sizeof(mt_node_moments));
+
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    mt_pixel_moments(mt, i);
+  }
+}
+
+void mt_rebase_attributes(mt_data* mt, INT_TYPE start, INT_TYPE end)
+{
+  // Make node attributes relative to the level of each node's parent
+
+  INT_TYPE i;
+  for (i = start; i != end; ++i)
+  {
+    INT_TYPE parent_idx = mt->nodes[i].parent;
+
+    // Skip the root, masked pixels and nodes within a level root's flat zone
+    if (parent_idx < 0 ||
+      mt->img.data[parent_idx] == mt->img.data[i])
+    {
+      continue;
+    }
+
+    mt_node_attributes *attr = mt->nodes_attributes + i;
+
+    FLOAT_TYPE delta = mt->img.data[i] - mt->img.data[parent_idx];
+
+    attr->power += delta * (2 * attr->volume + delta * mt->nodes[i].area);
+    attr->volume += delta * mt->nodes[i].area;
+  }
+}
+
+void mt_canonical_level_roots(mt_data* mt)
+{
+  // Make the pixel of lowest index in each flat zone its level root, so that
+  // the tree does not depend on the order in which it was built. Every pixel
+  // in a flat zone must have the zone's level root as its parent.
+
+  // Find whether any flat zone has a pixel before its level root
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
   {
-    int num_neighbors = 0;
-    int i;
-    for (i = 0; i != mt->connectivity.height; ++i)
+    INT_TYPE parent_idx = mt->nodes[i].parent;
+
+    if (parent_idx > i && mt->img.data[parent_idx] == mt->img.data[i])
+    {
+      break;
+    }
+  }
+
+  if (i == mt->img.size)
+  {
+    return;
+  }
+
+  // The new level root of each level root, or the pixel itself for others
+  INT_TYPE *level_roots = safe_malloc(mt->img.size * sizeof(*level_roots));
+
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    level_roots[i] = i;
+  }
+
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    INT_TYPE parent_idx = mt->nodes[i].parent;
+
+    if (parent_idx > i && mt->img.data[parent_idx] == mt->img.data[i] &&
+      level_roots[parent_idx] > i)
+    {
+      level_roots[parent_idx] = i;
+    }
+  }
+
+  // Swap the nodes of the old and new level roots, pointing the old at the new
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    INT_TYPE new_idx = level_roots[i];
+
+    if (new_idx == i)
+    {
+      continue;
+    }
+
+    mt_node node = mt->nodes[new_idx];
+    mt->nodes[new_idx] = mt->nodes[i];
+    mt->nodes[i] = node;
+    mt->nodes[i].parent = new_idx;
+
+    mt_node_attributes attributes = mt->nodes_attributes[new_idx];
+    mt->nodes_attributes[new_idx] = mt->nodes_attributes[i];
+    mt->nodes_attributes[i] = attributes;
+
+    if (mt->nodes_moments != NULL)
+    {
+      mt->nodes_moments[new_idx] = mt->nodes_moments[i];
+      mt_pixel_moments(mt, i);
+    }
+
+    if (mt->root == mt->nodes + i)
+    {
+      mt->root = mt->nodes + new_idx;
+    }
+  }
+
+  // Point the children of the old level roots at the new
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    if (mt->nodes[i].parent >= 0)
+    {
+      mt->nodes[i].parent = level_roots[mt->nodes[i].parent];
+    }
+  }
+
+  free(level_roots);
+}
+
+void mt_set_connectivity(mt_data* mt, int connectivity)
+{
+  // Use 4, 8 or 12 connected neighbours
+
+  switch (connectivity)
+  {
+    case 4:
+      mt->connectivity.neighbors = mt_conn_4;
+      mt->connectivity.width = MT_CONN_4_WIDTH;
+      mt->connectivity.height = MT_CONN_4_HEIGHT;
+      break;
+    case 8:
+      mt->connectivity.neighbors = mt_conn_8;
+      mt->connectivity.width = MT_CONN_8_WIDTH;
+      mt->connectivity.height = MT_CONN_8_HEIGHT;
+      break;
+    case 12:
+      mt->connectivity.neighbors = mt_conn_12;
+      mt->connectivity.width = MT_CONN_12_WIDTH;
+      mt->connectivity.height = MT_CONN_12_HEIGHT;
+      break;
+    default:
+      error("Error: connectivity must be 4, 8 or 12.\n");
+  }
+}
+
+void mt_init_neighbours(mt_data* mt, mt_neighbours* neighbours)
+{
+  // List the neighbours in the connectivity grid
+
+  INT_TYPE radius_y = mt->connectivity.height / 2;
+  INT_TYPE radius_x = mt->connectivity.width / 2;
+
+  neighbours->num_neighbours = 0;
+
+  INT_TYPE conn_y;
+  for (conn_y = 0; conn_y != mt->connectivity.height; ++conn_y)
+  {
+    INT_TYPE conn_x;
+    for (conn_x = 0; conn_x != mt->connectivity.width; ++conn_x)
     {
-      int j;
-      for (j = 0; j != mt->connectivity.width; ++j)
+      if (mt->connectivity.
+        neighbors[conn_y * mt->connectivity.width + conn_x] == 0)
       {
-        if (mt->connectivity.neighbors[i * mt->connectivity.width + j])
-        {
-          ++num_neighbors;
-        }
+        continue;
       }
+
+      int n = neighbours->num_neighbours++;
+      neighbours->dx[n] = conn_x - radius_x;
+      neighbours->dy[n] = conn_y - radius_y;
+      neighbours->offsets[n] = neighbours->dy[n] * mt->img.width +
+        neighbours->dx[n];
     }
+  }
+}
 
-    printf("%d neighbors connectivity.\n", num_neighbors);
+void mt_print_connectivity(mt_data* mt)
+{
+  int num_neighbors = 0;
+  int i;
+  for (i = 0; i != mt->connectivity.height; ++i)
+  {
+    int j;
+    for (j = 0; j != mt->connectivity.width; ++j)
+    {
+      if (mt->connectivity.neighbors[i * mt->connectivity.width + j])
+      {
+        ++num_neighbors;
+      }
+    }
   }
 
+  printf("%d neighbors connectivity.\n", num_neighbors);
+}
+
+static void mt_flood_queue(mt_data* mt, mt_bucket_queue* buckets,
+  int join_components)
+{
+  // Flood the image, using the bucket queue if there is one. Components of
+  // pixels separated by masked pixels are joined at the root's level, or
+  // else left as separate trees
+
+  assert(mt->connectivity.height > 0);
+  assert(mt->connectivity.height % 2 == 1);
+  assert(mt->connectivity.width > 0);
+  assert(mt->connectivity.width % 2 == 1);
+
+  mt_queue_flags flags;
+  mt_alloc_queue_flags(mt, &flags);
+
   mt_pixel next_pixel = mt_starting_pixel(mt);
-  INT_TYPE next_index = MT_INDEX_OF(next_pixel);
+  INT_TYPE next_index = next_pixel.index;
+
+  if (next_index == MT_UNASSIGNED)
+  {
+    // Every pixel is masked, so there is no tree
+    mt->root = NULL;
+
+    free(flags.queued);
+    mt_stack_free_entries(&mt->stack);
+    mt_heap_free_entries(&mt->heap);
+    return;
+  }
+
   mt->root = mt->nodes + next_index;
   mt->nodes[next_index].parent = MT_NO_PARENT;
-  mt_heap_insert(&mt->heap, &next_pixel);
+  *mt_queue_flag(mt, &flags, next_index) = 1;
+  mt_queue_insert(mt, buckets, &next_pixel);
   mt_stack_insert(&mt->stack, &next_pixel);
 
-  while (MT_HEAP_NOT_EMPTY(&mt->heap))
+  while (!mt_queue_empty(mt, buckets))
   {
     mt_pixel pixel = next_pixel;
     INT_TYPE index = next_index;
 
-    mt_queue_neighbours(mt, &pixel);
+    mt_queue_neighbours(mt, buckets, &flags, &pixel);
 
-    next_pixel = *MT_HEAP_TOP(&mt->heap);
-    next_index = MT_INDEX_OF(next_pixel);
+    next_pixel = *mt_queue_top(mt, buckets);
+    next_index = next_pixel.index;
 
     if (next_pixel.value > pixel.value)
     {
@@ -275,24 +658,53 @@ void mt_flood(mt_data* mt)
       continue;
     }
 
-    pixel = *mt_heap_remove(&mt->heap);
-    index = MT_INDEX_OF(pixel);
+    pixel = *mt_queue_remove(mt, buckets);
+    index = pixel.index;
     mt_pixel *stack_top = MT_STACK_TOP(&mt->stack);
-    INT_TYPE stack_top_index = MT_INDEX_OF(*stack_top);
+    INT_TYPE stack_top_index = stack_top->index;
 
     if (index != stack_top_index)
     {
       mt->nodes[index].parent = stack_top_index;
       ++mt->nodes[stack_top_index].area;
+
+      if (mt->nodes_moments != NULL)
+      {
+        mt_add_moments(mt->nodes_moments + stack_top_index,
+          mt->nodes_moments + index);
+      }
     }
 
-    if (MT_HEAP_EMPTY(&mt->heap))
+    if (mt_queue_empty(mt, buckets))
     {
-      break;
+      // Start the next component of pixels separated by masked pixels, or
+      // stop if there is none
+      if (!mt_queue_unqueued(mt, buckets, &flags))
+      {
+        break;
+      }
+
+      mt_remaining_stack(mt);
+
+      next_pixel = *mt_queue_top(mt, buckets);
+      next_index = next_pixel.index;
+
+      if (!join_components)
+      {
+        mt_stack_remove(&mt->stack);
+        mt->nodes[next_index].parent = MT_NO_PARENT;
+        mt_stack_insert(&mt->stack, &next_pixel);
+      }
+      else if (next_pixel.value > MT_STACK_TOP(&mt->stack)->value)
+      {
+        mt_stack_insert(&mt->stack, &next_pixel);
+      }
+
+      continue;
     }
 
-    next_pixel = *MT_HEAP_TOP(&mt->heap);
-    next_index = MT_INDEX_OF(next_pixel);
+    next_pixel = *mt_queue_top(mt, buckets);
+    next_index = next_pixel.index;
 
     if (next_pixel.value < pixel.value)
     {
@@ -304,10 +716,54 @@ void mt_flood(mt_data* mt)
 
   mt_remaining_stack(mt);
 
+  free(flags.queued);
   mt_stack_free_entries(&mt->stack);
   mt_heap_free_entries(&mt->heap);
 }
 
+void mt_flood_components(mt_data* mt, int join_components)
+{
+  mt_flood_queue(mt, NULL, join_components);
+}
+
+void mt_flood(mt_data* mt)
+{
+  if (mt->verbosity_level)
+  {
+    mt_print_connectivity(mt);
+  }
+
+  mt_flood_components(mt, 1);
+
+  mt_rebase_attributes(mt, 0, mt->img.size);
+  mt_canonical_level_roots(mt);
+}
+
+void mt_flood_levels(mt_data* mt, INT_TYPE levels, PIXEL_TYPE base,
+  PIXEL_TYPE step)
+{
+  // Flood an image whose finite values are base + k * step, for integer k
+  // from 0 to levels - 1, using a bucket queue in place of the heap
+
+  if (mt->verbosity_level)
+  {
+    mt_print_connectivity(mt);
+    printf("%d levels.\n", levels);
+  }
+
+  mt_heap_free_entries(&mt->heap);
+
+  mt_bucket_queue buckets;
+  mt_bucket_queue_alloc_entries(&buckets, mt, levels, base, step);
+
+  mt_flood_queue(mt, &buckets, 1);
+
+  mt_bucket_queue_free_entries(&buckets);
+
+  mt_rebase_attributes(mt, 0, mt->img.size);
+  mt_canonical_level_roots(mt);
+}
+
 void mt_init(mt_data* mt, const image* img)
 {
   mt->img = *img;
@@ -317,22 +773,56 @@ void mt_init(mt_data* mt, const image* img)
     sizeof(mt_node_attributes));
 
   mt_stack_alloc_entries(&mt->stack);
-  mt_heap_alloc_entries(&mt->heap);
+  mt_heap_alloc_entries(&mt->heap, mt->img.size);
 
   mt_init_nodes(mt);
 
-  mt->connectivity.neighbors = mt_conn_4;
-  mt->connectivity.width = MT_CONN_4_WIDTH;
-  mt->connectivity.height = MT_CONN_4_HEIGHT;
+  mt->nodes_moments = NULL;
+
+  mt_set_connectivity(mt, 4);
 
   mt->verbosity_level = 0;
 }
 
+void mt_set_mask(mt_data* mt, const uint8_t* mask)
+{
+  // Exclude the pixels where the mask is not zero from the tree. Masked pixels
+  // are never queued, and have no parent and no area
+
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    if (mask[i])
+    {
+      mt->nodes[i].parent = MT_MASKED;
+      mt->nodes[i].area = 0;
+    }
+  }
+}
+
+void mt_use_arrays(mt_data* mt, mt_node* nodes,
+  mt_node_attributes* nodes_attributes, INT_TYPE root_index)
+{
+  // Use the arrays of a tree flooded earlier in place of flooding. The arrays
+  // belong to the caller, which must clear the pointers before mt_free.
+
+  free(mt->nodes);
+  free(mt->nodes_attributes);
+
+  mt_stack_free_entries(&mt->stack);
+  mt_heap_free_entries(&mt->heap);
+
+  mt->nodes = nodes;
+  mt->nodes_attributes = nodes_attributes;
+  mt->root = nodes + root_index;
+}
+
 void mt_free(mt_data* mt)
 {
   // Free the memory occupied by the max tree
   free(mt->nodes);
   free(mt->nodes_attributes);
+  free(mt->nodes_moments);
 
   //memset(mt, 0, sizeof(mt_data));
 }
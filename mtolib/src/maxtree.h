@@ -6,12 +6,15 @@
 #define MT_UNASSIGNED -1
 #define MT_IN_QUEUE -2
 #define MT_NO_PARENT -3
+#define MT_MASKED -4
 
 #define MT_NO_OBJECT -1
 
 #define MT_IS_ROOT(MT_PTR, IDX) ((MT_PTR)->nodes + IDX == \
   (MT_PTR)->root)
 
+#define MT_IS_MASKED(MT_PTR, IDX) ((MT_PTR)->nodes[IDX].parent == MT_MASKED)
+
 #define MT_CONN_12_WIDTH 5
 #define MT_CONN_12_HEIGHT 5
 
@@ -25,6 +28,11 @@ extern const int mt_conn_12[MT_CONN_12_HEIGHT * MT_CONN_12_WIDTH];
 extern const int mt_conn_8[MT_CONN_8_HEIGHT * MT_CONN_8_WIDTH];
 extern const int mt_conn_4[MT_CONN_4_HEIGHT * MT_CONN_4_WIDTH];
 
+#define MT_MAX_NEIGHBOURS (MT_CONN_12_HEIGHT * MT_CONN_12_WIDTH)
+
+// Size of ATTRIBUTE_TYPE, for the Python interface
+extern const int mt_attribute_size;
+
 typedef struct
 {
   INT_TYPE parent;
@@ -33,19 +41,30 @@ typedef struct
 
 typedef struct
 {
-  FLOAT_TYPE volume;
-  FLOAT_TYPE power;
+  ATTRIBUTE_TYPE volume;
+  ATTRIBUTE_TYPE power;
 } mt_node_attributes;
 
+#define MT_NUM_MOMENTS 5
+
+// Optional attributes of a node's component, merged during flooding
 typedef struct
 {
-  SHORT_TYPE x;
-  SHORT_TYPE y;
-} mt_image_location;
+  // Sums of x, y, x^2, y^2 and xy, unweighted and weighted by pixel value
+  double sums[MT_NUM_MOMENTS];
+  double weighted_sums[MT_NUM_MOMENTS];
+  double flux;
+  // Bounding box
+  INT_TYPE x_min;
+  INT_TYPE y_min;
+  INT_TYPE x_max;
+  INT_TYPE y_max;
+} mt_node_moments;
 
 typedef struct
 {
-  mt_image_location location;
+  // Index of the pixel in the image
+  INT_TYPE index;
   PIXEL_TYPE value;
 } mt_pixel;
 
@@ -59,6 +78,15 @@ typedef struct
   int width;
 } mt_connectivity;
 
+typedef struct
+{
+  // Neighbour positions relative to a pixel
+  INT_TYPE dx[MT_MAX_NEIGHBOURS];
+  INT_TYPE dy[MT_MAX_NEIGHBOURS];
+  INT_TYPE offsets[MT_MAX_NEIGHBOURS];
+  int num_neighbours;
+} mt_neighbours;
+
 typedef struct
 {
   mt_node *root;
@@ -69,12 +97,30 @@ typedef struct
   image img;
   mt_connectivity connectivity;  
   int verbosity_level;
+  // Moments of each node's component, or NULL if they are not computed
+  mt_node_moments *nodes_moments;
 } mt_data;
 
 void* mt_malloc(size_t size);
 
 void mt_flood(mt_data* mt);
+void mt_flood_components(mt_data* mt, int join_components);
+void mt_flood_parallel(mt_data* mt, int num_threads);
+void mt_flood_union_find(mt_data* mt);
+void mt_flood_levels(mt_data* mt, INT_TYPE levels, PIXEL_TYPE base,
+  PIXEL_TYPE step);
+void mt_rebase_attributes(mt_data* mt, INT_TYPE start, INT_TYPE end);
+void mt_canonical_level_roots(mt_data* mt);
+void mt_set_connectivity(mt_data* mt, int connectivity);
+void mt_set_mask(mt_data* mt, const uint8_t* mask);
+void mt_init_neighbours(mt_data* mt, mt_neighbours* neighbours);
+void mt_print_connectivity(mt_data* mt);
+void mt_alloc_moments(mt_data* mt);
+void mt_pixel_moments(mt_data* mt, INT_TYPE idx);
+void mt_add_moments(mt_node_moments* to, const mt_node_moments* from);
 void mt_init(mt_data* mt, const image* img);
+void mt_use_arrays(mt_data* mt, mt_node* nodes,
+  mt_node_attributes* nodes_attributes, INT_TYPE root_index);
 void mt_free(mt_data* mt);
 
 void mt_set_verbosity_level(mt_data* mt, int verbosity_level);
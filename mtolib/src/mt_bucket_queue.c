@@ -0,0 +1,123 @@
+#include "mt_bucket_queue.h"
+
+// Bucket queue
+
+void mt_bucket_queue_alloc_entries(mt_bucket_queue* queue, const mt_data* mt,
+  INT_TYPE levels, PIXEL_TYPE base, PIXEL_TYPE step)
+{
+  queue->num_buckets = levels + 1;
+  queue->base = base;
+  queue->step = step;
+
+  queue->heads = safe_malloc(queue->num_buckets * sizeof(INT_TYPE));
+  queue->tails = safe_calloc(queue->num_buckets, sizeof(INT_TYPE));
+  queue->occupied = safe_calloc(
+    (queue->num_buckets + MT_BUCKET_QUEUE_WORD_BITS - 1) /
+    MT_BUCKET_QUEUE_WORD_BITS, sizeof(uint64_t));
+
+  // Each pixel which is not masked is queued once, so buckets are sized by
+  // the histogram of those pixels
+  INT_TYPE i;
+  INT_TYPE total = 0;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    if (!MT_IS_MASKED(mt, i))
+    {
+      ++queue->tails[mt_bucket_queue_level(queue, mt->img.data[i])];
+      ++total;
+    }
+  }
+
+  queue->entries = safe_malloc(total * sizeof(mt_pixel));
+
+  total = 0;
+  for (i = 0; i != queue->num_buckets; ++i)
+  {
+    INT_TYPE count = queue->tails[i];
+    queue->heads[i] = total;
+    queue->tails[i] = total;
+    total += count;
+  }
+
+  queue->num_entries = 0;
+  queue->top = -1;
+}
+
+void mt_bucket_queue_free_entries(mt_bucket_queue* queue)
+{
+  free(queue->entries);
+  free(queue->heads);
+  free(queue->tails);
+  free(queue->occupied);
+
+  queue->entries = NULL;
+  queue->heads = NULL;
+  queue->tails = NULL;
+  queue->occupied = NULL;
+}
+
+static INT_TYPE mt_bucket_queue_highest(const mt_bucket_queue* queue,
+  INT_TYPE level)
+{
+  // Find the highest bucket at or below a level which is not empty
+
+  INT_TYPE word = level / MT_BUCKET_QUEUE_WORD_BITS;
+  int bit = level % MT_BUCKET_QUEUE_WORD_BITS;
+
+  // Mask out buckets above the level
+  uint64_t bits = queue->occupied[word] & (((uint64_t)2 << bit) - 1);
+
+  while (bits == 0)
+  {
+    if (word == 0)
+    {
+      return -1;
+    }
+
+    bits = queue->occupied[--word];
+  }
+
+  return word * MT_BUCKET_QUEUE_WORD_BITS + MT_BUCKET_QUEUE_WORD_BITS - 1 -
+    __builtin_clzll(bits);
+}
+
+void mt_bucket_queue_insert(mt_bucket_queue* queue, const mt_pixel* pixel)
+{
+  INT_TYPE level = mt_bucket_queue_level(queue, pixel->value);
+
+  if (queue->heads[level] == queue->tails[level])
+  {
+    queue->occupied[level / MT_BUCKET_QUEUE_WORD_BITS] |=
+      (uint64_t)1 << (level % MT_BUCKET_QUEUE_WORD_BITS);
+  }
+
+  queue->entries[queue->tails[level]++] = *pixel;
+
+  if (level > queue->top)
+  {
+    queue->top = level;
+  }
+
+  ++queue->num_entries;
+}
+
+const mt_pixel* mt_bucket_queue_remove(mt_bucket_queue* queue)
+{
+  INT_TYPE level = queue->top;
+
+  // Pixels at the same level are removed in the order they were inserted, so
+  // the pixel being flooded stays at the top while its neighbours are queued
+  const mt_pixel* entry = queue->entries + queue->heads[level]++;
+
+  if (queue->heads[level] == queue->tails[level])
+  {
+    queue->occupied[level / MT_BUCKET_QUEUE_WORD_BITS] &=
+      ~((uint64_t)1 << (level % MT_BUCKET_QUEUE_WORD_BITS));
+
+    queue->top = mt_bucket_queue_highest(queue, level);
+  }
+
+  --queue->num_entries;
+
+  return entry;
+}
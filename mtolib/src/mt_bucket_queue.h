@@ -0,0 +1,72 @@
+#include "maxtree.h"
+
+#ifndef MT_BUCKET_QUEUE_H
+#define MT_BUCKET_QUEUE_H
+
+#include <math.h>
+
+// Hierarchical queue for images quantised to a fixed number of levels.
+// Each level has a first-in first-out bucket of pixels, and a bitmap records
+// which buckets are not empty. Non-finite values share one bucket above the
+// highest level.
+
+#define MT_BUCKET_QUEUE_WORD_BITS 64
+
+#define MT_BUCKET_QUEUE_TOP(MT_QUEUE_PTR) ((MT_QUEUE_PTR)->entries + \
+  (MT_QUEUE_PTR)->heads[(MT_QUEUE_PTR)->top])
+#define MT_BUCKET_QUEUE_NOT_EMPTY(MT_QUEUE_PTR) ((MT_QUEUE_PTR)->num_entries > 0)
+#define MT_BUCKET_QUEUE_EMPTY(MT_QUEUE_PTR) ((MT_QUEUE_PTR)->num_entries == 0)
+
+typedef struct
+{
+  mt_pixel* entries;
+  // Positions of the first and one past the last entry of each bucket
+  INT_TYPE* heads;
+  INT_TYPE* tails;
+  uint64_t* occupied;
+  INT_TYPE num_buckets;
+  INT_TYPE num_entries;
+  // Highest bucket which is not empty
+  INT_TYPE top;
+  PIXEL_TYPE base;
+  PIXEL_TYPE step;
+} mt_bucket_queue;
+
+static inline INT_TYPE mt_bucket_queue_level(const mt_bucket_queue* queue,
+  PIXEL_TYPE value)
+{
+  // Find the bucket of a pixel value
+
+  if (!isfinite(value))
+  {
+    return queue->num_buckets - 1;
+  }
+
+  if (queue->step <= 0)
+  {
+    return 0;
+  }
+
+  INT_TYPE level = (INT_TYPE)((value - queue->base) / queue->step + 0.5);
+
+  if (level < 0)
+  {
+    return 0;
+  }
+
+  if (level > queue->num_buckets - 2)
+  {
+    return queue->num_buckets - 2;
+  }
+
+  return level;
+}
+
+void mt_bucket_queue_alloc_entries(mt_bucket_queue* queue, const mt_data* mt,
+  INT_TYPE levels, PIXEL_TYPE base, PIXEL_TYPE step);
+void mt_bucket_queue_free_entries(mt_bucket_queue* queue);
+
+void mt_bucket_queue_insert(mt_bucket_queue* queue, const mt_pixel* pixel);
+const mt_pixel* mt_bucket_queue_remove(mt_bucket_queue* queue);
+
+#endif
@@ -1,13 +1,28 @@
 #include "mt_heap.h"
 
+#include <assert.h>
+
 // Heap
 
-void mt_heap_alloc_entries(mt_heap* heap)
+void mt_heap_alloc_entries(mt_heap* heap, INT_TYPE max_entries)
 {
-  heap->entries =
-    safe_malloc(MT_HEAP_NUM_ENTRIES_BYTES(MT_HEAP_INIT_SIZE));
+  // Allocate room for every entry the heap will hold, so that it is never
+  // resized. Each pixel is queued at most once, so the image size is enough
+  // for a flood. Pages of a large allocation are only used once touched.
+
+  size_t bytes = (MT_HEAP_ROOT + (size_t)max_entries) * sizeof(mt_pixel);
+  bytes = (bytes + MT_HEAP_ALIGNMENT - 1) / MT_HEAP_ALIGNMENT *
+    MT_HEAP_ALIGNMENT;
+
+  heap->entries = aligned_alloc(MT_HEAP_ALIGNMENT, bytes);
+
+  if (heap->entries == NULL)
+  {
+    error("aligned_alloc(%zu) failed.\n", bytes);
+  }
+
   heap->num_entries = 0;
-  heap->max_entries = MT_HEAP_INIT_SIZE; 
+  heap->max_entries = max_entries;
 }
 
 void mt_heap_free_entries(mt_heap* heap)
@@ -17,28 +32,17 @@ void mt_heap_free_entries(mt_heap* heap)
   heap->entries = NULL;
 }
 
-void mt_heap_resize(mt_heap* heap)
-{
-  heap->max_entries <<= 1;
-  
-  heap->entries = safe_realloc(heap->entries,
-    MT_HEAP_NUM_ENTRIES_BYTES(heap->max_entries));
-}
-
 void mt_heap_insert(mt_heap* heap, const mt_pixel* pixel)
 {
-  if (heap->max_entries == heap->num_entries)
-  {
-    mt_heap_resize(heap);
-  }
-  
-  INT_TYPE index = heap->num_entries + 1;
+  assert(heap->num_entries < heap->max_entries);
+
+  INT_TYPE index = MT_HEAP_ROOT + heap->num_entries;
   mt_pixel* entry = heap->entries + index;
   PIXEL_TYPE pix_value = pixel->value;
   
   // Up-heap.
   
-  while (index != 1)  
+  while (index != MT_HEAP_ROOT)
   {
     INT_TYPE up_index = MT_HEAP_UP(index);
     mt_pixel* up_entry = heap->entries + up_index;
@@ -61,44 +65,52 @@ void mt_heap_insert(mt_heap* heap, const mt_pixel* pixel)
 
 const mt_pixel* mt_heap_remove(mt_heap* heap)
 {
-  INT_TYPE index = 1;                         
+  INT_TYPE index = MT_HEAP_ROOT;
   mt_pixel* entry = heap->entries + index;    
   mt_pixel root_entry = *entry;               // Save root entry.
   
                                               // Entry to down-heap.
-  mt_pixel* last_entry = heap->entries + heap->num_entries;
+  INT_TYPE last_index = MT_HEAP_ROOT + heap->num_entries - 1;
+  mt_pixel* last_entry = heap->entries + last_index;
+  PIXEL_TYPE last_value = last_entry->value;
   
   // Down-heap.
   
   while (TRUE)
   {
-    index = MT_HEAP_DOWN(index, 0);
+    index = MT_HEAP_DOWN(index);
     
-    if (index > heap->num_entries)
+    if (index >= last_index)
     {
       break;
     }
     
-    mt_pixel* down = heap->entries + index; // Left branch.
-    
-    if (index < heap->num_entries)
+    // Find the largest child, other than the last entry
+    INT_TYPE end = index + MT_HEAP_ARITY;
+    if (end > last_index)
     {
-      mt_pixel* down_right = down + 1;      // Right branch.
-    
-      if (down_right->value > down->value)
+      end = last_index;
+    }
+
+    mt_pixel* down = heap->entries + index;
+
+    INT_TYPE child;
+    for (child = index + 1; child < end; ++child)
+    {
+      if (heap->entries[child].value > down->value)
       {
-        ++down;
-        ++index;
+        down = heap->entries + child;
       }
-    }      
+    }
    
-    if (down->value <= last_entry->value)
+    if (down->value <= last_value)
     {
       break;
     }
     
     *entry = *down;
     entry = down;
+    index = down - heap->entries;
   }
   
   *entry = *last_entry;
@@ -3,14 +3,21 @@
 #ifndef MT_HEAP_H
 #define MT_HEAP_H
 
-#define MT_HEAP_DOWN(INDEX, N) (((INDEX) << 1) + (N))
-#define MT_HEAP_UP(INDEX) ((INDEX) >> 1)
+// A 4-ary max heap. The root is at index MT_HEAP_ROOT, so that the children of
+// each entry are MT_HEAP_ARITY consecutive entries starting at a multiple of
+// MT_HEAP_ARITY, and share a cache line.
 
-#define MT_HEAP_NUM_ENTRIES_BYTES(X) (((X) + 1) * sizeof(mt_pixel))
+#define MT_HEAP_ARITY 4
+#define MT_HEAP_ROOT (MT_HEAP_ARITY - 1)
 
-#define MT_HEAP_INIT_SIZE 1024
+#define MT_HEAP_DOWN(INDEX) (MT_HEAP_ARITY * ((INDEX) - MT_HEAP_ROOT) + \
+  MT_HEAP_ROOT + 1)
+#define MT_HEAP_UP(INDEX) (((INDEX) - MT_HEAP_ROOT - 1) / MT_HEAP_ARITY + \
+  MT_HEAP_ROOT)
 
-#define MT_HEAP_TOP(MT_HEAP_PTR) ((MT_HEAP_PTR)->entries + 1)
+#define MT_HEAP_ALIGNMENT 64
+
+#define MT_HEAP_TOP(MT_HEAP_PTR) ((MT_HEAP_PTR)->entries + MT_HEAP_ROOT)
 #define MT_HEAP_SIZE(MT_HEAP_PTR) ((MT_HEAP_PTR)->num_entries)
 #define MT_HEAP_NOT_EMPTY(MT_HEAP_PTR) ((MT_HEAP_PTR)->num_entries > 0)
 #define MT_HEAP_EMPTY(MT_HEAP_PTR) ((MT_HEAP_PTR)->num_entries == 0)
@@ -22,7 +29,7 @@ typedef struct
   INT_TYPE max_entries;
 } mt_heap;
 
-void mt_heap_alloc_entries(mt_heap* heap);
+void mt_heap_alloc_entries(mt_heap* heap, INT_TYPE max_entries);
 void mt_heap_free_entries(mt_heap* heap);
 
 void mt_heap_insert(mt_heap* heap, const mt_pixel* pixel);
@@ -15,16 +15,66 @@ static const FLOAT_TYPE q2 = 2.091126298053044e+05;
 static const FLOAT_TYPE q3 = 1.424803575269314e+06;
 
 
+// Data of test 4: the minimum distance, and a table of the rejection boundary
+// by area for significance levels other than 1e-6
+typedef struct
+{
+  FLOAT_TYPE min_distance;
+  // Boundary for areas from 1 to num_boundaries, or NULL to use the fit for
+  // alpha = 1e-6
+  FLOAT_TYPE *boundaries;
+  INT_TYPE num_boundaries;
+  // Normal quantiles of alpha and 1e-6, and the area of one independent
+  // sample of the smoothed noise, to extend the table to larger areas
+  double z_alpha;
+  double z_default;
+  double correlation_area;
+  // Quantile ratio at the end of the table
+  double end_ratio;
+} mt_node_test_4_data;
+
+static double mt_quantile_ratio(const mt_node_test_4_data *data, INT_TYPE area)
+{
+  // Ratio of the chi-square quantiles of alpha and 1e-6 for the degrees of
+  // freedom of an area, by the Wilson-Hilferty approximation
+
+  double c = 2 / (9 * (area / data->correlation_area));
+
+  double ratio = (1 - c + data->z_alpha * sqrt(c)) /
+    (1 - c + data->z_default * sqrt(c));
+
+  return ratio * ratio * ratio;
+}
+
+static FLOAT_TYPE mt_fitted_boundary(INT_TYPE area)
+{
+  // Rational fit of the rejection boundary for alpha = 1e-6
+
+  if (area > max_area)
+  {
+    area = max_area;
+  }
+
+  FLOAT_TYPE area_to_2 = area * area;
+  FLOAT_TYPE area_to_3 = area_to_2 * area;
+  
+  FLOAT_TYPE x = p1 * area_to_3 + p2 * area_to_2 + p3 * area + p4;
+  x /= area_to_3 + q1 * area_to_2 + q2 * area + q3;
+
+  return x;
+}
+
 int mt_node_test_4(mt_object_data* mt_o, INT_TYPE node_idx)
 {
   // Point to max tree data
   mt_data* mt = mt_o->mt;
 
+  const mt_node_test_4_data *data = mt_o->node_significance_test_data;
+
   FLOAT_TYPE variance =
     mt_noise_variance(mt_o, node_idx, MT_NO_MAX_DISTANCE);
     
-  FLOAT_TYPE min_distance =
-    *((FLOAT_TYPE *)mt_o->node_significance_test_data);
+  FLOAT_TYPE min_distance = data->min_distance;
     
   if (min_distance > 0 &&
     MT_DISTANCE(node_idx) / sqrt(variance) < min_distance)
@@ -38,29 +88,37 @@ int mt_node_test_4(mt_object_data* mt_o, INT_TYPE node_idx)
   INT_TYPE area = mt->nodes[node_idx].area;
     
   FLOAT_TYPE power_normalized = power / variance / area;
-  
-  if (area > max_area)
-  {
-    area = max_area;
-  }  
 
-  FLOAT_TYPE area_to_2 = area * area;
-  FLOAT_TYPE area_to_3 = area_to_2 * area;
-  
-  FLOAT_TYPE x = p1 * area_to_3 + p2 * area_to_2 + p3 * area + p4;
-  x /= area_to_3 + q1 * area_to_2 + q2 * area + q3;
+  FLOAT_TYPE x;
+
+  if (data->boundaries == NULL)
+  {
+    x = mt_fitted_boundary(area);
+  }
+  else if (area <= data->num_boundaries)
+  {
+    x = data->boundaries[area - 1];
+  }
+  else
+  {
+    x = data->boundaries[data->num_boundaries - 1] *
+      mt_quantile_ratio(data, area) / data->end_ratio;
+  }
 
   return power_normalized > x;
 }
 
 void mt_node_test_4_data_free(mt_object_data* mt_o)
 {
-  free(mt_o->node_significance_test_data);
+  mt_node_test_4_data *data = mt_o->node_significance_test_data;
+
+  free(data->boundaries);
+  free(data);
   
   mt_o->node_significance_test_data = NULL;
 }
 
-void mt_use_node_test_4(mt_object_data* mt_o)
+static void mt_node_test_4_init(mt_object_data* mt_o)
 {
   if (mt_o->mt->verbosity_level)
   {
@@ -68,23 +126,52 @@ void mt_use_node_test_4(mt_object_data* mt_o)
       " 3x3 Gaussian filter with FWHM = 2).\n");
   }
 
-  if (mt_o->paras->alpha != 1e-6)
-  {
-    error("Error: rejection boundary only available "
-      "for alpha = 1E-6.\n");
-  }
-
   node_significance_test_data_clear(mt_o);
 
-  mt_o->node_significance_test_data = malloc(sizeof(FLOAT_TYPE));
+  mt_node_test_4_data *data = safe_calloc(1, sizeof(*data));
+  data->min_distance = mt_o->paras->min_distance;
 
-  *((FLOAT_TYPE *)mt_o->node_significance_test_data) =
-    mt_o->paras->min_distance;
+  mt_o->node_significance_test_data = data;
 
   mt_o->node_significance_test =
     mt_node_test_4;
 
   mt_o->node_significance_test_data_free =
     mt_node_test_4_data_free;
+}
+
+void mt_use_node_test_4(mt_object_data* mt_o)
+{
+  if (mt_o->paras->alpha != 1e-6)
+  {
+    error("Error: rejection boundary only available "
+      "for alpha = 1E-6 without a boundary table.\n");
+  }
+
+  mt_node_test_4_init(mt_o);
+}
+
+void mt_use_node_test_4_boundaries(mt_object_data* mt_o,
+  const FLOAT_TYPE *boundaries, INT_TYPE num_boundaries, double z_alpha,
+  double z_default, double correlation_area)
+{
+  // Use test 4 with a rejection boundary tabulated by area for the
+  // significance level, which is copied. Larger areas scale the last entry by
+  // the ratio of the chi-square quantiles of alpha and 1e-6.
+
+  assert(num_boundaries > 0);
+
+  mt_node_test_4_init(mt_o);
+
+  mt_node_test_4_data *data = mt_o->node_significance_test_data;
+
+  data->boundaries = safe_malloc(num_boundaries * sizeof(*data->boundaries));
+  memcpy(data->boundaries, boundaries,
+    num_boundaries * sizeof(*data->boundaries));
 
+  data->num_boundaries = num_boundaries;
+  data->z_alpha = z_alpha;
+  data->z_default = z_default;
+  data->correlation_area = correlation_area;
+  data->end_ratio = mt_quantile_ratio(data, num_boundaries);
 }
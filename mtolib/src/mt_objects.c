@@ -8,53 +8,132 @@
 
 
 
+// Digits of the keys in each pass of mt_sort_level_roots
+#define MT_RADIX_BITS 11
+#define MT_RADIX_SIZE (1 << MT_RADIX_BITS)
+#define MT_RADIX_PASSES \
+  ((8 * (int)sizeof(PIXEL_BITS_TYPE) + MT_RADIX_BITS - 1) / MT_RADIX_BITS)
+
+static PIXEL_BITS_TYPE mt_value_key(PIXEL_TYPE value)
+{
+  // Map an image value to an unsigned key in the same order. Adding zero
+  // turns -0 into 0, which it compares equal to.
+  PIXEL_BITS_TYPE key;
+  value += 0;
+  memcpy(&key, &value, sizeof(key));
+
+  const PIXEL_BITS_TYPE sign_bit = (PIXEL_BITS_TYPE)1 << (8 * sizeof(key) - 1);
+
+  return (key & sign_bit) ? ~key : key | sign_bit;
+}
+
+static void mt_sort_level_roots(mt_data* mt, INT_TYPE* indices, INT_TYPE len,
+  INT_TYPE (*counts)[MT_RADIX_SIZE])
+{
+  // Sort level roots in index order by value, with stable radix passes over
+  // the value digits, so that ties stay in index order. Parents have lower
+  // values, so come before their children, and the order does not depend on
+  // the order in which the tree was built. The counts of each digit are
+  // given, and passes where every digit is the same are skipped.
+
+  INT_TYPE *buffer = safe_malloc(len * sizeof(*buffer));
+  INT_TYPE *from = indices;
+  INT_TYPE *to = buffer;
+
+  int pass;
+  for (pass = 0; pass != MT_RADIX_PASSES; ++pass)
+  {
+    int shift = pass * MT_RADIX_BITS;
+
+    INT_TYPE total = 0;
+    INT_TYPE digit;
+    for (digit = 0; digit != MT_RADIX_SIZE && counts[pass][digit] != len;
+      ++digit)
+    {
+      INT_TYPE count = counts[pass][digit];
+      counts[pass][digit] = total;
+      total += count;
+    }
+
+    if (digit != MT_RADIX_SIZE)
+    {
+      continue;
+    }
+
+    INT_TYPE i;
+    for (i = 0; i != len; ++i)
+    {
+      PIXEL_BITS_TYPE key = mt_value_key(mt->img.data[from[i]]);
+      to[counts[pass][(key >> shift) & (MT_RADIX_SIZE - 1)]++] = from[i];
+    }
+
+    INT_TYPE *swap = from;
+    from = to;
+    to = swap;
+  }
+
+  if (from != indices)
+  {
+    memcpy(indices, from, len * sizeof(*indices));
+  }
+
+  free(buffer);
+}
+
 void mt_relevant_nodes(mt_object_data* mt_o)
 {
-  // Sort the nodes by image value.
+  // List the level roots other than the root, sorted by image value and then
+  // by index, so that every node comes after its ancestors and ties between
+  // main branches are broken in the same way by every engine.
   // Do not include the root or nodes where the parent has the same image value.
 
   mt_data *mt = mt_o->mt;
 
-  // Create a heap
-  mt_heap heap;
-  mt_heap_alloc_entries(&heap);
-  
-  // Iterate over image pixels
-  SHORT_TYPE y;
-  for (y = 0; y != mt->img.height; ++y)
+  INT_TYPE (*counts)[MT_RADIX_SIZE] = safe_calloc(MT_RADIX_PASSES,
+    sizeof(*counts));
+
+  mt_o->relevant_indices = safe_malloc(mt->img.size *
+    sizeof(*mt_o->relevant_indices));
+
+  INT_TYPE num_level_roots = 0;
+
+  // Find the level roots in index order, and count the digits of their values
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
   {
-    SHORT_TYPE x;
-    for (x = 0; x != mt->img.width; ++x)
+    INT_TYPE parent_idx = mt->nodes[i].parent;
+
+    // Skip the root node and masked pixels
+    // Skip nodes where the parent is at the same level as the node
+    if (MT_IS_ROOT(mt, i) || parent_idx == MT_MASKED ||
+      mt->img.data[parent_idx] == mt->img.data[i])
     {
+      continue;
+    }
 
-      // Get the pixel index and parent index
-      INT_TYPE i = y * mt->img.width + x;
-      INT_TYPE parent_idx = mt->nodes[i].parent;
+    mt_o->relevant_indices[num_level_roots++] = i;
 
-      // Skip the root node
-      // Skip nodes where the parent is at the same level as the node
-      if (MT_IS_ROOT(mt, i) ||
-        mt->img.data[parent_idx] == mt->img.data[i])
-      {
-        //printf("Root: %i\n", i);
-        continue;
-      }
+    PIXEL_BITS_TYPE key = mt_value_key(mt->img.data[i]);
 
-      // Create a pixel object and put it on the heap
-      mt_pixel pixel;
-      pixel.location.x = x;
-      pixel.location.y = y;
-      pixel.value = mt->img.data[i];
-      mt_heap_insert(&heap, &pixel);
+    int pass;
+    for (pass = 0; pass != MT_RADIX_PASSES; ++pass)
+    {
+      ++counts[pass][(key >> (pass * MT_RADIX_BITS)) & (MT_RADIX_SIZE - 1)];
     }
   }
 
-  // Get the size of the heap and allocate an array of the same length
-  // Relevant indices stores level roots
-  mt_o->relevant_indices_len = MT_HEAP_SIZE(&heap);
-  mt_o->relevant_indices = malloc(MT_HEAP_SIZE(&heap) *
-    sizeof(*mt_o->relevant_indices));
- 
+  mt_o->relevant_indices_len = num_level_roots;
+
+  // Release the unused part of the list
+  if (num_level_roots > 0)
+  {
+    mt_o->relevant_indices = safe_realloc(mt_o->relevant_indices,
+      num_level_roots * sizeof(*mt_o->relevant_indices));
+  }
+
+  mt_sort_level_roots(mt, mt_o->relevant_indices, num_level_roots, counts);
+
+  free(counts);
 
   // Print number of relevant nodes
   if (mt->verbosity_level > 1)
@@ -63,19 +142,6 @@ void mt_relevant_nodes(mt_object_data* mt_o)
       mt_o->relevant_indices_len);
       
   }
-
-  // Move nodes from heap into relevant indices list
-  // Produces list of root node indices sorted by pixel value
-  INT_TYPE i;
-  for (i = mt_o->relevant_indices_len; i--;)
-  {
-    const mt_pixel* removed = mt_heap_remove(&heap);
-    mt_o->relevant_indices[i] = removed->location.x +
-      removed->location.y * mt->img.width;
-  }
-
-  // Free heap memory
-  mt_heap_free_entries(&heap);
 }
 
 void mt_update_parent_main_branch(
@@ -98,17 +164,17 @@ void mt_update_parent_main_branch(
   // If so, set this node as the ancestor's significant descendant
   if (MT_HAVE_SIGNIFICANT_DESCENDANT(ancestor_idx))
   {
-    if (mt->nodes[mt_o->main_branches[ancestor_idx]].area <
+    if (mt->nodes[MT_MAIN_BRANCH(ancestor_idx)].area <
       mt->nodes[node_idx].area)
     {
-      mt_o->main_branches[ancestor_idx] = node_idx;
+      MT_MAIN_BRANCH(ancestor_idx) = node_idx;
     }
   }
   else
   // If the ancestor has no significant descendant, set this node as it
   {
     MT_SET_HAVE_SIGNIFICANT_DESCENDANT(ancestor_idx);
-    mt_o->main_branches[ancestor_idx] = node_idx;
+    MT_MAIN_BRANCH(ancestor_idx) = node_idx;
   }
 }
 
@@ -210,6 +276,136 @@ void mt_significant_nodes_down(mt_object_data* mt_o)
   mt_o->num_significant_nodes = num_significant;
 }
 
+void mt_significant_nodes_batched(mt_object_data* mt_o)
+{
+  // Test the relevant nodes in batches of equal depth in the tree, so that
+  // every node's ancestors are tested before it, with one call of the batch
+  // significance test per batch. Nodes are tested one at a time if there is
+  // no batch test. Gives the same results as mt_significant_nodes_up.
+
+  mt_data *mt = mt_o->mt;
+
+  INT_TYPE num_nodes = mt_o->relevant_indices_len;
+
+  // Find the depth of each relevant node by its dense index, and then the
+  // root's. Every node comes after its ancestors.
+  INT_TYPE *depths = safe_malloc((num_nodes + 1) * sizeof(*depths));
+  depths[num_nodes] = 0;
+
+  INT_TYPE max_depth = 0;
+
+  INT_TYPE i;
+  for (i = 0; i != num_nodes; ++i)
+  {
+    INT_TYPE parent_idx = mt->nodes[mt_o->relevant_indices[i]].parent;
+
+    depths[i] = depths[mt_o->branch_indices[parent_idx]] + 1;
+
+    if (depths[i] > max_depth)
+    {
+      max_depth = depths[i];
+    }
+  }
+
+  // Sort the nodes by depth with a counting sort, keeping their order
+  // within each depth
+  INT_TYPE *batch_starts = safe_calloc(max_depth + 2, sizeof(*batch_starts));
+
+  for (i = 0; i != num_nodes; ++i)
+  {
+    ++batch_starts[depths[i] + 1];
+  }
+
+  INT_TYPE depth;
+  for (depth = 1; depth <= max_depth + 1; ++depth)
+  {
+    batch_starts[depth] += batch_starts[depth - 1];
+  }
+
+  INT_TYPE *batches = safe_malloc(num_nodes * sizeof(*batches));
+  INT_TYPE *batch_ends = safe_malloc((max_depth + 1) * sizeof(*batch_ends));
+  memcpy(batch_ends, batch_starts, (max_depth + 1) * sizeof(*batch_ends));
+
+  for (i = 0; i != num_nodes; ++i)
+  {
+    batches[batch_ends[depths[i]]++] = mt_o->relevant_indices[i];
+  }
+
+  free(batch_ends);
+  free(depths);
+
+  uint8_t *results = safe_malloc(num_nodes * sizeof(*results));
+
+  INT_TYPE num_significant = 0;
+
+  for (depth = 1; depth <= max_depth; ++depth)
+  {
+    INT_TYPE *batch = batches + batch_starts[depth];
+    INT_TYPE batch_size = batch_starts[depth + 1] - batch_starts[depth];
+
+    // Set the closest significant ancestors, whose tests are all done
+    INT_TYPE j;
+    for (j = 0; j != batch_size; ++j)
+    {
+      INT_TYPE node_idx = batch[j];
+      INT_TYPE parent_idx = mt->nodes[node_idx].parent;
+
+      if (MT_SIGNIFICANT(parent_idx))
+      {
+        mt_o->closest_significant_ancestors[node_idx] = parent_idx;
+      }
+      else if (MT_HAVE_SIGNIFICANT_ANCESTOR(parent_idx))
+      {
+        mt_o->closest_significant_ancestors[node_idx] =
+          mt_o->closest_significant_ancestors[parent_idx];
+      }
+    }
+
+    if (mt_o->node_significance_test_batch != NULL)
+    {
+      mt_o->node_significance_test_batch(mt_o, batch, batch_size, results);
+    }
+    else
+    {
+      for (j = 0; j != batch_size; ++j)
+      {
+        results[j] = mt_o->node_significance_test(mt_o, batch[j]) != 0;
+      }
+    }
+
+    for (j = 0; j != batch_size; ++j)
+    {
+      if (results[j])
+      {
+        MT_SET_SIGNIFICANT(batch[j]);
+        ++num_significant;
+      }
+    }
+  }
+
+  free(results);
+  free(batches);
+  free(batch_starts);
+
+  // Set the main branches in the order of mt_significant_nodes_up, so that
+  // ties in area are broken in the same way
+  for (i = 0; i != num_nodes; ++i)
+  {
+    if (MT_SIGNIFICANT(mt_o->relevant_indices[i]))
+    {
+      mt_update_parent_main_branch(mt_o, mt_o->relevant_indices[i]);
+    }
+  }
+
+  if (mt->verbosity_level > 1)
+  {
+    printf("%d significant nodes, tested in %d batches.\n", num_significant,
+      max_depth);
+  }
+
+  mt_o->num_significant_nodes = num_significant;
+}
+
 void mt_find_objects(mt_object_data* mt_o)
 {
   // Count significant nodes and set object markers
@@ -243,7 +439,7 @@ void mt_find_objects(mt_object_data* mt_o)
         // mark it as a nested object
     INT_TYPE parent = mt_o->closest_significant_ancestors[i];
 
-    if (mt_o->main_branches[parent] != i)
+    if (MT_MAIN_BRANCH(parent) != i)
     {
       ++num_objects_nested;
       MT_SET_OBJECT(i);
@@ -276,8 +472,8 @@ void mt_main_power_branches(mt_object_data* mt_o)
   // Iterate over image pixels
   for (i = 0; i != mt->img.size; ++i)  
   {
-    // Skip the root
-    if (MT_IS_ROOT(mt, i))
+    // Skip the root and masked pixels
+    if (MT_IS_ROOT(mt, i) || MT_IS_MASKED(mt, i))
     {
       continue;
     }
@@ -288,17 +484,17 @@ void mt_main_power_branches(mt_object_data* mt_o)
     // If the parent has a descendant, check if this node has a higher power and set accordingly
     if (MT_HAVE_DESCENDANT(parent))
     {
-      if (mt->nodes_attributes[mt_o->main_power_branches[parent]].power
+      if (mt->nodes_attributes[MT_MAIN_POWER_BRANCH(parent)].power
 			< mt->nodes_attributes[i].power)
       {
-        mt_o->main_power_branches[parent] = i;
+        MT_MAIN_POWER_BRANCH(parent) = i;
       }
     }
     else
     // If the parent has no marked descendant, set this as the highest power descendant
     {
       MT_SET_HAVE_DESCENDANT(parent);
-      mt_o->main_power_branches[parent] = i;
+      MT_MAIN_POWER_BRANCH(parent) = i;
     }
   }
 }
@@ -344,11 +540,11 @@ void mt_move_up(mt_object_data* mt_o)
     
       if (MT_HAVE_SIGNIFICANT_DESCENDANT(next_idx))
       {
-        next_idx = mt_o->main_branches[next_idx];        
+        next_idx = MT_MAIN_BRANCH(next_idx);        
       }
       else if (MT_HAVE_DESCENDANT(next_idx))
       {
-        next_idx = mt_o->main_power_branches[next_idx];
+        next_idx = MT_MAIN_POWER_BRANCH(next_idx);
       }
       else
       {
@@ -385,11 +581,47 @@ void mt_objects_init(mt_object_data *mt_o)
 
   mt_o->flags = safe_calloc(img_size, sizeof(*mt_o->flags));
 
-  mt_o->main_branches = safe_malloc(img_size *
+  // Allocated for the level roots by mt_index_level_roots
+  mt_o->main_branches = NULL;
+  mt_o->main_power_branches = NULL;
+}
+
+void mt_index_level_roots(mt_object_data *mt_o)
+{
+  // Number the relevant nodes and the root densely, and allocate the main
+  // branch arrays for them alone. The numbers are kept in branch_indices, or
+  // in object_ids, which is not used until mt_object_ids, if it is not set.
+
+  mt_data *mt = mt_o->mt;
+
+  if (mt_o->branch_indices == NULL)
+  {
+    mt_o->branch_indices = mt_o->object_ids;
+  }
+
+  INT_TYPE i;
+  for (i = 0; i != mt_o->relevant_indices_len; ++i)
+  {
+    mt_o->branch_indices[mt_o->relevant_indices[i]] = i;
+  }
+
+  mt_o->branch_indices[mt->root - mt->nodes] = mt_o->relevant_indices_len;
+
+  mt_o->main_branches = safe_malloc((mt_o->relevant_indices_len + 1) *
     sizeof(*mt_o->main_branches));
 
-  mt_o->main_power_branches = safe_malloc(img_size *
+  mt_o->main_power_branches = safe_malloc((mt_o->relevant_indices_len + 1) *
     sizeof(*mt_o->main_power_branches));
+
+  if (mt->verbosity_level > 1)
+  {
+    printf("Object data: %.1f bytes per pixel.\n",
+      (double)(mt->img.size * (sizeof(*mt_o->flags) +
+      sizeof(*mt_o->closest_significant_ancestors) +
+      sizeof(*mt_o->object_ids)) + mt_o->relevant_indices_len *
+      (sizeof(*mt_o->relevant_indices) + sizeof(*mt_o->main_branches) +
+      sizeof(*mt_o->main_power_branches))) / mt->img.size);
+  }
 }
 
 
@@ -399,29 +631,65 @@ void mt_objects(mt_object_data* mt_o)
   // Create arrays
   mt_objects_init(mt_o);
 
+  // Find level roots
+  mt_relevant_nodes(mt_o);
+  mt_index_level_roots(mt_o);
+
+  mt_objects_significance(mt_o);
+
+  // If move_up is being used, find main power branches
+  if(mt_o->paras->move_factor != 0)
+  {
+    mt_main_power_branches(mt_o);
+  }
+
+  mt_objects_select(mt_o);
+}
+
+void mt_objects_prepare(mt_object_data* mt_o)
+{
+  // Find the parts of object detection which depend only on the tree, so
+  // that it can be filtered with several sets of parameters: the relevant
+  // nodes, their dense indices and their main power branches
+
+  mt_objects_init(mt_o);
+
+  mt_relevant_nodes(mt_o);
+  mt_index_level_roots(mt_o);
+
+  mt_main_power_branches(mt_o);
+}
+
+void mt_objects_significance(mt_object_data* mt_o)
+{
+  // Test the relevant nodes, setting the significant flags, the closest
+  // significant ancestors and the main branches
+
   // Validate parameters
   assert(mt_o->paras->bg_variance > 0);
   assert(mt_o->paras->gain > 0);
-  assert(mt_o->paras->move_factor >= 0);
-  assert(mt_o->node_significance_test != NULL);
-
-  // Find level roots
-  mt_relevant_nodes(mt_o);
+  assert(mt_o->node_significance_test != NULL ||
+    mt_o->node_significance_test_batch != NULL);
 
   mt_o->significant_nodes(mt_o);
+}
+
+void mt_objects_select(mt_object_data* mt_o)
+{
+  // Mark the objects among the significant nodes, move the markers up if
+  // move_factor is set, using the main power branches, and set the ids
+
+  assert(mt_o->paras->move_factor >= 0);
 
   // Count objects
   mt_find_objects(mt_o);
 
-  // If move_up is being used, find main power branches and execute move_up
   if(mt_o->paras->move_factor != 0)
   {
-    mt_main_power_branches(mt_o);
     mt_move_up(mt_o);
   }
 
   mt_object_ids(mt_o);
-    
 }
 
 // Marks object ids
@@ -440,6 +708,13 @@ void mt_object_ids(mt_object_data* mt_o)
       continue;
     }
 
+    // Masked pixels belong to no object
+    if (MT_IS_MASKED(mt, i))
+    {
+      mt_o->object_ids[i] = MT_NO_OBJECT;
+      continue;
+    }
+
     // Set next id as i
     INT_TYPE next_idx = i;
 
@@ -490,6 +765,43 @@ void mt_object_ids(mt_object_data* mt_o)
   }
 }
 
+void mt_object_index(const INT_TYPE* label_map, INT_TYPE size,
+  INT_TYPE num_labels, INT_TYPE* offsets, INT_TYPE* pixels)
+{
+  // Group the pixels of a label map by label with a counting sort. Labels
+  // run from 0 to num_labels - 1, and pixels with negative labels are left
+  // out. Offsets must have num_labels + 2 entries. The pixels labelled n are
+  // pixels[offsets[n]:offsets[n + 1]], in increasing order.
+
+  memset(offsets, 0, (num_labels + 2) * sizeof(INT_TYPE));
+
+  // Count each label two entries along, so that the running sums give the
+  // start of each label one entry along
+  INT_TYPE i;
+  for (i = 0; i != size; ++i)
+  {
+    if (label_map[i] >= 0)
+    {
+      ++offsets[label_map[i] + 2];
+    }
+  }
+
+  INT_TYPE n;
+  for (n = 2; n < num_labels + 2; ++n)
+  {
+    offsets[n] += offsets[n - 1];
+  }
+
+  // Placing each pixel advances the start of its label to the next label's
+  for (i = 0; i != size; ++i)
+  {
+    if (label_map[i] >= 0)
+    {
+      pixels[offsets[label_map[i] + 1]++] = i;
+    }
+  }
+}
+
 
 void node_significance_test_data_clear(mt_object_data* mt_o)
 {
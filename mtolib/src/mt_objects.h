@@ -26,6 +26,13 @@
 #define MT_SET_CHECKED_FOR_OBJECT(IDX) (mt_o->flags[IDX] |= 64)
 #define MT_CHECKED_FOR_OBJECT(IDX) (mt_o->flags[IDX] & 64)
 
+// Main branches are only stored for level roots, at the dense index held in
+// branch_indices
+#define MT_MAIN_BRANCH(IDX) \
+  (mt_o->main_branches[mt_o->branch_indices[IDX]])
+#define MT_MAIN_POWER_BRANCH(IDX) \
+  (mt_o->main_power_branches[mt_o->branch_indices[IDX]])
+
 #define MT_HAVE_SIGNIFICANT_ANCESTOR(IDX) \
   (mt_o->closest_significant_ancestors[IDX] != MT_NO_PARENT)
   
@@ -67,17 +74,33 @@ typedef struct mt_object_data
   void (*significant_nodes)(struct mt_object_data *);
   void *node_significance_test_data;
   void (*node_significance_test_data_free)(struct mt_object_data *);
+  // Dense index of each level root, which is kept in object_ids until the
+  // object ids are set if no other array is given
+  INT_TYPE* branch_indices;
+  // Pointer to function that takes an mt_o, an array of node IDs and its
+  // length, and sets one result per node to 1 if it is significant or 0
+  void (*node_significance_test_batch)(struct mt_object_data *, INT_TYPE *,
+    INT_TYPE, uint8_t *);
 } mt_object_data;
 
 void mt_objects_init(mt_object_data* mt_o);
+void mt_index_level_roots(mt_object_data* mt_o);
 void mt_objects_free(mt_object_data* mt_o);
 void mt_ids_free(mt_object_data* mt_o);
 void mt_objects(mt_object_data* mt_o);
+void mt_objects_prepare(mt_object_data* mt_o);
+void mt_objects_significance(mt_object_data* mt_o);
+void mt_objects_select(mt_object_data* mt_o);
 void mt_object_ids(mt_object_data* mt_o);
+void mt_object_index(const INT_TYPE* label_map, INT_TYPE size,
+  INT_TYPE num_labels, INT_TYPE* offsets, INT_TYPE* pixels);
 
 void mt_relevant_nodes(mt_object_data* mt_o);
 
 void mt_use_node_test_4(mt_object_data* mt_o);
+void mt_use_node_test_4_boundaries(mt_object_data* mt_o,
+  const FLOAT_TYPE *boundaries, INT_TYPE num_boundaries, double z_alpha,
+  double z_default, double correlation_area);
 
 void node_significance_test_data_clear(mt_object_data* mt_o);
 
@@ -0,0 +1,497 @@
+#include <pthread.h>
+
+#include "maxtree.h"
+
+// Concurrent max tree construction, after Wilkinson et al. (2008),
+// "Concurrent computation of attribute filters on shared memory parallel
+// machines".
+// The image is split into horizontal strips which are flooded concurrently.
+// The strip trees are then merged pairwise along strip boundaries.
+
+typedef struct
+{
+  mt_data* mt;
+  INT_TYPE start_row;
+  INT_TYPE end_row;
+  // Root of the strip's tree holding its minimum, or MT_NO_PARENT if every
+  // pixel of the strip is masked
+  INT_TYPE root_idx;
+  INT_TYPE num_masked;
+} mt_strip;
+
+typedef struct
+{
+  mt_data* mt;
+  // First row of the lower strip group
+  INT_TYPE boundary_row;
+  // Rows spanned by both strip groups
+  INT_TYPE start_row;
+  INT_TYPE end_row;
+} mt_boundary;
+
+// Attributes of a component, relative to its own level
+typedef struct
+{
+  INT_TYPE area;
+  FLOAT_TYPE volume;
+  FLOAT_TYPE power;
+  PIXEL_TYPE level;
+  // Only used if the tree has moments
+  mt_node_moments moments;
+} mt_component;
+
+static void* mt_flood_strip(void* arg)
+{
+  // Flood a strip of the image, as though it were a separate image. Pixels
+  // separated by masked pixels are left in separate trees, to be joined at
+  // the level of the image's minimum
+
+  mt_strip* strip = arg;
+  mt_data* mt = strip->mt;
+
+  INT_TYPE offset = strip->start_row * mt->img.width;
+
+  mt_data strip_mt = *mt;
+  strip_mt.img.data = mt->img.data + offset;
+  strip_mt.img.height = strip->end_row - strip->start_row;
+  strip_mt.img.size = strip_mt.img.height * strip_mt.img.width;
+  strip_mt.nodes = mt->nodes + offset;
+  strip_mt.nodes_attributes = mt->nodes_attributes + offset;
+  strip_mt.verbosity_level = 0;
+
+  if (mt->nodes_moments != NULL)
+  {
+    strip_mt.nodes_moments = mt->nodes_moments + offset;
+  }
+
+  mt_stack_alloc_entries(&strip_mt.stack);
+  mt_heap_alloc_entries(&strip_mt.heap, strip_mt.img.size);
+
+  mt_flood_components(&strip_mt, 0);
+
+  strip->root_idx = strip_mt.root == NULL ? MT_NO_PARENT :
+    strip_mt.root - mt->nodes;
+  strip->num_masked = 0;
+
+  // Convert parents from strip indices to image indices
+  INT_TYPE i;
+  for (i = 0; i != strip_mt.img.size; ++i)
+  {
+    if (strip_mt.nodes[i].parent >= 0)
+    {
+      strip_mt.nodes[i].parent += offset;
+    }
+    else if (strip_mt.nodes[i].parent == MT_MASKED)
+    {
+      ++strip->num_masked;
+    }
+  }
+
+  return NULL;
+}
+
+static INT_TYPE mt_level_root(mt_data* mt, INT_TYPE idx)
+{
+  // Follow parents within a flat zone to the zone's level root
+
+  INT_TYPE parent_idx = mt->nodes[idx].parent;
+
+  while (parent_idx != MT_NO_PARENT &&
+    mt->img.data[parent_idx] == mt->img.data[idx])
+  {
+    idx = parent_idx;
+    parent_idx = mt->nodes[idx].parent;
+  }
+
+  return idx;
+}
+
+static INT_TYPE mt_parent_level_root(mt_data* mt, INT_TYPE idx)
+{
+  INT_TYPE parent_idx = mt->nodes[idx].parent;
+
+  if (parent_idx == MT_NO_PARENT)
+  {
+    return MT_NO_PARENT;
+  }
+
+  return mt_level_root(mt, parent_idx);
+}
+
+static mt_component mt_get_component(mt_data* mt, INT_TYPE idx)
+{
+  mt_component component;
+  component.area = mt->nodes[idx].area;
+  component.volume = mt->nodes_attributes[idx].volume;
+  component.power = mt->nodes_attributes[idx].power;
+  component.level = mt->img.data[idx];
+
+  if (mt->nodes_moments != NULL)
+  {
+    component.moments = mt->nodes_moments[idx];
+  }
+
+  return component;
+}
+
+static void mt_add_component(mt_data* mt, INT_TYPE idx,
+  const mt_component* component)
+{
+  // Add a component at or above a node's level to the node
+
+  if (component->area == 0)
+  {
+    return;
+  }
+
+  mt_node_attributes *attr = mt->nodes_attributes + idx;
+
+  FLOAT_TYPE delta = component->level - mt->img.data[idx];
+
+  mt->nodes[idx].area += component->area;
+  attr->power += component->power + delta *
+    (2 * component->volume + delta * component->area);
+  attr->volume += component->volume + delta * component->area;
+
+  if (mt->nodes_moments != NULL)
+  {
+    mt_add_moments(mt->nodes_moments + idx, &component->moments);
+  }
+}
+
+static void mt_connect(mt_data* mt, INT_TYPE x, INT_TYPE y)
+{
+  // Merge the branches of two neighbouring pixels
+  // Nodes of both branches are visited in order of decreasing level. Each
+  // node is given the component of the other branch at its level, and the
+  // parent of the previously visited node. Nodes at equal levels are fused.
+
+  INT_TYPE a = mt_level_root(mt, x);
+  INT_TYPE b = mt_level_root(mt, y);
+
+  // Components to add to nodes in each branch
+  mt_component carry_a = {0};
+  mt_component carry_b = {0};
+
+  INT_TYPE previous = MT_NO_PARENT;
+
+  while (a != b)
+  {
+    INT_TYPE next;
+
+    if (b == MT_NO_PARENT ||
+      (a != MT_NO_PARENT && mt->img.data[a] > mt->img.data[b]))
+    {
+      next = a;
+      carry_b = mt_get_component(mt, a);
+      mt_add_component(mt, a, &carry_a);
+      a = mt_parent_level_root(mt, a);
+    }
+    else if (a == MT_NO_PARENT || mt->img.data[b] > mt->img.data[a])
+    {
+      next = b;
+      carry_a = mt_get_component(mt, b);
+      mt_add_component(mt, b, &carry_b);
+      b = mt_parent_level_root(mt, b);
+    }
+    else
+    {
+      // Equal levels - b joins a's flat zone
+      next = a;
+      carry_b = mt_get_component(mt, a);
+      carry_a = mt_get_component(mt, b);
+
+      INT_TYPE a_parent = mt_parent_level_root(mt, a);
+      INT_TYPE b_parent = mt_parent_level_root(mt, b);
+
+      mt_add_component(mt, a, &carry_a);
+
+      mt->nodes[b].parent = a;
+      mt->nodes[b].area = 1;
+      mt->nodes_attributes[b].volume = 0;
+      mt->nodes_attributes[b].power = 0;
+
+      if (mt->nodes_moments != NULL)
+      {
+        mt_pixel_moments(mt, b);
+      }
+
+      a = a_parent;
+      b = b_parent;
+    }
+
+    if (previous != MT_NO_PARENT)
+    {
+      mt->nodes[previous].parent = next;
+    }
+
+    previous = next;
+  }
+
+  if (previous != MT_NO_PARENT && a != MT_NO_PARENT)
+  {
+    mt->nodes[previous].parent = a;
+  }
+}
+
+static void* mt_merge_boundary(void* arg)
+{
+  // Connect all neighbouring pixel pairs across a strip boundary
+
+  mt_boundary* boundary = arg;
+  mt_data* mt = boundary->mt;
+
+  INT_TYPE radius_y = mt->connectivity.height / 2;
+  INT_TYPE radius_x = mt->connectivity.width / 2;
+
+  INT_TYPE y;
+  for (y = boundary->boundary_row; y != boundary->end_row &&
+    y < boundary->boundary_row + radius_y; ++y)
+  {
+    INT_TYPE conn_y;
+    // Neighbours above the pixel
+    for (conn_y = 0; conn_y < radius_y; ++conn_y)
+    {
+      INT_TYPE neighbour_y = y - radius_y + conn_y;
+
+      // Only pairs crossing the boundary
+      if (neighbour_y >= boundary->boundary_row ||
+        neighbour_y < boundary->start_row)
+      {
+        continue;
+      }
+
+      INT_TYPE conn_x;
+      for (conn_x = 0; conn_x != mt->connectivity.width; ++conn_x)
+      {
+        if (mt->connectivity.
+          neighbors[conn_y * mt->connectivity.width + conn_x] == 0)
+        {
+          continue;
+        }
+
+        INT_TYPE x;
+        for (x = 0; x != mt->img.width; ++x)
+        {
+          INT_TYPE neighbour_x = x - radius_x + conn_x;
+
+          if (neighbour_x < 0 || neighbour_x >= mt->img.width)
+          {
+            continue;
+          }
+
+          INT_TYPE idx = y * mt->img.width + x;
+          INT_TYPE neighbour_idx = neighbour_y * mt->img.width + neighbour_x;
+
+          if (MT_IS_MASKED(mt, idx) || MT_IS_MASKED(mt, neighbour_idx))
+          {
+            continue;
+          }
+
+          mt_connect(mt, idx, neighbour_idx);
+        }
+      }
+    }
+  }
+
+  return NULL;
+}
+
+static void* mt_finish_strip(void* arg)
+{
+  // Point every pixel at a level root, and rebase the attributes
+
+  mt_strip* strip = arg;
+  mt_data* mt = strip->mt;
+
+  INT_TYPE start = strip->start_row * mt->img.width;
+  INT_TYPE end = strip->end_row * mt->img.width;
+
+  INT_TYPE i;
+  for (i = start; i != end; ++i)
+  {
+    INT_TYPE parent_idx = mt->nodes[i].parent;
+
+    // Skip the root and masked pixels
+    if (parent_idx < 0)
+    {
+      continue;
+    }
+
+    if (mt->img.data[parent_idx] == mt->img.data[i])
+    {
+      mt->nodes[i].parent = mt_level_root(mt, i);
+    }
+    else
+    {
+      mt->nodes[i].parent = mt_level_root(mt, parent_idx);
+    }
+  }
+
+  mt_rebase_attributes(mt, start, end);
+
+  return NULL;
+}
+
+static void mt_run_threads(pthread_t* threads, int num_threads,
+  void* (*function)(void*), void* args, size_t arg_size)
+{
+  // Run the function on each of the arguments on its own thread, and wait for
+  // them all. An argument is run on the calling thread if no thread can be
+  // created for it.
+
+  char* started = safe_malloc(num_threads);
+
+  int i;
+  for (i = 0; i != num_threads; ++i)
+  {
+    void* arg = (char*)args + i * arg_size;
+
+    started[i] = pthread_create(threads + i, NULL, function, arg) == 0;
+
+    if (!started[i])
+    {
+      function(arg);
+    }
+  }
+
+  for (i = 0; i != num_threads; ++i)
+  {
+    if (started[i])
+    {
+      pthread_join(threads[i], NULL);
+    }
+  }
+
+  free(started);
+}
+
+void mt_flood_parallel(mt_data* mt, int num_threads)
+{
+  if (mt->verbosity_level)
+  {
+    mt_print_connectivity(mt);
+  }
+
+  // Strips must be at least as tall as the connectivity
+  INT_TYPE min_rows = mt->connectivity.height;
+
+  if (num_threads > mt->img.height / min_rows)
+  {
+    num_threads = mt->img.height / min_rows;
+  }
+
+  if (num_threads <= 1)
+  {
+    mt_flood_components(mt, 1);
+
+    mt_rebase_attributes(mt, 0, mt->img.size);
+    mt_canonical_level_roots(mt);
+    return;
+  }
+
+  if (mt->verbosity_level)
+  {
+    printf("%d threads.\n", num_threads);
+  }
+
+  // The image's own queue is not used
+  mt_stack_free_entries(&mt->stack);
+  mt_heap_free_entries(&mt->heap);
+
+  mt_strip* strips = safe_malloc(num_threads * sizeof(mt_strip));
+  mt_boundary* boundaries = safe_malloc(num_threads * sizeof(mt_boundary));
+  pthread_t* threads = safe_malloc(num_threads * sizeof(pthread_t));
+
+  int i;
+  for (i = 0; i != num_threads; ++i)
+  {
+    strips[i].mt = mt;
+    strips[i].start_row = (INT_TYPE)((int64_t)mt->img.height * i / num_threads);
+    strips[i].end_row =
+      (INT_TYPE)((int64_t)mt->img.height * (i + 1) / num_threads);
+  }
+
+  mt_run_threads(threads, num_threads, mt_flood_strip, strips,
+    sizeof(*strips));
+
+  // Merge neighbouring groups of strips, doubling the group size each time
+  int step;
+  for (step = 1; step < num_threads; step *= 2)
+  {
+    int num_merges = 0;
+
+    for (i = 0; i + step < num_threads; i += 2 * step)
+    {
+      int last = i + 2 * step - 1 < num_threads ?
+        i + 2 * step - 1 : num_threads - 1;
+
+      boundaries[num_merges].mt = mt;
+      boundaries[num_merges].start_row = strips[i].start_row;
+      boundaries[num_merges].boundary_row = strips[i + step].start_row;
+      boundaries[num_merges].end_row = strips[last].end_row;
+      ++num_merges;
+    }
+
+    mt_run_threads(threads, num_merges, mt_merge_boundary, boundaries,
+      sizeof(*boundaries));
+  }
+
+  // Find the first minimum pixel which is not masked
+  INT_TYPE root_idx = MT_NO_PARENT;
+  INT_TYPE num_masked = 0;
+
+  for (i = 0; i != num_threads; ++i)
+  {
+    INT_TYPE strip_root_idx = strips[i].root_idx;
+
+    if (strip_root_idx != MT_NO_PARENT && (root_idx == MT_NO_PARENT ||
+      mt->img.data[strip_root_idx] < mt->img.data[root_idx]))
+    {
+      root_idx = strip_root_idx;
+    }
+
+    num_masked += strips[i].num_masked;
+  }
+
+  if (num_masked)
+  {
+    // Masked pixels may leave several trees. Join them at the level of the
+    // minimum
+    INT_TYPE idx;
+    for (idx = 0; idx != mt->img.size; ++idx)
+    {
+      if (mt->nodes[idx].parent == MT_NO_PARENT && idx != root_idx)
+      {
+        mt_connect(mt, idx, root_idx);
+      }
+    }
+  }
+
+  mt_run_threads(threads, num_threads, mt_finish_strip, strips,
+    sizeof(*strips));
+
+  // Find the root
+  if (root_idx == MT_NO_PARENT)
+  {
+    // Every pixel is masked, so there is no tree
+    mt->root = NULL;
+  }
+  else
+  {
+    while (mt->nodes[root_idx].parent != MT_NO_PARENT)
+    {
+      root_idx = mt->nodes[root_idx].parent;
+    }
+
+    mt->root = mt->nodes + root_idx;
+  }
+
+  // The strips' level roots are not always the first pixels of their flat
+  // zones, as in the other engines
+  mt_canonical_level_roots(mt);
+
+  free(strips);
+  free(boundaries);
+  free(threads);
+}
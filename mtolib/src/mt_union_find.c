@@ -0,0 +1,295 @@
+#include "maxtree.h"
+
+// Max tree construction by sorting and union-find, after Berger et al.
+// (2007), "Effective component tree computation with application to pattern
+// recognition in astronomical imaging".
+// Pixels are sorted by a radix sort on their bits, then added to the tree in
+// order of decreasing value. Neighbouring components are merged into each
+// new pixel using a union-find structure with path compression.
+
+#define MT_RADIX_BITS 8
+#define MT_RADIX_SIZE (1 << MT_RADIX_BITS)
+
+typedef PIXEL_BITS_TYPE mt_sort_key;
+
+typedef struct
+{
+  mt_sort_key key;
+  INT_TYPE index;
+} mt_sort_entry;
+
+static mt_sort_key mt_pixel_key(PIXEL_TYPE value)
+{
+  // Map a floating point value to an unsigned integer with the same order
+
+  mt_sort_key key;
+  memcpy(&key, &value, sizeof(key));
+
+  mt_sort_key sign_bit = (mt_sort_key)1 << (sizeof(key) * 8 - 1);
+
+  if (key & sign_bit)
+  {
+    return ~key;
+  }
+
+  return key | sign_bit;
+}
+
+static INT_TYPE* mt_sort_pixels(mt_data* mt, INT_TYPE* num_pixels)
+{
+  // Return the indices of the pixels which are not masked, sorted by
+  // increasing value using a radix sort, and set their number
+  // Pixels with equal values stay in index order
+
+  INT_TYPE n = 0;
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    n += !MT_IS_MASKED(mt, i);
+  }
+
+  *num_pixels = n;
+
+  mt_sort_entry* entries = safe_malloc((n + 1) * sizeof(mt_sort_entry));
+  mt_sort_entry* buffer = safe_malloc((n + 1) * sizeof(mt_sort_entry));
+
+  n = 0;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    if (MT_IS_MASKED(mt, i))
+    {
+      continue;
+    }
+
+    entries[n].key = mt_pixel_key(mt->img.data[i]);
+    entries[n].index = i;
+    ++n;
+  }
+
+  INT_TYPE counts[MT_RADIX_SIZE];
+
+  unsigned int shift;
+  for (shift = 0; shift < sizeof(mt_sort_key) * 8; shift += MT_RADIX_BITS)
+  {
+    memset(counts, 0, sizeof(counts));
+
+    for (i = 0; i != n; ++i)
+    {
+      ++counts[(entries[i].key >> shift) & (MT_RADIX_SIZE - 1)];
+    }
+
+    // Skip digits which are the same for every pixel
+    if (n == 0 ||
+      counts[(entries[0].key >> shift) & (MT_RADIX_SIZE - 1)] == n)
+    {
+      continue;
+    }
+
+    // Convert counts to starting positions
+    INT_TYPE total = 0;
+    int digit;
+    for (digit = 0; digit != MT_RADIX_SIZE; ++digit)
+    {
+      INT_TYPE count = counts[digit];
+      counts[digit] = total;
+      total += count;
+    }
+
+    for (i = 0; i != n; ++i)
+    {
+      buffer[counts[(entries[i].key >> shift) & (MT_RADIX_SIZE - 1)]++] =
+        entries[i];
+    }
+
+    mt_sort_entry* swap = entries;
+    entries = buffer;
+    buffer = swap;
+  }
+
+  free(buffer);
+
+  // Keep only the indices, reusing the sorted entries
+  INT_TYPE* sorted = (INT_TYPE*)entries;
+  for (i = 0; i != n; ++i)
+  {
+    sorted[i] = entries[i].index;
+  }
+
+  return safe_realloc(sorted, (n + 1) * sizeof(INT_TYPE));
+}
+
+static INT_TYPE mt_find_root(INT_TYPE* zpar, INT_TYPE idx)
+{
+  // Find the root of a pixel's set, halving the path on the way
+
+  while (zpar[idx] != idx)
+  {
+    zpar[idx] = zpar[zpar[idx]];
+    idx = zpar[idx];
+  }
+
+  return idx;
+}
+
+static void mt_union(mt_data* mt, INT_TYPE* zpar, INT_TYPE idx,
+  INT_TYPE root_idx)
+{
+  // Make a pixel the parent of another component's root
+
+  mt_node *node = mt->nodes + idx;
+  mt_node *root = mt->nodes + root_idx;
+  mt_node_attributes *attr = mt->nodes_attributes + idx;
+  mt_node_attributes *root_attr = mt->nodes_attributes + root_idx;
+
+  FLOAT_TYPE delta = mt->img.data[root_idx] - mt->img.data[idx];
+
+  node->area += root->area;
+  attr->power += root_attr->power + delta *
+    (2 * root_attr->volume + delta * root->area);
+  attr->volume += root_attr->volume + delta * root->area;
+
+  if (mt->nodes_moments != NULL)
+  {
+    mt_add_moments(mt->nodes_moments + idx, mt->nodes_moments + root_idx);
+  }
+
+  root->parent = idx;
+  zpar[root_idx] = idx;
+}
+
+static void mt_union_neighbours(mt_data* mt, INT_TYPE* zpar,
+  const mt_neighbours* neighbours, INT_TYPE idx)
+{
+  // Merge the components of all processed neighbours into a pixel
+
+  INT_TYPE y = idx / mt->img.width;
+  INT_TYPE x = idx - y * mt->img.width;
+
+  int n;
+  for (n = 0; n != neighbours->num_neighbours; ++n)
+  {
+    INT_TYPE neighbour_x = x + neighbours->dx[n];
+    INT_TYPE neighbour_y = y + neighbours->dy[n];
+
+    if (neighbour_x < 0 || neighbour_x >= mt->img.width ||
+      neighbour_y < 0 || neighbour_y >= mt->img.height)
+    {
+      continue;
+    }
+
+    INT_TYPE neighbour_idx = idx + neighbours->offsets[n];
+
+    // Skip neighbours which are masked or have not been added yet
+    if (zpar[neighbour_idx] == MT_UNASSIGNED)
+    {
+      continue;
+    }
+
+    INT_TYPE root_idx = mt_find_root(zpar, neighbour_idx);
+
+    if (root_idx == idx)
+    {
+      continue;
+    }
+
+    // Make the pixel the parent of the neighbour's component
+    mt_union(mt, zpar, idx, root_idx);
+  }
+}
+
+void mt_flood_union_find(mt_data* mt)
+{
+  if (mt->verbosity_level)
+  {
+    mt_print_connectivity(mt);
+  }
+
+  // The image's own queue is not used
+  mt_stack_free_entries(&mt->stack);
+  mt_heap_free_entries(&mt->heap);
+
+  mt_neighbours neighbours;
+  mt_init_neighbours(mt, &neighbours);
+
+  INT_TYPE num_pixels;
+  INT_TYPE* sorted = mt_sort_pixels(mt, &num_pixels);
+
+  if (num_pixels == 0)
+  {
+    // Every pixel is masked, so there is no tree
+    mt->root = NULL;
+    free(sorted);
+    return;
+  }
+
+  INT_TYPE* zpar = safe_malloc(mt->img.size * sizeof(INT_TYPE));
+
+  INT_TYPE i;
+  for (i = 0; i != mt->img.size; ++i)
+  {
+    zpar[i] = MT_UNASSIGNED;
+  }
+
+  // Add pixels from the highest value to the lowest
+  for (i = num_pixels; i--;)
+  {
+    INT_TYPE idx = sorted[i];
+
+    mt->nodes[idx].parent = idx;
+    zpar[idx] = idx;
+
+    mt_union_neighbours(mt, zpar, &neighbours, idx);
+  }
+
+  // The last pixel added is the root
+  INT_TYPE root_idx = sorted[0];
+  mt->root = mt->nodes + root_idx;
+
+  // Masked pixels may separate the image into components. Join the others to
+  // the tree at the root's level
+  for (i = 1; i != num_pixels; ++i)
+  {
+    INT_TYPE idx = sorted[i];
+
+    if (zpar[idx] == idx)
+    {
+      mt_union(mt, zpar, root_idx, idx);
+    }
+  }
+
+  free(zpar);
+
+  // Point every pixel at the level root of its flat zone, from the root up
+  for (i = 0; i != num_pixels; ++i)
+  {
+    INT_TYPE idx = sorted[i];
+    INT_TYPE parent_idx = mt->nodes[idx].parent;
+
+    if (mt->img.data[mt->nodes[parent_idx].parent] ==
+      mt->img.data[parent_idx])
+    {
+      mt->nodes[idx].parent = mt->nodes[parent_idx].parent;
+    }
+
+    // Pixels in a level root's flat zone have no attributes of their own
+    if (idx != root_idx &&
+      mt->img.data[mt->nodes[idx].parent] == mt->img.data[idx])
+    {
+      mt->nodes[idx].area = 1;
+      mt->nodes_attributes[idx].volume = 0;
+      mt->nodes_attributes[idx].power = 0;
+
+      if (mt->nodes_moments != NULL)
+      {
+        mt_pixel_moments(mt, idx);
+      }
+    }
+  }
+
+  mt->nodes[root_idx].parent = MT_NO_PARENT;
+
+  free(sorted);
+
+  mt_rebase_attributes(mt, 0, mt->img.size);
+  mt_canonical_level_roots(mt);
+}
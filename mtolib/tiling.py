@@ -0,0 +1,278 @@
+"""Tiled max tree processing for images too large to process in one piece."""
+
+import numpy as np
+
+from mtolib import maxtree
+from mtolib.tree_filtering import filter_tree_timed, default_sig_test, up_tree
+
+
+def axis_tiles(length, tile_size, overlap):
+    """Split an axis into overlapping tiles.
+       Return a list of (tile_start, tile_end, core_start, core_end) tuples.
+       Cores partition the axis; tiles extend each core by half the overlap on each side.
+    """
+    core_size = tile_size - overlap
+    half_overlap = overlap // 2
+
+    tiles = []
+    for core_start in range(0, length, core_size):
+        core_end = min(core_start + core_size, length)
+        tiles.append((max(core_start - half_overlap, 0), min(core_end + half_overlap, length),
+                      core_start, core_end))
+
+    return tiles
+
+
+def validate_tiling(tile_size, overlap, connectivity=4):
+    """Check that a tile size and overlap can be used with a connectivity."""
+    if tile_size ** 2 > maxtree.MAX_IMAGE_SIZE:
+        raise ValueError("Tiles must have at most " + str(maxtree.MAX_IMAGE_SIZE) + " pixels")
+    reach = max(max(abs(dy), abs(dx)) for dy, dx in maxtree.NEIGHBOUR_OFFSETS[connectivity])
+    if overlap < 2 * reach or overlap >= tile_size:
+        raise ValueError("Tile overlap must be at least " + str(2 * reach) +
+                         " and smaller than the tile size")
+
+
+def global_indices(local_ids, y_offset, x_offset, width, dtype):
+    """Convert pixel indices within a tile to pixel indices within the full image.
+       Negative values (no object/no parent) are left unchanged.
+    """
+    global_ids = local_ids.astype(dtype)
+    valid = local_ids >= 0
+
+    y, x = np.divmod(local_ids[valid].astype(np.int64), local_ids.shape[1])
+    global_ids[valid] = (y + y_offset) * width + x + x_offset
+
+    return global_ids
+
+
+def tile_ids(local_ids, tile_number, tile_pixels, dtype):
+    """Give the object ids of a tile, which are pixel indices within the tile, a range of their own
+       by adding the tile's number times the number of pixels a tile may have.
+       Negative values (no object) are left unchanged.
+    """
+    ids = local_ids.astype(dtype)
+    ids[local_ids >= 0] += tile_number * tile_pixels
+
+    return ids
+
+
+def seam_links(tile_ids, tile_bounds, image_shape, offsets=maxtree.NEIGHBOUR_OFFSETS[4]):
+    """Find objects crossing the core boundaries of a tile.
+       Return pairs of (object id, index of the pixel across the seam) for each pair of
+       neighbours, at the given (y, x) offsets, with one pixel in the core and the other outside
+       it, which the tile assigns to the same object.
+    """
+    y0, y1, x0, x1, cy0, cy1, cx0, cx1 = tile_bounds
+    width = image_shape[1]
+
+    # Core pixels close enough to its edges to have neighbours outside it, in image coordinates
+    reach = max(max(abs(dy), abs(dx)) for dy, dx in offsets)
+
+    rows = np.arange(cy0, cy1)
+    columns = np.arange(cx0, cx1)
+    edge_rows = (rows < cy0 + reach) | (rows >= cy1 - reach)
+    edge_columns = (columns < cx0 + reach) | (columns >= cx1 - reach)
+
+    y = np.concatenate((np.repeat(rows[edge_rows], columns.size),
+                        np.repeat(rows[~edge_rows], np.count_nonzero(edge_columns))))
+    x = np.concatenate((np.tile(columns, np.count_nonzero(edge_rows)),
+                        np.tile(columns[edge_columns], np.count_nonzero(~edge_rows))))
+
+    inside = tile_ids[y - y0, x - x0]
+
+    object_ids = []
+    pixel_indices = []
+
+    for dy, dx in offsets:
+        ny = y + dy
+        nx = x + dx
+
+        # Neighbours in the tile but outside its core
+        across = ((ny >= y0) & (ny < y1) & (nx >= x0) & (nx < x1) &
+                  ~((ny >= cy0) & (ny < cy1) & (nx >= cx0) & (nx < cx1)))
+
+        outside = np.full(inside.shape, -1, dtype=tile_ids.dtype)
+        outside[across] = tile_ids[ny[across] - y0, nx[across] - x0]
+
+        connected = (inside == outside) & (inside >= 0)
+        object_ids.append(inside[connected])
+        pixel_indices.append(ny[connected] * width + nx[connected])
+
+    return np.concatenate(object_ids), np.concatenate(pixel_indices)
+
+
+def find_root(parents, label):
+    """Find the representative of a label in a union-find dictionary."""
+    root = label
+    while parents.get(root, root) != root:
+        root = parents[root]
+
+    # Compress the path
+    while label != root:
+        next_label = parents[label]
+        parents[label] = root
+        label = next_label
+
+    return root
+
+
+def merge_seam_objects(id_map, object_ids, pixel_indices, rows_per_chunk=1024):
+    """Merge objects which have been linked across tile seams.
+       Each linked set of objects takes the smallest id in the set.
+    """
+    parents = {}
+
+    neighbour_ids = id_map.ravel()[pixel_indices]
+
+    for a, b in zip(object_ids.tolist(), neighbour_ids.tolist()):
+        if b < 0 or a == b:
+            continue
+
+        root_a = find_root(parents, a)
+        root_b = find_root(parents, b)
+
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    if not parents:
+        return id_map
+
+    old_ids = np.array(sorted(parents), dtype=id_map.dtype)
+    new_ids = np.array([find_root(parents, i) for i in old_ids.tolist()], dtype=id_map.dtype)
+
+    return relabel(id_map, old_ids, new_ids, rows_per_chunk)
+
+
+def relabel(id_map, old_ids, new_ids, rows_per_chunk=1024):
+    """Replace each of a sorted array of ids in an id map with the matching new id, in place."""
+    if not old_ids.size:
+        return id_map
+
+    # Relabel in chunks to avoid image-sized temporaries
+    for row in range(0, id_map.shape[0], rows_per_chunk):
+        chunk = id_map[row:row + rows_per_chunk]
+        positions = np.searchsorted(old_ids, chunk).clip(max=old_ids.size - 1)
+        found = old_ids[positions] == chunk
+        chunk[found] = new_ids[positions[found]]
+
+    return id_map
+
+
+def marker_ids(id_map, tile_origins, tile_pixels, rows_per_chunk=1024):
+    """Replace the ids given by tile_ids in a merged id map with pixel indices in the full image.
+       Each object takes the index of its marker pixel in the tile its id comes from, or of its
+       first pixel if the marker is not in the object, so that every object has its own id.
+       tile_origins holds the first row, first column and width of each tile.
+    """
+    width = id_map.shape[1]
+
+    # Find the ids in use and the first pixel of each, a chunk of rows at a time
+    labels = []
+    first_pixels = []
+
+    for row in range(0, id_map.shape[0], rows_per_chunk):
+        chunk_labels, chunk_first = np.unique(id_map[row:row + rows_per_chunk], return_index=True)
+        labels.append(chunk_labels)
+        first_pixels.append(chunk_first + row * width)
+
+    labels, positions = np.unique(np.concatenate(labels), return_index=True)
+    first_pixels = np.concatenate(first_pixels)[positions]
+
+    objects = labels >= 0
+    labels = labels[objects]
+    first_pixels = first_pixels[objects]
+
+    tile_numbers, local_ids = np.divmod(labels.astype(np.int64), tile_pixels)
+    y0, x0, tile_width = tile_origins[tile_numbers].T
+    y, x = np.divmod(local_ids, tile_width)
+
+    markers = (y + y0) * width + x + x0
+    inside = id_map.ravel()[markers] == labels
+
+    return relabel(id_map, labels, np.where(inside, markers, first_pixels).astype(id_map.dtype),
+                   rows_per_chunk)
+
+
+def filter_tiles(img, params, tile_size=4096, overlap=256, maxtree_class=maxtree.OriginalMaxTree,
+                 sig_test=default_sig_test, sig_nodes_function=up_tree, mask=None):
+    """Build and filter a max tree for each overlapping tile of an image, and merge objects
+       which cross tile seams.
+
+       Only one tile's max tree is held in memory at a time. Each pixel takes its object from the
+       tile whose core contains it. Object ids are kept apart by tile until the objects crossing
+       seams have been merged, and are then pixel indices in the full image, as with filter_tree,
+       as are the significant ancestors. NaN pixels, and pixels where mask is true, are left out
+       of the trees.
+    """
+    connectivity = getattr(params, 'connectivity', 4)
+    validate_tiling(tile_size, overlap, connectivity)
+
+    height, width = img.shape
+
+    tiles = [(y_tile, x_tile) for y_tile in axis_tiles(height, tile_size, overlap)
+             for x_tile in axis_tiles(width, tile_size, overlap)]
+
+    tile_pixels = tile_size ** 2
+    tile_origins = np.array([(y0, x0, x1 - x0) for (y0, _, _, _), (x0, x1, _, _) in tiles],
+                            dtype=np.int64)
+
+    # Use 64 bit ids and ancestors if int32 cannot index every tile's pixels, or the image's
+    id_type = np.int32 if len(tiles) * tile_pixels < np.iinfo(np.int32).max else np.int64
+    sig_anc_type = np.int32 if img.size < np.iinfo(np.int32).max else np.int64
+
+    id_map = np.zeros(img.shape, dtype=id_type)
+    sig_ancs = np.zeros(img.shape, dtype=sig_anc_type)
+
+    seam_objects = []
+    seam_pixels = []
+
+    for n, ((y0, y1, cy0, cy1), (x0, x1, cx0, cx1)) in enumerate(tiles):
+        if params.verbosity > 1:
+            print("\n---Tile", n + 1, "of", len(tiles), "---")
+
+        tile = np.ascontiguousarray(img[y0:y1, x0:x1])
+        core = (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0))
+
+        tile_mask = None if mask is None else mask[y0:y1, x0:x1]
+
+        # Tiles which are entirely masked have no tree and no objects
+        invalid = np.isnan(tile)
+        if tile_mask is not None:
+            invalid |= tile_mask
+
+        if invalid.all():
+            id_map[cy0:cy1, cx0:cx1] = -1
+            sig_ancs[cy0:cy1, cx0:cx1] = -3
+            continue
+
+        mt = maxtree_class(tile, params.verbosity, params)
+
+        if tile_mask is not None:
+            mt.set_mask(tile_mask)
+
+        mt.flood()
+
+        local_ids, local_sig_ancs = filter_tree_timed(mt, tile, params, sig_test,
+                                                      sig_nodes_function)
+
+        mt.free_objects()
+
+        ids = tile_ids(local_ids, n, tile_pixels, id_type)
+        tile_sig_ancs = global_indices(local_sig_ancs, y0, x0, width, sig_anc_type)
+
+        # Keep the results for the tile's core
+        id_map[cy0:cy1, cx0:cx1] = ids[core]
+        sig_ancs[cy0:cy1, cx0:cx1] = tile_sig_ancs[core]
+
+        objects, pixels = seam_links(ids, (y0, y1, x0, x1, cy0, cy1, cx0, cx1), img.shape,
+                                     maxtree.NEIGHBOUR_OFFSETS[connectivity])
+        seam_objects.append(objects)
+        seam_pixels.append(pixels)
+
+    if not seam_objects:
+        raise ValueError("Every pixel of the image is masked")
+
+    id_map = merge_seam_objects(id_map, np.concatenate(seam_objects), np.concatenate(seam_pixels))
+
+    return marker_ids(id_map, tile_origins, tile_pixels), sig_ancs
@@ -1,38 +1,35 @@
 """Filter a maxtree."""
 
 import ctypes as ct
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import mtolib.significance_tests as mt_sig
-from mtolib import _ctype_classes as mt_class
+from mtolib.maxtree import c_array
 from mtolib.utils import time_function
 
-# Get access to the compiled C maxtree library
-# Defaults to float version
-mto_lib = ct.CDLL('mtolib/lib/mt_objects.so')
+# Parameters which may be varied by sweep_tree
+SWEEP_PARAMETERS = ('alpha', 'move_factor', 'min_distance')
 
 
-def init_double_filtering(params):
-    """Set up the double version of the maxtree library."""
-    global mto_lib
-
-    # If the image is 64 bit, use the double version of the library
-    if params.d_type == ct.c_double:
-        mto_lib = ct.CDLL('mtolib/lib/mt_objects_double.so')
-
-
-def up_tree():
+def up_tree(bindings):
     """Process a tree from root to leaves."""
-    return mt_class.SIGNODES_TYPE(mto_lib.mt_significant_nodes_up)
+    return bindings.objects_lib.mt_significant_nodes_up
 
 
-def down_tree():
+def down_tree(bindings):
     """Process a tree from leaves to root."""
-    return mt_class.SIGNODES_TYPE(mto_lib.mt_significant_nodes_down)
+    return bindings.objects_lib.mt_significant_nodes_down
+
 
+def batched(bindings):
+    """Process a tree from root to leaves, testing all nodes of each depth at once.
+       Used for batch significance tests."""
+    return bindings.objects_lib.mt_significant_nodes_batched
 
-def default_sig_test():
-    return mt_sig.default_sig_test(mto_lib)
+
+def default_sig_test(bindings):
+    return mt_sig.default_sig_test(bindings.objects_lib)
 
 
 def get_c_significant_nodes(lib_name):
@@ -41,21 +38,107 @@ def get_c_significant_nodes(lib_name):
     # Get access to a compiled C mt_object library
     c_lib = ct.CDLL(lib_name)
 
-    return mt_class.SIGNODES_TYPE(c_lib.significant_nodes)
+    return c_lib.significant_nodes
+
+
+def significance_functions(bindings, sig_test, sig_nodes_function):
+    """Return the fields of the C object data which hold the significance test and the
+       significant nodes function, as function pointers of a set of bindings' types, and the
+       test's initialisation function."""
+
+    # Batch tests are given the nodes of each depth by the batched function
+    if isinstance(sig_test, mt_sig.BatchSignificanceTest):
+        if sig_nodes_function == down_tree:
+            raise ValueError("Batch significance tests process the tree from root to leaves")
+
+        if sig_nodes_function == up_tree:
+            sig_nodes_function = batched
+
+    # Get up/down tree functions if necessary
+    if sig_nodes_function in (up_tree, down_tree, batched):
+        sig_nodes_function = sig_nodes_function(bindings)
+
+    # Get sig test if necessary
+    if sig_test == default_sig_test:
+        sig_test = default_sig_test(bindings)
+
+    test, init_test = sig_test.functions(bindings)
+
+    fields = {sig_test.field: test,
+              'significant_nodes': mt_sig.c_function(bindings.SIGNODES_TYPE, sig_nodes_function)}
+
+    return fields, init_test
+
+
+class ObjectData:
+    """The internal arrays of object detection on a maxtree, as numpy arrays sharing their memory.
+       The C arrays are freed once this object and all arrays from it have been deleted."""
+    def __init__(self, mt_in, lib, mto_struct, sig_ancs):
+        self.tree_memory = mt_in.memory
+        self.lib = lib
+        self.mto = mto_struct
+        self.closest_significant_ancestors = sig_ancs.ravel()
+
+    def __del__(self):
+        self.lib.mt_objects_free.argtypes = [ct.POINTER(type(self.mto))]
+        self.lib.mt_objects_free(ct.byref(self.mto))
+
+    @property
+    def flags(self):
+        """The flags of each pixel's node, as set by the macros in mt_objects.h: 1 if significant,
+           4 if it has a significant descendant, 8 if an object."""
+        return c_array(self, self.mto.flags, self.mto.mt.contents.img.size, ct.c_uint8)
+
+    @property
+    def relevant_indices(self):
+        """The nodes considered by the significance tests."""
+        return c_array(self, self.mto.relevant_indices, self.mto.relevant_indices_len, ct.c_int32)
+
+    @property
+    def branch_nodes(self):
+        """The nodes with main branches, which are the relevant nodes and then the root."""
+        mt = self.mto.mt.contents
+        root = ct.addressof(mt.root.contents) - ct.addressof(mt.nodes.contents)
+
+        return np.append(self.relevant_indices, root // ct.sizeof(mt.nodes._type_))
+
+    @property
+    def main_branches(self):
+        """The main branch of each of branch_nodes."""
+        return c_array(self, self.mto.main_branches, self.mto.relevant_indices_len + 1, ct.c_int32)
+
+    @property
+    def main_power_branches(self):
+        """The main power branch of each of branch_nodes, only set if move_factor is not zero."""
+        return c_array(self, self.mto.main_power_branches, self.mto.relevant_indices_len + 1,
+                       ct.c_int32)
+
+
+def mto_parameters(bindings, params, **settings):
+    """Return the C filtering parameters, with any values given in settings in place of those
+       in params."""
+    values = dict(bg_variance=params.bg_variance, gain=params.gain,
+                  move_factor=params.move_factor, alpha=params.alpha,
+                  verbosity=params.verbosity, min_distance=params.min_distance)
+    values.update(settings)
+
+    return bindings.MtParameters(**values)
 
 
 def filter_tree(mt_in, image, params, sig_test=default_sig_test,
-                sig_nodes_function=up_tree):
+                sig_nodes_function=up_tree, keep_object_data=False):
     if params.verbosity:
         print("\n---Finding Objects---")
-    return time_function(filter_tree_timed, (mt_in, image, params, sig_test, sig_nodes_function),
+    return time_function(filter_tree_timed,
+                         (mt_in, image, params, sig_test, sig_nodes_function, keep_object_data),
                          params.verbosity, 'find objects')
 
 
 def filter_tree_timed(mt_in, image, params, sig_test=default_sig_test,
-                sig_nodes_function=up_tree):
+                sig_nodes_function=up_tree, keep_object_data=False):
     """Filter a maxtree using a given significance test and processing method,
-     and return an object id map"""
+     and return an object id map.
+     If keep_object_data is set, the internal arrays are kept as mt_in.object_data."""
 
     # Convert the maxtree object for ctypes compatibility
     mt = mt_in.ctypes_maxtree()
@@ -71,36 +154,142 @@ def filter_tree_timed(mt_in, image, params, sig_test=default_sig_test,
     sig_ancs = np.zeros(image.shape, dtype=ct.c_int32) -3
     sig_anc_pointer = sig_ancs.ctypes.data_as(object_id_type)
 
-    # Get up/down tree functions if necessary
-    if sig_nodes_function == up_tree:
-        sig_nodes_function = up_tree()
-    elif sig_nodes_function == down_tree:
-        sig_nodes_function = down_tree()
-
-    # Get sig test if necessary
-    if sig_test == default_sig_test:
-        sig_test = default_sig_test()
+    # Get the significance functions for the tree's pixel type
+    bindings = mt_in.bindings
+    mto_lib = bindings.objects_lib
+    test_fields, init_test = significance_functions(bindings, sig_test, sig_nodes_function)
 
     # Create a parameters object
-    mto_params = mt_class.MtParameters(bg_variance=params.bg_variance, gain=params.gain,
-                                       move_factor=params.move_factor, alpha=params.alpha,
-                                       verbosity=params.verbosity, min_distance=params.min_distance)
-
+    mto_params = mto_parameters(bindings, params)
 
     # Create the MTO struct and a pointer
     # Avoids bizarre memory management issues - creating it in C seems to go very wrong
-    mto_struct = mt_class.MtObjectData(object_ids=id_pointer, mt=ct.pointer(mt),
+    mto_struct = bindings.MtObjectData(object_ids=id_pointer, mt=ct.pointer(mt),
                                        paras=ct.pointer(mto_params),
-                                       significant_nodes=sig_nodes_function,
-                                       node_significance_test=sig_test.test,
-                                       closest_significant_ancestors=sig_anc_pointer)
+                                       closest_significant_ancestors=sig_anc_pointer,
+                                       **test_fields)
 
     mto_pointer = ct.pointer(mto_struct)
 
-    sig_test.init_test(mto_pointer)
+    init_test(mto_pointer)
 
     # Set up the mt_objects c function interface
-    mto_lib.mt_objects.argtypes = [ct.POINTER(mt_class.MtObjectData)]
+    mto_lib.mt_objects.argtypes = [ct.POINTER(bindings.MtObjectData)]
     mto_lib.mt_objects(mto_pointer)
 
+    if keep_object_data:
+        mt_in.object_data = ObjectData(mt_in, mto_lib, mto_struct, sig_ancs)
+    else:
+        # Free the internal arrays - only the id map and significant ancestors are returned
+        mto_lib.mt_objects_free.argtypes = [ct.POINTER(bindings.MtObjectData)]
+        mto_lib.mt_objects_free(mto_pointer)
+
     return object_ids, sig_ancs
+
+
+def sweep_tree(mt_in, image, params, settings, sig_test=default_sig_test,
+               sig_nodes_function=up_tree, num_threads=1):
+    if params.verbosity:
+        print("\n---Finding Objects for", len(settings), "Settings---")
+    return time_function(sweep_tree_timed,
+                         (mt_in, image, params, settings, sig_test, sig_nodes_function, num_threads),
+                         params.verbosity, 'find objects for each setting')
+
+
+def sweep_tree_timed(mt_in, image, params, settings, sig_test=default_sig_test,
+                     sig_nodes_function=up_tree, num_threads=1):
+    """Filter a maxtree once for each of a list of settings, and return a list of the object id
+     maps and significant ancestors given by filter_tree for each.
+     Each setting is a dictionary of values for any of SWEEP_PARAMETERS, with other values taken
+     from params. The relevant nodes and main power branches are found once, and the
+     significance tests are run once for all settings which differ only in move_factor.
+     Settings are filtered on up to num_threads threads."""
+
+    for setting in settings:
+        for name in setting:
+            if name not in SWEEP_PARAMETERS:
+                raise ValueError("Cannot sweep parameter " + name)
+
+    mt = mt_in.ctypes_maxtree()
+    size = image.size
+
+    object_id_type = ct.POINTER(ct.c_int32)
+    flag_type = ct.POINTER(ct.c_uint8)
+
+    # Get the significance functions for the tree's pixel type
+    bindings = mt_in.bindings
+    mto_lib = bindings.objects_lib
+    test_fields, init_test = significance_functions(bindings, sig_test, sig_nodes_function)
+
+    mto_lib.mt_objects_prepare.argtypes = [ct.POINTER(bindings.MtObjectData)]
+    mto_lib.mt_objects_significance.argtypes = [ct.POINTER(bindings.MtObjectData)]
+    mto_lib.mt_objects_select.argtypes = [ct.POINTER(bindings.MtObjectData)]
+    mto_lib.node_significance_test_data_clear.argtypes = [ct.POINTER(bindings.MtObjectData)]
+    mto_lib.mt_objects_free.argtypes = [ct.POINTER(bindings.MtObjectData)]
+
+    # Find the parts of filtering which depend only on the tree
+    branch_indices = np.empty(size, dtype=ct.c_int32)
+    base = bindings.MtObjectData(mt=ct.pointer(mt),
+                                 branch_indices=branch_indices.ctypes.data_as(object_id_type))
+    mto_lib.mt_objects_prepare(ct.byref(base))
+
+    base_flags = c_array(None, base.flags, size, ct.c_uint8)
+    num_branches = base.relevant_indices_len + 1
+
+    def test_nodes(significance_setting):
+        # Run the significance tests with one alpha and min_distance, with arrays of its own
+        mto_params = mto_parameters(bindings, params, **dict(significance_setting))
+
+        flags = base_flags.copy()
+        sig_ancs = np.zeros(image.shape, dtype=ct.c_int32) - 3
+        main_branches = np.empty(num_branches, dtype=ct.c_int32)
+
+        mto_struct = bindings.MtObjectData.from_buffer_copy(base)
+        mto_struct.paras = ct.pointer(mto_params)
+        mto_struct.flags = flags.ctypes.data_as(flag_type)
+        mto_struct.closest_significant_ancestors = sig_ancs.ctypes.data_as(object_id_type)
+        mto_struct.main_branches = main_branches.ctypes.data_as(object_id_type)
+
+        for name, value in test_fields.items():
+            setattr(mto_struct, name, value)
+
+        mto_pointer = ct.pointer(mto_struct)
+
+        init_test(mto_pointer)
+        mto_lib.mt_objects_significance(mto_pointer)
+        mto_lib.node_significance_test_data_clear(mto_pointer)
+
+        return mto_struct, flags, sig_ancs, main_branches
+
+    def find_objects(setting):
+        # Mark and label the objects for one setting, with its own flags and id map
+        tested_struct, tested_flags, sig_ancs, _ = tested[significance_key(setting)]
+
+        mto_params = mto_parameters(bindings, params, **setting)
+
+        flags = tested_flags.copy()
+        object_ids = np.zeros(image.shape, dtype=ct.c_int32)
+
+        mto_struct = bindings.MtObjectData.from_buffer_copy(tested_struct)
+        mto_struct.paras = ct.pointer(mto_params)
+        mto_struct.flags = flags.ctypes.data_as(flag_type)
+        mto_struct.object_ids = object_ids.ctypes.data_as(object_id_type)
+
+        mto_lib.mt_objects_select(ct.byref(mto_struct))
+
+        return object_ids, sig_ancs
+
+    def significance_key(setting):
+        return (('alpha', setting.get('alpha', params.alpha)),
+                ('min_distance', setting.get('min_distance', params.min_distance)))
+
+    significance_settings = list(dict.fromkeys(significance_key(setting) for setting in settings))
+
+    # The C functions release the GIL, so settings are filtered concurrently
+    with ThreadPoolExecutor(num_threads) as executor:
+        tested = dict(zip(significance_settings, executor.map(test_nodes, significance_settings)))
+        results = list(executor.map(find_objects, settings))
+
+    mto_lib.mt_objects_free(ct.byref(base))
+
+    return results
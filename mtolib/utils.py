@@ -1,12 +1,19 @@
 """Miscellaneous utilities."""
 
 import time
+import resource
+import sys
 from astropy.stats import gaussian_fwhm_to_sigma
 import argparse
 
 
 def time_function(function, parameters, verbosity, task_string):
-    """Time a function, return the function's output, and print the time taken."""
+    """Time a function, return the function's output, and print the time taken.
+       At verbosity 2, also print the bytes read and the memory used by the function."""
+    if verbosity > 1:
+        reset_peak_memory()
+        start_usage = resource_usage()
+
     start_time = time.time()
 
     output = function(*parameters)
@@ -14,10 +21,66 @@ def time_function(function, parameters, verbosity, task_string):
     if verbosity > 1:
         elapsed_time = (time.time() - start_time)
         print('{:.4} seconds to {}.'.format(elapsed_time, task_string))
+        print_resource_usage(start_usage, resource_usage())
 
     return output
 
 
+def resource_usage():
+    """Return the number of bytes read from storage by this process, including pages of memory
+       mapped files, and its current and peak resident memory in bytes.
+       On Linux, the peak is since the last call to reset_peak_memory. Elsewhere, bytes read and
+       current memory are None, and the peak is since the process started.
+    """
+    bytes_read = None
+    current_memory = None
+    peak_memory = None
+
+    try:
+        with open('/proc/self/io') as io:
+            bytes_read = next(int(line.split()[1]) for line in io if line.startswith('read_bytes'))
+
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    current_memory = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak_memory = int(line.split()[1]) * 1024
+    except (OSError, StopIteration):
+        pass
+
+    if peak_memory is None:
+        # Peak memory is given in bytes on macOS, and kilobytes elsewhere
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak_memory *= 1024
+
+    return bytes_read, current_memory, peak_memory
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process to its current use, where supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def print_resource_usage(start_usage, end_usage):
+    """Print the bytes read from storage and the memory used between two calls to resource_usage."""
+    start_read, start_memory, _ = start_usage
+    end_read, end_memory, peak_memory = end_usage
+
+    if end_read is None or start_memory is None:
+        print('Peak memory {:.1f} MB.'.format(peak_memory / 2**20))
+        return
+
+    print('{:.1f} MB read, peak memory {:.1f} MB ({:+.1f} MB during this step, {:+.1f} MB kept).'.format(
+        (end_read - start_read) / 2**20, peak_memory / 2**20, (peak_memory - start_memory) / 2**20,
+        (end_memory - start_memory) / 2**20))
+
+
 def fwhm_to_sigma(x):
     """Convert the full width at half maximum (FWHM) of a function to a sigma."""
     return x * gaussian_fwhm_to_sigma
@@ -16,8 +16,14 @@ fi
 
 cd "${0%/*}/../src"
 
-gcc -shared -fPIC -include main.h -o ../lib/mt_objects.so mt_objects.c mt_heap.c mt_node_test_4.c
-gcc -shared -fPIC -include main.h -o ../lib/maxtree.so maxtree.c mt_stack.c mt_heap.c
+# Set ATTRIBUTE_TYPE (float or double) to override the precision of the node attributes
+attributes=""
+if [ -n "$ATTRIBUTE_TYPE" ]
+then attributes="-DATTRIBUTE_TYPE=$ATTRIBUTE_TYPE"
+fi
+
+gcc -shared -fPIC -include main.h $attributes -o ../lib/mt_objects.so mt_objects.c mt_heap.c mt_node_test_4.c
+gcc -shared -fPIC -pthread -include main.h $attributes -o ../lib/maxtree.so maxtree.c mt_stack.c mt_heap.c mt_parallel.c mt_union_find.c mt_bucket_queue.c
 
-gcc -shared -fPIC -include main_double.h  -o ../lib/mt_objects_double.so mt_objects.c mt_heap.c mt_node_test_4.c
-gcc -shared -fPIC -include main_double.h -o ../lib/maxtree_double.so maxtree.c mt_stack.c mt_heap.c
+gcc -shared -fPIC -include main_double.h $attributes -o ../lib/mt_objects_double.so mt_objects.c mt_heap.c mt_node_test_4.c
+gcc -shared -fPIC -pthread -include main_double.h $attributes -o ../lib/maxtree_double.so maxtree.c mt_stack.c mt_heap.c mt_parallel.c mt_union_find.c mt_bucket_queue.c
@@ -0,0 +1,104 @@
+"""Images and parameters shared by the tests.
+
+The C libraries are loaded from mtolib/lib, so the tests are run from the repository root:
+
+    python -m pytest tests
+"""
+
+import ctypes as ct
+
+import numpy as np
+
+from mtolib import maxtree
+from mtolib.benchmarks import default_params
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+# Seeds of the random frames used by most tests, which include frames in single and double
+# precision, with and without ties
+SEEDS = range(6)
+
+# Names of the deterministic frames made by edge_frame
+EDGE_FRAMES = ('plateaus', 'row', 'column')
+
+
+def small_image(seed):
+    """Make a small image of gaussian sources on noise with a mean of 100 and a variance of 25.
+       Images with odd seeds are rounded to whole numbers after scaling down, so that they have
+       many flat zones and ties. Every third image is in double precision.
+       Return the image and its background mean and variance."""
+    rng = np.random.RandomState(seed)
+
+    height, width = rng.randint(40, 100, size=2)
+    img = rng.normal(100, 5, size=(height, width))
+
+    y, x = np.mgrid[:height, :width]
+    for _ in range(rng.randint(3, 25)):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        sigma = rng.uniform(0.8, 5)
+        img += rng.uniform(5, 400) * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * sigma ** 2))
+
+    scale = 1
+    if seed % 2:
+        scale = rng.choice([1, 2, 5])
+        img = np.round(img / scale)
+
+    dtype = np.float64 if seed % 3 == 0 else np.float32
+
+    return img.astype(dtype), 100.0 / scale, 25.0 / scale ** 2
+
+
+def image_params(image, bg_mean=None, bg_variance=-1):
+    """Return the default parameters for an image, with the pixel type set and optionally the
+       background."""
+    params = default_params()
+    params.d_type = ct.c_double if image.dtype == np.float64 else ct.c_float
+    params.bg_mean = bg_mean
+    params.bg_variance = bg_variance
+
+    return params
+
+
+def small_frame(seed):
+    """Return a small image made by small_image and its parameters, with the background set."""
+    image, bg_mean, bg_variance = small_image(seed)
+
+    params = image_params(image, bg_mean, bg_variance)
+    params.gain = 1
+
+    return image, params
+
+
+def edge_frame(name):
+    """Return a small deterministic image and its parameters, for cases which random frames
+       seldom reach: 'plateaus' has nested flat zones with equal values, and 'row' and 'column'
+       are a single row and column with two peaks of the same value."""
+    if name == 'plateaus':
+        img = np.zeros((24, 32))
+        img[4:20, 4:28] = 10
+        img[6:10, 6:10] = img[6:10, 20:24] = img[14:18, 12:16] = 20
+        img[15:17, 13:15] = 30
+    else:
+        x = np.arange(64)
+        img = np.round(40 * np.exp(-(x - 16) ** 2 / 8) + 40 * np.exp(-(x - 44) ** 2 / 8))
+        img = img[np.newaxis] if name == 'row' else img[:, np.newaxis]
+
+    img = img.astype(np.float32)
+
+    params = image_params(img, bg_mean=0, bg_variance=1)
+    params.gain = 1
+
+    return img, params
+
+
+def find_objects(image, params, maxtree_class=maxtree.OriginalMaxTree, **kwargs):
+    """Preprocess an image, build a max tree of a class and filter it.
+       Return the preprocessed image, the tree and the object id map."""
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree_class(processed_image, 0, params, **kwargs)
+    mt.flood()
+
+    id_map, _ = filter_tree(mt, processed_image, params)
+
+    return processed_image, mt, id_map
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from mtolib import background
+from mtolib.benchmarks import synthetic_image
+
+
+def background_image(seed):
+    """A synthetic image with a border of zeros and a patch of NaNs on one side, as in mosaics."""
+    img = synthetic_image(300, 420, num_sources=60, seed=seed)
+
+    img[:, :40] = 0
+    img[200:260, 300:380] = np.nan
+
+    return img.astype(np.float32 if seed % 2 else np.float64)
+
+
+def per_tile_flat(img, tile_length, rejection_rate):
+    return np.array([[background.check_tile_is_flat(img[y:y + tile_length, x:x + tile_length],
+                                                    rejection_rate)
+                      for x in range(0, img.shape[1] - tile_length, tile_length)]
+                     for y in range(0, img.shape[0] - tile_length, tile_length)], dtype=bool)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('tile_length', [16, 32, 64, 128])
+def test_batched_tiles_match_per_tile(seed, tile_length):
+    img = background_image(seed)
+
+    flat = background.TileMoments(img).flat_tiles(tile_length, 0.05)
+
+    assert np.array_equal(flat, per_tile_flat(img, tile_length, 0.05))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_batched_estimate_matches_per_tile(seed):
+    img = background_image(seed)
+
+    assert (background.estimate_bg(img, verbosity=0) ==
+            background.estimate_bg(img, verbosity=0, batched=False))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_masked_estimate_matches_nan_estimate(seed):
+    img = background_image(seed)
+
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[50:150, 100:250] = True
+
+    masked_img = img.copy()
+    masked_img[mask] = np.nan
+    expected = background.estimate_bg(masked_img, verbosity=0)
+
+    img[mask] = 1e6
+
+    for batched in (True, False):
+        assert np.allclose(background.estimate_bg(img, verbosity=0, batched=batched, mask=mask),
+                           expected, rtol=1e-6)
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from mtolib import batch
+
+from tests.helpers import small_frame
+
+
+def test_output_names_mirror_subdirectories(tmp_path):
+    files = [str(tmp_path / 'a' / 'x.fits'), str(tmp_path / 'b' / 'c' / 'x.fits'),
+             str(tmp_path / 'a' / 'y.fits')]
+
+    names = batch.all_output_names(files, 'out', 'png')
+
+    directories = [os.path.join('out', 'a'), os.path.join('out', 'b', 'c'),
+                   os.path.join('out', 'a')]
+    stems = ['x', 'x', 'y']
+
+    assert names == [(os.path.join(directory, stem + '.png'),
+                      os.path.join(directory, stem + '_parameters.csv'))
+                     for directory, stem in zip(directories, stems)]
+
+
+def test_output_names_of_one_directory(tmp_path):
+    names = batch.all_output_names([str(tmp_path / 'x.fits')], 'out', 'fits')
+
+    assert names == [(os.path.join('out', 'x.fits'), os.path.join('out', 'x_parameters.csv'))]
+
+
+def test_files_with_the_same_outputs_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        batch.all_output_names([str(tmp_path / 'x.fits'), str(tmp_path / 'x.fits.gz')], 'out',
+                               'png')
+
+
+def test_batch_keeps_files_with_the_same_name_apart(tmp_path):
+    image, params = small_frame(1)
+
+    files = [tmp_path / 'images' / 'a' / 'x.fits', tmp_path / 'images' / 'b' / 'x.fits']
+    for n, filename in enumerate(files):
+        filename.parent.mkdir(parents=True)
+        fits.writeto(str(filename), np.flipud(image) if n else image)
+
+    out_dir = tmp_path / 'out'
+    failed = batch.main([str(filename) for filename in files] +
+                        ['-out_dir', str(out_dir), '-threads', '-workers', '2', '--',
+                         '-bg_mean', str(params.bg_mean), '-bg_variance', str(params.bg_variance),
+                         '-gain', '1'])
+
+    assert failed == 0
+
+    for subdirectory in ('a', 'b'):
+        assert (out_dir / subdirectory / 'x.png').exists()
+        assert (out_dir / subdirectory / 'x_parameters.csv').exists()
+
+    records = batch.read_manifest(str(out_dir / batch.MANIFEST_NAME))
+    assert sorted(records) == sorted(str(filename) for filename in files)
+    assert all(record['status'] == 'done' for record in records.values())
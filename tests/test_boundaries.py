@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from mtolib import boundaries, maxtree, significance_tests
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import small_frame
+
+ALPHAS = [1e-2, 1e-3, 1e-6, 1e-9]
+
+
+@pytest.mark.parametrize('float_type', [np.float32, np.float64])
+def test_default_level_table_is_the_fitted_boundary(tmp_path, float_type):
+    boundary = boundaries.RejectionBoundary(boundaries.DEFAULT_ALPHA, float_type, str(tmp_path))
+    area = np.arange(1, boundaries.TABLE_AREAS + 1)
+
+    assert boundary.table.dtype == float_type
+    assert np.allclose(boundary.table, boundaries.fitted_boundary(area),
+                       rtol=4 * np.finfo(float_type).eps, atol=0)
+
+    # Beyond the table the fitted boundary is constant, and so is the lookup
+    large_area = np.arange(boundaries.TABLE_AREAS + 1, 4 * boundaries.TABLE_AREAS)
+    assert np.allclose(boundary(large_area), boundaries.fitted_boundary(large_area, float_type),
+                       rtol=1e-6)
+
+
+def test_boundary_is_monotone_in_alpha(tmp_path):
+    area = np.arange(1, 4 * boundaries.TABLE_AREAS)
+
+    x = np.array([boundaries.RejectionBoundary(alpha, np.float64, str(tmp_path))(area)
+                  for alpha in ALPHAS])
+
+    # Smaller significance levels need brighter nodes at every area
+    assert (np.diff(x, axis=0) > 0).all()
+
+
+@pytest.mark.parametrize('alpha', ALPHAS)
+def test_lookups_beyond_the_table_continue_it(tmp_path, alpha):
+    boundary = boundaries.RejectionBoundary(alpha, np.float64, str(tmp_path))
+    last_area = boundaries.TABLE_AREAS
+
+    x = boundary(np.arange(last_area - 1, last_area + 3))
+
+    assert x[1] == boundary.table[-1]
+
+    # The step across the end of the table is no larger than the steps either side of it
+    steps = np.abs(np.diff(x))
+    assert steps[1] <= 2 * max(steps[0], steps[2]) + 1e-12 * x[1]
+    assert np.isclose(x[2], x[1], rtol=1e-4)
+
+
+def test_tables_are_cached(tmp_path):
+    table = boundaries.RejectionBoundary(1e-3, np.float32, str(tmp_path)).table
+
+    assert len(list(tmp_path.iterdir())) == 1
+    assert np.array_equal(boundaries.RejectionBoundary(1e-3, np.float32, str(tmp_path)).table,
+                          table)
+
+
+@pytest.mark.parametrize('alpha', [1e-3, 1e-9])
+def test_c_boundary_matches_lookup(alpha):
+    # Test 4 in C, with the table given by mt_use_node_test_4_boundaries, and batch_test_4, with
+    # the lookup, find the same objects, in a frame with nodes larger than the table
+    image, params = small_frame(2)
+    image = np.tile(image, (2, 2))
+    params.alpha = alpha
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    _, areas = mt.node_arrays()
+    assert areas.max() > boundaries.TABLE_AREAS
+
+    expected_ids, expected_sig_ancs = filter_tree(mt, processed_image, params)
+    id_map, sig_ancs = filter_tree(mt, processed_image, params, significance_tests.batch_test_4())
+
+    assert (expected_ids >= 0).any()
+    assert np.array_equal(id_map, expected_ids)
+    assert np.array_equal(sig_ancs, expected_sig_ancs)
@@ -0,0 +1,126 @@
+import copy
+import ctypes as ct
+import os
+
+import numpy as np
+import pytest
+
+from mtolib import maxtree
+from mtolib.cache import TreeCache
+from mtolib.main import cached_max_tree
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import SEEDS, small_frame
+
+
+def flooded_tree(seed):
+    """Return a small frame's parameters, preprocessed image and flooded tree."""
+    image, params = small_frame(seed)
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    return params, processed_image, mt
+
+
+def set_last_use(cache, key, time):
+    os.utime(cache.path(key), (time, time))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_cache_hit_gives_the_same_objects(tmp_path, seed):
+    cache = TreeCache(str(tmp_path))
+    image, params = small_frame(seed)
+
+    processed_image, mt = cached_max_tree(image, copy.copy(params), cache)
+    expected, expected_sig_ancs = filter_tree(mt, processed_image, params)
+
+    cached_image, cached_mt = cached_max_tree(image, copy.copy(params), cache)
+    id_map, sig_ancs = filter_tree(cached_mt, cached_image, params)
+
+    assert cache.counts() == {'hits': 1, 'misses': 1}
+    assert np.array_equal(cached_image, processed_image)
+    assert cached_mt.root_index() == mt.root_index()
+    assert np.array_equal(id_map, expected)
+    assert np.array_equal(sig_ancs, expected_sig_ancs)
+
+
+def test_key_depends_on_the_tree_settings(tmp_path):
+    cache = TreeCache(str(tmp_path))
+    image, params = small_frame(0)
+
+    mask = np.zeros(image.shape, dtype=bool)
+    other_mask = mask.copy()
+    other_mask[0, 0] = True
+
+    other_mean = copy.copy(params)
+    other_mean.bg_mean += 1
+
+    double_params = copy.copy(params)
+    double_params.d_type = ct.c_double if params.d_type == ct.c_float else ct.c_float
+    double_image = image.astype(np.float64 if image.dtype == np.float32 else np.float32)
+
+    keys = [cache.key(image, params, 'OriginalMaxTree'),
+            cache.key(image, other_mean, 'OriginalMaxTree'),
+            cache.key(image, params, 'OriginalMaxTree', n=3),
+            cache.key(image, params, 'OriginalMaxTree', levels=256),
+            cache.key(image, params, 'OriginalMaxTree', connectivity=8),
+            cache.key(image, params, 'OriginalMaxTree', mask=mask),
+            cache.key(image, params, 'OriginalMaxTree', mask=other_mask),
+            cache.key(double_image, double_params, 'OriginalMaxTree'),
+            cache.key(image, params, 'ParallelMaxTree')]
+
+    assert len(set(keys)) == len(keys)
+    assert cache.key(image.copy(), copy.copy(params), 'OriginalMaxTree') == keys[0]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    params, processed_image, mt = flooded_tree(0)
+
+    cache = TreeCache(str(tmp_path))
+    cache.store('a', processed_image, mt, params)
+    cache.store('b', processed_image, mt, params)
+
+    entry_size = cache.stats()['bytes'] // 2
+
+    set_last_use(cache, 'a', 1000)
+    set_last_use(cache, 'b', 2000)
+
+    # Loading an entry makes it the most recently used
+    assert cache.load('a') is not None
+
+    cache.max_bytes = 2 * entry_size
+    cache.store('c', processed_image, mt, params)
+
+    assert [key for _, _, key in cache.entries()] == ['a', 'c']
+
+
+def test_stored_entry_is_kept_when_larger_than_the_cache(tmp_path):
+    params, processed_image, mt = flooded_tree(0)
+
+    cache = TreeCache(str(tmp_path), max_bytes=1)
+    cache.store('a', processed_image, mt, params)
+    cache.store('b', processed_image, mt, params)
+
+    assert [key for _, _, key in cache.entries()] == ['b']
+
+
+def test_hits_and_misses_are_counted(tmp_path):
+    params, processed_image, mt = flooded_tree(0)
+
+    cache = TreeCache(str(tmp_path))
+    assert cache.load('a') is None
+
+    cache.store('a', processed_image, mt, params)
+    assert cache.load('a') is not None
+    assert cache.load('a') is not None
+
+    # Counts are kept in the directory, across instances
+    stats = TreeCache(str(tmp_path)).stats()
+
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['bytes'] > processed_image.nbytes
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from mtolib import main
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import SEEDS, find_objects, small_frame
+
+
+def object_mask(id_map):
+    """Mask a rectangle around the middle of an id map's objects."""
+    y, x = np.nonzero(id_map >= 0)
+
+    mask = np.zeros(id_map.shape, dtype=bool)
+    mask[int(np.percentile(y, 25)):int(np.percentile(y, 75)) + 1,
+         int(np.percentile(x, 25)):int(np.percentile(x, 75)) + 1] = True
+
+    return mask
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('tile_size', [None, 32])
+def test_masked_pixels_belong_to_no_object(seed, tile_size):
+    image, params = small_frame(seed)
+    _, _, unmasked_ids = find_objects(image, params)
+
+    mask = object_mask(unmasked_ids)
+    assert (unmasked_ids[mask] >= 0).any()
+
+    image, params = small_frame(seed)
+    processed_image = preprocess_image(image, params, n=2, mask=mask)
+
+    if tile_size:
+        id_map, _ = main.filter_tree_tiled(processed_image, params, tile_size, 8, mask=mask)
+    else:
+        mt = main.build_max_tree(processed_image, params, mask=mask)
+        id_map, _ = filter_tree(mt, processed_image, params)
+
+    assert (id_map[mask] == -1).all()
+    assert (id_map[~mask] >= 0).any()
+
+
+def test_run_with_mask_file(tmp_path):
+    image, params = small_frame(1)
+    _, _, unmasked_ids = find_objects(image, params)
+
+    mask = object_mask(unmasked_ids)
+
+    image_path = str(tmp_path / 'image.fits')
+    mask_path = str(tmp_path / 'mask.fits')
+    fits.writeto(image_path, image)
+    fits.writeto(mask_path, mask.astype(np.uint8))
+
+    image, params = main.setup([image_path, '-mask', mask_path, '-out', str(tmp_path / 'out.png'),
+                                '-par_out', str(tmp_path / 'parameters.csv'),
+                                '-bg_mean', str(params.bg_mean),
+                                '-bg_variance', str(params.bg_variance), '-gain', '1'])
+
+    assert np.array_equal(params.mask, mask)
+
+    id_map = main.run(image, params)
+
+    assert (id_map[mask] == -1).all()
+    assert (id_map[~mask] > 0).any()
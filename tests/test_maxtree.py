@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from mtolib import maxtree
+from mtolib.preprocessing import preprocess_image, quantise_image
+
+from tests.helpers import EDGE_FRAMES, SEEDS, edge_frame, find_objects, small_frame
+
+
+def flooded_tree(image, params, maxtree_class=maxtree.OriginalMaxTree, **kwargs):
+    mt = maxtree_class(image, 0, params, **kwargs)
+    mt.flood()
+
+    return mt
+
+
+def assert_same_tree(mt, expected):
+    # Parents and areas are identical. Volumes and powers are summed in another order.
+    assert mt.root_index() == expected.root_index()
+    assert np.array_equal(mt.parent, expected.parent)
+    assert np.array_equal(mt.area, expected.area)
+    assert np.allclose(mt.volume, expected.volume, rtol=1e-4, atol=1e-3)
+    assert np.allclose(mt.power, expected.power, rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('num_threads', [2, 3, 7])
+@pytest.mark.parametrize('connectivity', [4, 8, 12])
+def test_parallel_tree_matches_original(seed, num_threads, connectivity):
+    image, params = small_frame(seed)
+    params.connectivity = connectivity
+    processed_image = preprocess_image(image, params, n=2)
+
+    expected = flooded_tree(processed_image, params)
+    mt = flooded_tree(processed_image, params, maxtree.ParallelMaxTree, num_threads=num_threads)
+
+    assert_same_tree(mt, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('connectivity', [4, 8, 12])
+def test_union_find_tree_matches_original(seed, connectivity):
+    image, params = small_frame(seed)
+    params.connectivity = connectivity
+    processed_image = preprocess_image(image, params, n=2)
+
+    expected = flooded_tree(processed_image, params)
+    mt = flooded_tree(processed_image, params, maxtree.UnionFindMaxTree)
+
+    assert_same_tree(mt, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('levels', [64, 65536])
+def test_quantised_tree_matches_original_of_quantised_image(seed, levels):
+    image, params = small_frame(seed)
+    processed_image = preprocess_image(image, params, n=2)
+
+    expected = flooded_tree(quantise_image(processed_image, levels)[0], params)
+    mt = flooded_tree(processed_image, params, maxtree.QuantisedMaxTree, levels=levels)
+
+    assert_same_tree(mt, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_parallel_objects_match_original(seed):
+    image, params = small_frame(seed)
+    _, _, expected = find_objects(image, params)
+
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params, maxtree.ParallelMaxTree, num_threads=4)
+
+    assert np.array_equal(id_map, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_union_find_objects_match_original(seed):
+    image, params = small_frame(seed)
+    _, _, expected = find_objects(image, params)
+
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params, maxtree.UnionFindMaxTree)
+
+    assert np.array_equal(id_map, expected)
+
+
+@pytest.mark.parametrize('name', EDGE_FRAMES)
+@pytest.mark.parametrize('connectivity', [4, 8, 12])
+def test_engines_match_original_on_edge_frames(name, connectivity):
+    # The frames are flooded without smoothing, which would take away their flat zones
+    image, params = edge_frame(name)
+    params.connectivity = connectivity
+
+    expected = flooded_tree(image, params)
+
+    assert_same_tree(flooded_tree(image, params, maxtree.ParallelMaxTree, num_threads=3),
+                     expected)
+    assert_same_tree(flooded_tree(image, params, maxtree.UnionFindMaxTree), expected)
+
+    assert_same_tree(flooded_tree(image, params, maxtree.QuantisedMaxTree, levels=64),
+                     flooded_tree(quantise_image(image, 64)[0], params))
+
+
+@pytest.mark.parametrize('maxtree_class', [maxtree.OriginalMaxTree, maxtree.ParallelMaxTree,
+                                           maxtree.UnionFindMaxTree])
+def test_fully_masked_image_is_rejected(maxtree_class):
+    image, params = edge_frame('plateaus')
+
+    with pytest.raises(ValueError):
+        maxtree_class(np.full(image.shape, np.nan, dtype=image.dtype), 0, params)
+
+    mt = maxtree_class(image, 0, params)
+    with pytest.raises(ValueError):
+        mt.set_mask(np.ones(image.shape, dtype=bool))
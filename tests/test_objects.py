@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from mtolib import maxtree
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import EDGE_FRAMES, SEEDS, edge_frame, find_objects, small_frame
+
+
+def assert_relevant_nodes_sorted(mt, image):
+    # Every level root other than the root is tested, in order of value and then of index
+    parents, _ = mt.node_arrays()
+    values = image.ravel()
+    level_roots = np.nonzero((parents >= 0) & (values[np.maximum(parents, 0)] != values))[0]
+
+    expected = level_roots[np.lexsort((level_roots, values[level_roots]))]
+
+    assert np.array_equal(mt.objects().relevant_indices, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_relevant_nodes_are_sorted_by_value_and_index(seed):
+    image, params = small_frame(seed)
+    processed_image, mt, _ = find_objects(image, params)
+    filter_tree(mt, processed_image, params, keep_object_data=True)
+
+    assert_relevant_nodes_sorted(mt, processed_image)
+
+
+@pytest.mark.parametrize('name', EDGE_FRAMES)
+@pytest.mark.parametrize('connectivity', [4, 8, 12])
+def test_engines_find_the_same_objects_on_edge_frames(name, connectivity):
+    # Ties between flat zones are broken in the same way whichever engine built the tree
+    image, params = edge_frame(name)
+    params.connectivity = connectivity
+
+    id_maps = []
+    for maxtree_class, kwargs in ((maxtree.OriginalMaxTree, {}),
+                                  (maxtree.ParallelMaxTree, dict(num_threads=3)),
+                                  (maxtree.UnionFindMaxTree, {})):
+        mt = maxtree_class(image, 0, params, **kwargs)
+        mt.flood()
+
+        id_map, _ = filter_tree(mt, image, params, keep_object_data=True)
+        assert_relevant_nodes_sorted(mt, image)
+
+        id_maps.append(id_map)
+
+    assert np.unique(id_maps[0][id_maps[0] >= 0]).size > 1
+    assert all(np.array_equal(id_map, id_maps[0]) for id_map in id_maps[1:])
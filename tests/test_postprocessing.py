@@ -0,0 +1,184 @@
+import numpy as np
+import pytest
+from skimage.color import label2rgb
+
+from mtolib import maxtree
+from mtolib.postprocessing import ObjectIndex, colour_labels, get_catalogue, get_image_parameters, \
+    get_tree_catalogue, headings, levelled_segments, relabel_segments, tree_headings
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import SEEDS, find_objects, small_frame
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_tree_catalogue_matches_catalogue_of_smoothed_image(seed):
+    image, params = small_frame(seed)
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.enable_moments()
+    mt.flood()
+
+    id_map, _ = filter_tree(mt, processed_image, params)
+    index = ObjectIndex(id_map)
+
+    parents, areas = mt.node_arrays()
+    tree_rows = np.array(get_tree_catalogue(processed_image, id_map, parents, areas,
+                                            mt.node_moments(), index))
+    rows = np.array(get_catalogue(processed_image, id_map, index))
+
+    # The smoothed columns are those of get_catalogue for the smoothed image
+    for name in ('X', 'Y', 'A', 'B', 'theta', 'total_flux', 'mu_mean'):
+        assert np.allclose(tree_rows[:, tree_headings.index(name + '_smoothed')],
+                           rows[:, headings.index(name)], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_catalogue_matches_loop(seed):
+    image, params = small_frame(seed)
+    processed_image, _, id_map = find_objects(image, params)
+
+    # Images are read as float64, where the loop's sums are as precise as the catalogue's
+    img = processed_image.astype(np.float64)
+
+    expected = get_image_parameters(img, id_map, None, params, vectorised=False)
+    parameters = get_image_parameters(img, id_map, None, params)
+
+    assert parameters[0] == expected[0] == headings
+    assert len(parameters) == len(expected)
+
+    rows = np.array(parameters[1:], dtype=np.float64)
+    expected_rows = np.array(expected[1:], dtype=np.float64)
+
+    assert np.array_equal(rows[:, 0], expected_rows[:, 0])
+    assert np.allclose(rows, expected_rows, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_object_index_matches_argsort(seed):
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params)
+
+    index = ObjectIndex(id_map)
+    ids = id_map.ravel()
+
+    labels = np.unique(ids[ids >= 0])
+    assert np.array_equal(index.labels, labels)
+
+    for n, label in enumerate(labels):
+        assert np.array_equal(index.object_pixels(n), np.flatnonzero(ids == label))
+
+    # Labels too large for the C counting sort are sorted by numpy
+    large_ids = np.where(id_map >= 0, id_map.astype(np.int64) + 2 ** 40, -1)
+    large_index = ObjectIndex(large_ids)
+
+    assert np.array_equal(large_index.labels, labels + 2 ** 40)
+    assert np.array_equal(large_index.offsets, index.offsets)
+    assert np.array_equal(large_index.pixels, index.pixels)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('shuffle_labels', [False, True])
+def test_relabelled_index_matches_new_index(seed, shuffle_labels):
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params)
+
+    index = ObjectIndex(id_map)
+
+    np.random.seed(seed)
+    relabelled_map = relabel_segments(id_map, shuffle_labels, index)
+
+    relabelled = index.relabelled(relabelled_map)
+    expected = ObjectIndex(relabelled_map)
+
+    assert np.array_equal(relabelled.labels, expected.labels)
+    assert np.array_equal(relabelled.offsets, expected.offsets)
+    assert np.array_equal(relabelled.pixels, expected.pixels)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_colour_labels_matches_label2rgb(seed):
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params)
+
+    expected = np.uint8(label2rgb(id_map) * 255)
+
+    assert np.array_equal(colour_labels(id_map), expected)
+    assert np.array_equal(colour_labels(id_map, ObjectIndex(id_map)), expected)
+
+
+def loop_relabel_segments(label_map, shuffle_labels=False):
+    """relabel_segments as it was before it was vectorised, looping over the objects."""
+    original_shape = label_map.shape
+
+    label_map = label_map.ravel()
+    output = np.zeros(label_map.shape, dtype=label_map.dtype) - 1
+
+    sorted_ids = label_map.argsort()
+    id_set = sorted(set(label_map))
+    id_set.remove(-1)
+
+    right_indices = np.searchsorted(label_map, id_set, side='right', sorter=sorted_ids)
+    left_indices = np.searchsorted(label_map, id_set, side='left', sorter=sorted_ids)
+
+    label_list = list(range(1, 1 + len(id_set)))
+
+    if shuffle_labels:
+        np.random.shuffle(label_list)
+
+    for n in range(len(id_set)):
+        pixel_indices = np.unravel_index(sorted_ids[left_indices[n]:right_indices[n]],
+                                         label_map.shape)
+        output[pixel_indices] = label_list[n]
+
+    return output.reshape(original_shape)
+
+
+def loop_levelled_segments(img, label_map):
+    """levelled_segments as it was before it was vectorised, looping over the objects."""
+    output = np.zeros(img.shape)
+
+    label_map = label_map.ravel()
+
+    sorted_ids = label_map.argsort()
+    id_set = list(set(label_map))
+    id_set.remove(-1)
+
+    right_indices = np.searchsorted(label_map, id_set, side='right', sorter=sorted_ids)
+    left_indices = np.searchsorted(label_map, id_set, side='left', sorter=sorted_ids)
+
+    for n in range(len(id_set)):
+        pixel_indices = np.unravel_index(sorted_ids[left_indices[n]:right_indices[n]], img.shape)
+        output[pixel_indices] = np.min(img[pixel_indices])
+
+    return output
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('shuffle_labels', [False, True])
+@pytest.mark.parametrize('use_index', [False, True])
+def test_relabel_segments_matches_loop(seed, shuffle_labels, use_index):
+    image, params = small_frame(seed)
+    _, _, id_map = find_objects(image, params)
+
+    np.random.seed(seed)
+    expected = loop_relabel_segments(id_map, shuffle_labels)
+
+    np.random.seed(seed)
+    output = relabel_segments(id_map, shuffle_labels, ObjectIndex(id_map) if use_index else None)
+
+    assert output.dtype == expected.dtype
+    assert np.array_equal(output, expected)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('use_index', [False, True])
+def test_levelled_segments_matches_loop(seed, use_index):
+    image, params = small_frame(seed)
+    processed_image, _, id_map = find_objects(image, params)
+
+    expected = loop_levelled_segments(processed_image, id_map)
+    output = levelled_segments(processed_image, id_map, ObjectIndex(id_map) if use_index else None)
+
+    assert np.array_equal(output, expected)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from mtolib import preprocessing
+from mtolib.benchmarks import synthetic_image
+
+from tests.helpers import image_params
+
+
+def preprocessing_image(dtype, nans):
+    img = synthetic_image(150, 170, num_sources=40).astype(dtype)
+
+    if nans:
+        img[40:50, 60:75] = np.nan
+        img[0, :] = np.nan
+
+    return img
+
+
+def preprocessing_mask(img):
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[100:130, 20:90] = True
+    mask[:, -3:] = True
+
+    return mask
+
+
+@pytest.mark.parametrize('dtype', ['<f4', '>f4', '<f8', '>f8'])
+@pytest.mark.parametrize('nans', [False, True])
+@pytest.mark.parametrize('nan_value', [None, 0, 5])
+@pytest.mark.parametrize('gaussian_blur', [False, True])
+@pytest.mark.parametrize('masked', [False, True])
+def test_fused_preprocessing_matches_unfused(monkeypatch, dtype, nans, nan_value, gaussian_blur,
+                                             masked):
+    # Process the image in blocks of a few rows
+    monkeypatch.setattr(preprocessing, 'BLOCK_SIZE', 4096)
+
+    img = preprocessing_image(dtype, nans)
+    mask = preprocessing_mask(img) if masked else None
+
+    params = image_params(img)
+    expected = preprocessing.preprocess_image(img, params, gaussian_blur, nan_value=nan_value,
+                                              fused=False, mask=mask)
+
+    params = image_params(img)
+    output = preprocessing.preprocess_image(img, params, gaussian_blur, nan_value=nan_value,
+                                            mask=mask)
+
+    assert output.dtype == expected.dtype
+    assert np.array_equal(output, expected, equal_nan=True)
+
+
+def test_fused_preprocessing_in_place():
+    img = preprocessing_image(np.float32, True)
+
+    params = image_params(img)
+    expected = preprocessing.preprocess_image(img, params, fused=False)
+
+    params = image_params(img)
+    output = preprocessing.preprocess_image(img, params, out=img)
+
+    assert output is img
+    assert np.array_equal(output, expected, equal_nan=True)
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_smoothing_ignores_masked_and_nan_pixels(fused):
+    # Normalised smoothing of a flat image stays flat up to the masked and NaN pixels
+    img = np.full((150, 170), 3.0, dtype=np.float32)
+    img[40:50, 60:75] = np.nan
+
+    mask = preprocessing_mask(img)
+    img[mask] = 1e6
+
+    params = image_params(img, bg_mean=1.0, bg_variance=1.0)
+    params.gain = 1
+    output = preprocessing.preprocess_image(img, params, fused=fused, mask=mask)
+
+    invalid = mask | np.isnan(img)
+    assert np.isnan(output[invalid]).all()
+    assert np.allclose(output[~invalid], 2, rtol=1e-5)
+
+
+def test_background_ignores_masked_pixels():
+    img = preprocessing_image(np.float32, True)
+    mask = preprocessing_mask(img)
+
+    masked_img = img.copy()
+    masked_img[mask] = np.nan
+
+    expected = image_params(masked_img)
+    preprocessing.estimate_background(masked_img, expected)
+
+    img[mask] = 1e6
+    params = image_params(img)
+    preprocessing.estimate_background(img, params, mask)
+
+    assert np.isclose(params.bg_mean, expected.bg_mean, rtol=1e-6)
+    assert np.isclose(params.bg_variance, expected.bg_variance, rtol=1e-5)
+    assert np.isclose(params.gain, expected.gain, rtol=1e-5)
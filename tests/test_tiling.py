@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from mtolib import maxtree, tiling
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree
+
+from tests.helpers import SEEDS, find_objects, image_params, small_frame
+
+
+def line_image(connectivity):
+    """A line of pixels peaking in its middle, which is only connected through the neighbours
+       added by the connectivity: a diagonal for 8, and every second pixel of a row for 12."""
+    img = np.full((64, 64), np.nan, dtype=np.float32)
+    i = np.arange(64)
+
+    if connectivity == 12:
+        img[32, ::2] = 100 - np.abs(i[::2] - 30)
+    else:
+        img[i, i] = 100 - np.abs(i - 30)
+
+    params = image_params(img, bg_mean=0, bg_variance=1)
+    params.gain = 1
+    params.connectivity = connectivity
+
+    return img, params
+
+
+def test_objects_with_the_same_marker_pixel_stay_apart():
+    # Two tiles of width 4 overlapping in columns 2 and 3, whose objects both have their marker
+    # at pixel 3 of the image but do not cross the seam between columns 2 and 3
+    tile_origins = np.array([(0, 0, 4), (0, 2, 4)])
+    left = tiling.tile_ids(np.full((2, 4), 3), 0, 16, np.int32)
+    right = tiling.tile_ids(np.full((2, 4), 1), 1, 16, np.int32)
+
+    id_map = np.concatenate((left[:, :3], right[:, 1:]), axis=1)
+
+    id_map = tiling.marker_ids(id_map, tile_origins, 16)
+
+    # The right object keeps its marker, and the left one takes its first pixel
+    assert np.array_equal(id_map, [[0, 0, 0, 3, 3, 3], [0, 0, 0, 3, 3, 3]])
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('tile_size, overlap', [(16, 4), (24, 8), (32, 12)])
+@pytest.mark.parametrize('connectivity', [4, 8, 12])
+def test_tiled_ids_are_pixels_of_their_objects(seed, tile_size, overlap, connectivity):
+    image, params = small_frame(seed)
+    params.connectivity = connectivity
+    processed_image = preprocess_image(image, params, n=2)
+
+    id_map, _ = tiling.filter_tiles(processed_image, params, tile_size, overlap)
+
+    labels = np.unique(id_map[id_map >= 0])
+    assert np.array_equal(id_map.ravel()[labels], labels)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_single_tile_matches_filter_tree(seed):
+    image, params = small_frame(seed)
+    processed_image, _, expected = find_objects(image, params)
+
+    id_map, _ = tiling.filter_tiles(processed_image, params, 128, 8)
+
+    assert np.array_equal(id_map, expected)
+
+
+@pytest.mark.parametrize('connectivity', [8, 12])
+def test_objects_crossing_seams_through_further_neighbours_are_merged(connectivity):
+    img, params = line_image(connectivity)
+
+    mt = maxtree.OriginalMaxTree(img, 0, params)
+    mt.flood()
+    expected, _ = filter_tree(mt, img, params)
+
+    id_map, _ = tiling.filter_tiles(img, params, 40, 16)
+
+    # The line is one object, although the tiles' trees may give it fewer pixels
+    assert np.unique(expected[expected >= 0]).size == 1
+    assert np.unique(id_map[id_map >= 0]).size == 1
+    assert (expected[id_map >= 0] >= 0).all()
+
+
+def test_fully_masked_image_is_rejected():
+    image, params = small_frame(0)
+    processed_image = preprocess_image(image, params, n=2)
+
+    with pytest.raises(ValueError, match='Every pixel of the image is masked'):
+        tiling.filter_tiles(processed_image, params, 32, 8,
+                            mask=np.ones(processed_image.shape, dtype=bool))
+
+
+def test_overlap_covers_the_connectivity():
+    img, params = line_image(12)
+
+    with pytest.raises(ValueError):
+        tiling.filter_tiles(img, params, 40, 3)
@@ -0,0 +1,70 @@
+import copy
+import itertools
+
+import numpy as np
+import pytest
+
+from mtolib import maxtree, significance_tests
+from mtolib.preprocessing import preprocess_image
+from mtolib.tree_filtering import filter_tree, sweep_tree
+
+from tests.helpers import SEEDS, small_frame
+
+
+SETTINGS = [dict(alpha=alpha, move_factor=move_factor, min_distance=min_distance)
+            for alpha, move_factor, min_distance
+            in itertools.product([1e-6, 1e-3], [0, 0.5], [0, 2])] + [{}]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('num_threads', [1, 3])
+def test_sweep_matches_filter_tree(seed, num_threads):
+    image, params = small_frame(seed)
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    results = sweep_tree(mt, processed_image, params, SETTINGS, num_threads=num_threads)
+
+    assert len(results) == len(SETTINGS)
+
+    for setting, (id_map, sig_ancs) in zip(SETTINGS, results):
+        setting_params = copy.copy(params)
+        for name, value in setting.items():
+            setattr(setting_params, name, value)
+
+        expected_ids, expected_sig_ancs = filter_tree(mt, processed_image, setting_params)
+
+        assert np.array_equal(id_map, expected_ids)
+        assert np.array_equal(sig_ancs, expected_sig_ancs)
+
+
+def test_sweep_rejects_other_parameters():
+    image, params = small_frame(0)
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    with pytest.raises(ValueError):
+        sweep_tree(mt, processed_image, params, [dict(gain=2)])
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('alpha', [1e-6, 1e-3])
+@pytest.mark.parametrize('min_distance', [0, 2])
+def test_batch_test_4_matches_c_test_4(seed, alpha, min_distance):
+    image, params = small_frame(seed)
+    params.alpha = alpha
+    params.min_distance = min_distance
+    processed_image = preprocess_image(image, params, n=2)
+
+    mt = maxtree.OriginalMaxTree(processed_image, 0, params)
+    mt.flood()
+
+    expected_ids, expected_sig_ancs = filter_tree(mt, processed_image, params)
+    id_map, sig_ancs = filter_tree(mt, processed_image, params, significance_tests.batch_test_4())
+
+    assert np.array_equal(id_map, expected_ids)
+    assert np.array_equal(sig_ancs, expected_sig_ancs)